@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+import argparse
+import enum
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import PIL
+import PIL.Image
+
+from purepale.batching import BatchJob, BatchKey, BatchScheduler, get_batch_key
+from purepale.ingest import ImageStore
+from purepale.options import add_pipes_options, get_batch_scheduler
+from purepale.output import get_suffix, is_sidecar, split_request, write_result
+from purepale.runtime import set_num_threads
+from purepale.schema import (
+    ModelConfig,
+    OutputOptions,
+    Parameters,
+    PipesRequest,
+    PrasedPrompt,
+    SchedulerName,
+    WebRequest,
+    WebResponse,
+)
+from purepale.workers import WorkerPool
+from purepale.writer import BackgroundWriter
+
+logger = getLogger(__name__)
+
+FILE_NAME_PREFIX: str = "batch_"
+
+
+class BatchEntry:
+    """A request of one image to generate offline."""
+
+    request: WebRequest
+    image_dir: Path
+    name: str
+
+    def __init__(self, *, request: WebRequest, image_dir: Path):
+        self.request = request
+        self.image_dir = image_dir
+        # Same requests have the same file name, which tells whether it is already generated
+        key: str = hashlib.sha256(request.json(sort_keys=True).encode("utf8")).hexdigest()
+        self.name = f"{FILE_NAME_PREFIX}{key[:32]}"
+
+    @property
+    def group_key(self) -> BatchKey:
+        """Return the key of batches which the entry can join."""
+        # Paths stand for images, which decide the mode
+        shape = PipesRequest(
+            initial_image=self.request.path_initial_image,
+            initial_image_mask=self.request.path_initial_image_mask,
+            parameters=self.request.parameters,
+        )
+        return get_batch_key(model=self.request.model, request=shape)
+
+
+def _get_sort_key(entry: BatchEntry) -> Tuple:
+    """Return the key to sort entries so that ones of the same batch are adjacent."""
+    return tuple((v is not None, v.value if isinstance(v, enum.Enum) else v) for v in entry.group_key)
+
+
+def _set_seeds(request: WebRequest, *, entry_id: str) -> WebRequest:
+    """Return the request with seeds. Ones without seeds get seeds derived from ``entry_id``, so reruns are the same."""
+    if request.seeds is not None:
+        return request
+    seed: Optional[int] = request.parameters.seed
+    if seed is None:
+        seed = int(hashlib.sha256(entry_id.encode("utf8")).hexdigest()[:13], 16)
+    return request.copy(update={"seeds": [seed + i for i in range(request.num_images)]})
+
+
+def _read_requests(path: Path, opts: argparse.Namespace) -> Iterator[Tuple[str, WebRequest, Optional[str]]]:
+    """Yield IDs, requests and used prompts of inputs.
+
+    An input is a directory of JSON logs, a JSONL file of logs or requests, or a prompt file.
+    """
+    if path.is_dir():
+        for path_log in sorted(path.glob("*.json")):
+            if is_sidecar(path_log):
+                continue
+            with path_log.open() as inf:
+                data = json.load(inf)
+            if not isinstance(data, dict) or "request" not in data:
+                continue  # Not a log of generation
+            yield str(path_log.resolve()), WebRequest.parse_obj(data["request"]), data["parsed_prompt"]["used_prompt"]
+        return
+
+    num_prompts: int = 0
+    with path.open() as inf:
+        for lineno, line in enumerate(inf, start=1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            entry_id: str = f"{path.resolve()}:{lineno}"
+            if path.suffix == ".jsonl":
+                data = json.loads(line)
+                yield (
+                    entry_id,
+                    WebRequest.parse_obj(data.get("request", data)),
+                    data.get("parsed_prompt", {}).get("used_prompt"),
+                )
+            elif not line.startswith("#"):
+                if not opts.model:
+                    raise ValueError("--model is required for prompt files")
+                yield entry_id, WebRequest(
+                    model=opts.model[0],
+                    parameters=Parameters(
+                        prompt=line,
+                        height=opts.height,
+                        width=opts.width,
+                        num_inference_steps=opts.steps,
+                        guidance_scale=opts.guidance_scale,
+                        scheduler=opts.scheduler,
+                        seed=None if opts.seed is None else opts.seed + num_prompts * opts.num_images,
+                    ),
+                    num_images=opts.num_images,
+                ), None
+                num_prompts += 1
+
+
+def load_entries(opts: argparse.Namespace) -> List[BatchEntry]:
+    """Return entries of all inputs sorted so that entries of the same batch key are adjacent."""
+    entries: List[BatchEntry] = []
+    for path in opts.input:
+        image_dir: Path = opts.image_dir if opts.image_dir is not None else path if path.is_dir() else path.parent
+        for entry_id, request, used_prompt in _read_requests(path, opts):
+            request = _set_seeds(request, entry_id=entry_id)
+            assert request.seeds is not None
+            # A log has the prompt used for its first image
+            used_prompts: List[Optional[str]] = [used_prompt] + [None] * (len(request.seeds) - 1)
+            entries += [
+                BatchEntry(request=r, image_dir=image_dir) for r in split_request(request, used_prompts=used_prompts)
+            ]
+    return sorted(entries, key=_get_sort_key)
+
+
+class BatchRunner:
+    """Generate entries with a scheduler and write images and JSON logs like the server.
+
+    A JSON log is written atomically after its image, so entries with logs are complete and skipped on reruns.
+    At most ``max_inflight`` entries are submitted at once to bound memory of initial images and results.
+    """
+
+    def __init__(
+        self,
+        *,
+        batch_scheduler: Union[BatchScheduler, WorkerPool],
+        path_out: Path,
+        default_output: OutputOptions,
+        writer: BackgroundWriter,
+        max_inflight: int,
+        image_cache_mb: int,
+    ):
+        self.batch_scheduler: Union[BatchScheduler, WorkerPool] = batch_scheduler
+        self.path_out: Path = path_out
+        self.default_output: OutputOptions = default_output
+        self.writer: BackgroundWriter = writer
+        self.image_cache_mb: int = image_cache_mb
+
+        self.max_inflight: int = max_inflight
+        self._cond = threading.Condition()
+        self._num_inflight: int = 0
+        self._lock = threading.Lock()
+        self._image_stores: Dict[Path, ImageStore] = {}
+        self.num_done: int = 0
+        self.num_failed: int = 0
+        self._total: int = 0
+        self._start: float = time.monotonic()
+        self._last_report: float = 0.0
+
+    def _acquire(self) -> None:
+        with self._cond:
+            while self._num_inflight >= self.max_inflight:
+                self._cond.wait()
+            self._num_inflight += 1
+
+    def _release(self) -> None:
+        with self._cond:
+            self._num_inflight -= 1
+            self._cond.notify_all()
+
+    def is_done(self, entry: BatchEntry) -> bool:
+        return self.path_out.joinpath(f"{entry.name}.json").exists()
+
+    def _get_pipes_request(self, entry: BatchEntry) -> PipesRequest:
+        image_store: Optional[ImageStore] = self._image_stores.get(entry.image_dir)
+        if image_store is None:
+            image_store = self._image_stores[entry.image_dir] = ImageStore(
+                path_out=entry.image_dir,
+                max_bytes=self.image_cache_mb * 1024 * 1024,
+            )
+        request: WebRequest = entry.request
+        parameters: Parameters = request.parameters
+        return PipesRequest(
+            initial_image=None
+            if request.path_initial_image is None
+            else image_store.get_image(request.path_initial_image, width=parameters.width, height=parameters.height),
+            initial_image_mask=None
+            if request.path_initial_image_mask is None
+            else image_store.get_mask(
+                request.path_initial_image_mask, width=parameters.width, height=parameters.height
+            ),
+            initial_image_key=None
+            if request.path_initial_image is None
+            else image_store.get_digest(request.path_initial_image),
+            initial_image_mask_key=None
+            if request.path_initial_image_mask is None
+            else image_store.get_digest(request.path_initial_image_mask),
+            parameters=parameters,
+            seeds=request.seeds,
+        )
+
+    def _write(self, entry: BatchEntry, image: PIL.Image.Image, parsed_prompt: PrasedPrompt) -> None:
+        request: WebRequest = entry.request
+        output: OutputOptions = request.output or self.default_output
+        name_image: str = f"{entry.name}{get_suffix(output)}"
+        resp = WebResponse(
+            request=request,
+            model=ModelConfig.parse(request.model),
+            path=f"images/{name_image}",
+            scheduler=self.batch_scheduler.scheduler_param(request.model, request.parameters.scheduler),
+            parsed_prompt=parsed_prompt,
+            paths=[f"images/{name_image}"],
+            seeds=request.seeds or [],
+        )
+        write_result(
+            image,
+            path_image=self.path_out.joinpath(name_image),
+            resp=resp,
+            path_log=self.path_out.joinpath(f"{entry.name}.json"),
+            options=output,
+        )
+
+    def _report(self, *, force: bool = False) -> None:
+        now: float = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < 10.0:
+                return
+            self._last_report = now
+            finished: int = self.num_done + self.num_failed
+            elapsed: float = now - self._start
+            eta: str = "" if finished == 0 else f", ETA {elapsed / finished * (self._total - finished):.0f}s"
+            logger.info(f"{finished}/{self._total} images ({self.num_failed} failed) in {elapsed:.0f}s{eta}")
+
+    def _on_generated(
+        self,
+        entry: BatchEntry,
+        future: "Future[List[Tuple[PIL.Image.Image, PrasedPrompt]]]",
+    ) -> None:
+        e: Optional[BaseException] = future.exception()
+        if e is not None:
+            logger.error(f"Failed to generate {entry.name}: {''.join(str(v) for v in e.args)}")
+            with self._lock:
+                self.num_failed += 1
+            self._release()
+            return
+
+        def write() -> None:
+            try:
+                image, parsed_prompt = future.result()[0]
+                self._write(entry, image, parsed_prompt)
+                with self._lock:
+                    self.num_done += 1
+            except Exception:
+                with self._lock:
+                    self.num_failed += 1
+                raise
+            finally:
+                self._release()
+                self._report()
+
+        self.writer.submit([entry.name], write)
+
+    def run(self, entries: List[BatchEntry]) -> None:
+        """Generate entries and wait for all of them to be written."""
+        self._total = len(entries)
+        for entry in entries:
+            self._acquire()
+            try:
+                request: PipesRequest = self._get_pipes_request(entry)
+                job: BatchJob = self.batch_scheduler.submit(model=entry.request.model, request=request)
+            except Exception:
+                logger.exception(f"Failed to submit {entry.name}")
+                with self._lock:
+                    self.num_failed += 1
+                self._release()
+                continue
+            job.future.add_done_callback(lambda future, entry=entry: self._on_generated(entry, future))
+        with self._cond:
+            while self._num_inflight > 0:
+                self._cond.wait()
+        self._report(force=True)
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument(
+        "input",
+        type=Path,
+        nargs="+",
+        help="Directories of JSON logs, JSONL files of logs or requests, or prompt files with a prompt per line",
+    )
+    oparser.add_argument("--output", "-o", type=Path, required=True)
+    oparser.add_argument(
+        "--model",
+        action="append",
+        help="Models to load (default: models of requests). The first one is used for prompt files",
+    )
+    oparser.add_argument(
+        "--image-dir",
+        type=Path,
+        help="Directory of initial images of requests (default: the directory of each input)",
+    )
+    oparser.add_argument("--num-images", "-n", type=int, help="Number of images per prompt of prompt files", default=1)
+    oparser.add_argument("--height", type=int, default=Parameters.__fields__["height"].default)
+    oparser.add_argument("--width", type=int, default=Parameters.__fields__["width"].default)
+    oparser.add_argument("--steps", type=int, default=Parameters.__fields__["num_inference_steps"].default)
+    oparser.add_argument("--guidance-scale", type=float, default=Parameters.__fields__["guidance_scale"].default)
+    oparser.add_argument("--scheduler", type=SchedulerName, choices=list(SchedulerName))
+    oparser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the first prompt of prompt files (default: derived from the file and the line)",
+    )
+    oparser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes per model. 0 means generating in this process",
+        default=0,
+    )
+    add_pipes_options(oparser)
+    # Offline runs have every request at hand, so batches are filled by default
+    oparser.set_defaults(batch_window_ms=100, max_batch=4)
+    return oparser.parse_args()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    opts = get_opts()
+    opts.output.mkdir(exist_ok=True, parents=True)
+
+    entries: List[BatchEntry] = load_entries(opts)
+    models: List[str] = opts.model if opts.model else sorted({entry.request.model for entry in entries})
+    unknown: List[str] = sorted({entry.request.model for entry in entries} - set(models))
+    if len(unknown) > 0:
+        raise ValueError(f"Requests use models which are not given by --model: {unknown}")
+    default_output = OutputOptions(format=opts.output_format, quality=opts.output_quality)
+
+    if opts.workers == 0:
+        set_num_threads(intra_op=opts.threads, inter_op=opts.interop_threads)
+    # Entries are sorted by model, so each model is loaded once even when they do not fit in the budget together
+    batch_scheduler: Union[BatchScheduler, WorkerPool] = get_batch_scheduler(
+        opts,
+        models=models,
+        replicas=opts.workers,
+    )
+
+    writer = BackgroundWriter(max_workers=opts.writer_threads)
+    runner = BatchRunner(
+        batch_scheduler=batch_scheduler,
+        path_out=opts.output,
+        default_output=default_output,
+        writer=writer,
+        # Enough to fill every batch of every worker while the next ones are prepared
+        max_inflight=2 * opts.max_batch * opts.max_process * max(1, opts.workers) * len(models),
+        image_cache_mb=opts.image_cache_mb,
+    )
+    todo: List[BatchEntry] = [entry for entry in entries if not runner.is_done(entry)]
+    logger.info(f"{len(todo)} images to generate ({len(entries) - len(todo)} already generated)")
+    try:
+        runner.run(todo)
+    finally:
+        # Interrupted entries have no logs, so they are generated again at the next run
+        batch_scheduler.close()
+        writer.close()
+    if runner.num_failed > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
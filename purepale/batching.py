@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from concurrent.futures import Future
+from logging import getLogger
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+import PIL
+import PIL.Image
+
+from purepale.metrics import METRICS
+from purepale.pipes import GenerationCancelled
+from purepale.prompt import Prompt
+from purepale.registry import PipesRegistry
+from purepale.schema import GenerationMode, PipesRequest, PrasedPrompt, SchedulerName
+
+logger = getLogger(__name__)
+
+
+class BatchKey(NamedTuple):
+    model: str
+    mode: GenerationMode
+    height: int
+    width: int
+    num_inference_steps: int
+    tileable: bool
+    eta: float
+    strength: Optional[float]
+    scheduler: Optional[SchedulerName]
+
+
+def get_batch_key(*, model: str, request: PipesRequest) -> BatchKey:
+    mode: GenerationMode = request.get_mode()
+    return BatchKey(
+        model=model,
+        mode=mode,
+        height=request.parameters.height,
+        width=request.parameters.width,
+        num_inference_steps=request.parameters.num_inference_steps,
+        tileable=Prompt(original=request.parameters.prompt).tileable,
+        eta=request.parameters.eta,
+        strength=None if mode == GenerationMode.txt2img else request.parameters.strength,
+        scheduler=request.parameters.scheduler,
+    )
+
+
+class BatchJob:
+    request: PipesRequest
+    priority: int
+    client: str
+    arrived: float
+    future: "Future[List[Tuple[PIL.Image.Image, PrasedPrompt]]]"
+    cancel_requested: bool
+    step: int
+    total_steps: int
+    on_progress: Optional[Callable[["BatchJob"], None]]
+    # Jobs of parts of the images which run in place of this job
+    chunks: List["BatchJob"]
+
+    def __init__(
+        self,
+        *,
+        request: PipesRequest,
+        priority: int,
+        on_progress: Optional[Callable[["BatchJob"], None]],
+        client: str = "",
+    ):
+        self.request = request
+        self.priority = priority
+        self.client = client
+        self.arrived = time.monotonic()
+        self.future = Future()
+        self.cancel_requested = False
+        self.step = 0
+        self.total_steps = 0
+        self.on_progress = on_progress
+        self.chunks = []
+
+    @property
+    def num_images(self) -> int:
+        return len(self.request.get_seeds())
+
+    @property
+    def step_cost(self) -> int:
+        """Return the estimated cost of a denoising step, which is proportional to pixels of images."""
+        return self.request.parameters.height * self.request.parameters.width * self.num_images
+
+    @property
+    def remaining_cost(self) -> int:
+        """Return the estimated cost of steps which are not finished yet."""
+        total_steps: int = self.total_steps if self.total_steps > 0 else self.request.parameters.num_inference_steps
+        return (total_steps - self.step) * self.step_cost
+
+
+class FairShare:
+    """Usage of each client, the estimated cost of its steps, to run jobs of less served clients first.
+
+    A client which starts sending jobs begins with the least usage among active clients,
+    so that being idle does not give it credit to starve others later.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._usage: Dict[str, float] = {}
+        self._active: Dict[str, int] = {}
+
+    def join(self, job: BatchJob) -> None:
+        """Count the job of its client until it is done."""
+        with self._lock:
+            if job.client not in self._active:
+                least: float = min((self._usage[c] for c in self._active), default=0.0)
+                self._usage[job.client] = max(self._usage.get(job.client, 0.0), least)
+            self._active[job.client] = self._active.get(job.client, 0) + 1
+        job.future.add_done_callback(lambda _: self._leave(job.client))
+
+    def _leave(self, client: str) -> None:
+        with self._lock:
+            self._active[client] -= 1
+            if self._active[client] > 0:
+                return
+            del self._active[client]
+            # Usage at most the least of active clients is the same as none when the client comes back
+            least: float = min((self._usage[c] for c in self._active), default=float("inf"))
+            for c in [c for c, usage in self._usage.items() if c not in self._active and usage <= least]:
+                del self._usage[c]
+
+    def charge(self, client: str, cost: float) -> None:
+        with self._lock:
+            self._usage[client] = self._usage.get(client, 0.0) + cost
+
+    def order(self, job: BatchJob) -> Tuple[int, float, int, float]:
+        """Return the key to sort jobs: priority, usage of the client, remaining cost and arrival."""
+        with self._lock:
+            usage: float = self._usage.get(job.client, 0.0)
+        return (-job.priority, usage, job.remaining_cost, job.arrived)
+
+
+def track_inflight(*, model: str, job: BatchJob) -> None:
+    """Count the job in the gauge of in-flight requests until it is done."""
+    METRICS.add("purepale_inflight_requests", 1, model=model)
+    job.future.add_done_callback(lambda _: METRICS.add("purepale_inflight_requests", -1, model=model))
+
+
+class BatchScheduler:
+    """Collect requests arriving within a window and run compatible ones as one batch.
+
+    Up to ``max_inflight`` batches are in progress, and at most ``max_process`` of them run a step at the same time.
+    Batches beyond ``max_process`` start only for models already loaded, so interleaving never loads more models
+    than the memory budget allows.
+    Batches take turns after each denoising step, so a long batch does not hold back short ones.
+    While all batches are busy, waiting requests keep joining their groups up to ``max_batch`` images.
+    A request with more images than ``max_batch`` is split into chunks of at most ``max_batch`` images,
+    whose results are gathered in the job of the request.
+    Groups and turns go to higher priority jobs first, then to jobs of clients which used less (see FairShare).
+    """
+
+    def __init__(
+        self,
+        *,
+        registry: PipesRegistry,
+        window_ms: int,
+        max_batch: int,
+        max_process: int,
+        max_inflight: Optional[int] = None,
+    ):
+        assert window_ms >= 0
+        assert max_batch >= 1
+        assert max_process >= 1
+        if max_inflight is None:
+            max_inflight = max_process
+        assert max_inflight >= max_process
+        self.registry: PipesRegistry = registry
+        self.window: float = window_ms / 1000.0
+        self.max_batch: int = max_batch
+        self.max_process: int = max_process
+        self.fair_share = FairShare()
+
+        self._cond = threading.Condition()
+        self._pending: Dict[BatchKey, List[BatchJob]] = {}
+        self.max_inflight: int = max_inflight
+        # Number of batches in progress for each model
+        self._inflight: Dict[str, int] = {}
+        # Batches waiting for their turn to run a step, and the number of batches running one
+        self._turn_cond = threading.Condition()
+        self._waiting: List[List[BatchJob]] = []
+        self._num_running: int = 0
+        self._closed: bool = False
+        self._thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._thread.start()
+
+    @property
+    def models(self) -> List[str]:
+        return self.registry.models
+
+    @property
+    def resident_models(self) -> List[str]:
+        return self.registry.resident_models
+
+    def scheduler_param(self, model: str, scheduler: Optional[SchedulerName] = None) -> Dict[str, Any]:
+        return self.registry.scheduler_param(model, scheduler)
+
+    @property
+    def num_pending(self) -> int:
+        with self._cond:
+            return sum(len(jobs) for jobs in self._pending.values())
+
+    def submit(
+        self,
+        *,
+        model: str,
+        request: PipesRequest,
+        priority: int = 0,
+        on_progress: Optional[Callable[[BatchJob], None]] = None,
+        client: str = "",
+    ) -> BatchJob:
+        assert model in self.registry.models
+        job = BatchJob(
+            request=request,
+            priority=priority,
+            on_progress=on_progress,
+            client=client,
+        )
+        seeds: List[int] = request.get_seeds()
+        if len(seeds) > self.max_batch:
+            self._submit_chunks(
+                job,
+                model=model,
+                requests=[
+                    request.copy(update={"seeds": seeds[i : i + self.max_batch]})
+                    for i in range(0, len(seeds), self.max_batch)
+                ],
+            )
+        else:
+            self._submit(job, model=model)
+        track_inflight(model=model, job=job)
+        return job
+
+    def _submit(self, job: BatchJob, *, model: str) -> None:
+        key: BatchKey = get_batch_key(model=model, request=job.request)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed")
+            self.fair_share.join(job)
+            self._pending.setdefault(key, []).append(job)
+            self._cond.notify()
+
+    def _submit_chunks(self, job: BatchJob, *, model: str, requests: List[PipesRequest]) -> None:
+        """Run requests in place of the job, and gather their results in the job."""
+        lock = threading.Lock()
+
+        def on_progress(_: BatchJob) -> None:
+            with lock:
+                # Steps weighted by images, so that the cost of the job is charged correctly
+                job.step = sum(chunk.step * chunk.num_images for chunk in job.chunks) // job.num_images
+                job.total_steps = max(chunk.total_steps for chunk in job.chunks)
+                if not job.future.running():
+                    job.future.set_running_or_notify_cancel()
+            if job.on_progress is not None:
+                job.on_progress(job)
+
+        def on_done(_: "Future[List[Tuple[PIL.Image.Image, PrasedPrompt]]]") -> None:
+            with lock:
+                if job.future.done() or not all(chunk.future.done() for chunk in job.chunks):
+                    return
+                # Cancelled before any chunk started
+                if all(chunk.future.cancelled() for chunk in job.chunks) and job.future.cancel():
+                    return
+                if not job.future.running():
+                    job.future.set_running_or_notify_cancel()
+                results: List[Tuple[PIL.Image.Image, PrasedPrompt]] = []
+                for chunk in job.chunks:
+                    if chunk.future.cancelled():
+                        job.future.set_exception(GenerationCancelled())
+                        return
+                    e = chunk.future.exception()
+                    if e is not None:
+                        job.future.set_exception(e)
+                        return
+                    results += chunk.future.result()
+                job.future.set_result(results)
+
+        job.chunks = [
+            BatchJob(request=request, priority=job.priority, on_progress=on_progress, client=job.client)
+            for request in requests
+        ]
+        for chunk in job.chunks:
+            self._submit(chunk, model=model)
+        for chunk in job.chunks:
+            chunk.future.add_done_callback(on_done)
+
+    def generate(
+        self,
+        *,
+        model: str,
+        request: PipesRequest,
+        client: str = "",
+    ) -> List[Tuple[PIL.Image.Image, PrasedPrompt]]:
+        return self.submit(model=model, request=request, client=client).future.result()
+
+    def cancel(self, job: BatchJob) -> None:
+        """Drop a queued job, or stop a running one at the next step.
+
+        A running batch stops only when all jobs in it are cancelled.
+        """
+        if len(job.chunks) > 0:
+            job.cancel_requested = True
+            for chunk in job.chunks:
+                self.cancel(chunk)
+            return
+        queued: bool = False
+        with self._cond:
+            job.cancel_requested = True
+            for key, jobs in self._pending.items():
+                if job in jobs:
+                    jobs.remove(job)
+                    if len(jobs) == 0:
+                        del self._pending[key]
+                    queued = True
+                    break
+        # Done callbacks should not run with the lock
+        if queued:
+            job.future.cancel()
+
+    def queue_position(self, job: BatchJob) -> Optional[int]:
+        """Return the number of queued jobs which run before the job, or None if it is not queued."""
+        if len(job.chunks) > 0:
+            return min((p for p in map(self.queue_position, job.chunks) if p is not None), default=None)
+        with self._cond:
+            found: bool = False
+            ahead: int = 0
+            order = self.fair_share.order(job)
+            for jobs in self._pending.values():
+                for other in jobs:
+                    if other is job:
+                        found = True
+                    elif self.fair_share.order(other) < order:
+                        ahead += 1
+            return ahead if found else None
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _pop_ready(self) -> Optional[Tuple[BatchKey, List[BatchJob]]]:
+        """Return the most urgent startable group among groups which are full or whose window has passed."""
+        now: float = time.monotonic()
+        best: Optional[BatchKey] = None
+        best_order = None
+        for key, jobs in self._get_startable().items():
+            if (
+                sum(job.num_images for job in jobs) < self.max_batch
+                and now - min(job.arrived for job in jobs) < self.window
+            ):
+                continue
+            order = min(self.fair_share.order(job) for job in jobs)
+            if best_order is None or order < best_order:
+                best, best_order = key, order
+        if best is None:
+            return None
+
+        jobs: List[BatchJob] = sorted(self._pending.pop(best), key=self.fair_share.order)
+        num: int = 1
+        num_images: int = jobs[0].num_images
+        while num < len(jobs) and num_images + jobs[num].num_images <= self.max_batch:
+            num_images += jobs[num].num_images
+            num += 1
+        if len(jobs) > num:
+            self._pending[best] = jobs[num:]
+        return best, jobs[:num]
+
+    def _get_startable(self) -> Dict[BatchKey, List[BatchJob]]:
+        """Return pending groups which can start a batch now.
+
+        Once ``max_process`` batches are in progress, only groups of models which are loaded or in use can start.
+        """
+        num_inflight: int = sum(self._inflight.values())
+        if num_inflight >= self.max_inflight:
+            return {}
+        if num_inflight < self.max_process:
+            return self._pending
+        models: Set[str] = set(self.registry.resident_models) | set(self._inflight)
+        return {key: jobs for key, jobs in self._pending.items() if key.model in models}
+
+    def _next_timeout(self) -> Optional[float]:
+        startable: Dict[BatchKey, List[BatchJob]] = self._get_startable()
+        if len(startable) == 0:
+            return None
+        now: float = time.monotonic()
+        return max(
+            0.0,
+            min(min(job.arrived for job in jobs) + self.window - now for jobs in startable.values()),
+        )
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            with self._cond:
+                ready: Optional[Tuple[BatchKey, List[BatchJob]]] = None
+                while ready is None and not self._closed:
+                    ready = self._pop_ready()
+                    if ready is None:
+                        self._cond.wait(timeout=self._next_timeout())
+                if ready is None:
+                    break
+                self._inflight[ready[0].model] = self._inflight.get(ready[0].model, 0) + 1
+                for job in ready[1]:
+                    # Jobs in _pending are never cancelled, so this does not call done callbacks
+                    job.future.set_running_or_notify_cancel()
+            threading.Thread(target=self._run, args=ready, daemon=True).start()
+
+        with self._cond:
+            left: List[BatchJob] = [job for jobs in self._pending.values() for job in jobs]
+            self._pending.clear()
+        for job in left:
+            job.future.set_running_or_notify_cancel()
+            job.future.set_exception(RuntimeError("BatchScheduler is closed"))
+
+    def _acquire_turn(self, jobs: List[BatchJob], *, release: bool = False) -> None:
+        """Wait until the batch is the most urgent one waiting and a step can run.
+
+        With ``release``, the turn held by the batch goes to a more urgent one if any.
+        """
+        with self._turn_cond:
+            if release:
+                if len(self._waiting) == 0:
+                    return
+                self._num_running -= 1
+            start: float = time.monotonic()
+            self._waiting.append(jobs)
+            self._turn_cond.notify_all()
+            while (
+                self._num_running >= self.max_process
+                or min(self._waiting, key=lambda w: min(self.fair_share.order(job) for job in w)) is not jobs
+            ):
+                self._turn_cond.wait()
+            self._waiting = [w for w in self._waiting if w is not jobs]
+            self._num_running += 1
+            self._turn_cond.notify_all()
+        METRICS.observe("purepale_queue_wait_seconds", time.monotonic() - start, queue="step")
+
+    def _release_turn(self) -> None:
+        with self._turn_cond:
+            self._num_running -= 1
+            self._turn_cond.notify_all()
+
+    def _get_callback(self, jobs: List[BatchJob]) -> Callable[[int, int], bool]:
+        """Return the callback of steps of a batch, which holds the turn, to report progress and take turns."""
+
+        def callback(step: int, total_steps: int) -> bool:
+            for job in jobs:
+                job.step = step
+                job.total_steps = total_steps
+                self.fair_share.charge(job.client, job.step_cost)
+                if job.on_progress is not None:
+                    job.on_progress(job)
+            if all(job.cancel_requested for job in jobs):
+                return False
+            # Other batches may run their steps before the next one
+            self._acquire_turn(jobs, release=True)
+            return not all(job.cancel_requested for job in jobs)
+
+        return callback
+
+    def _run(self, key: BatchKey, jobs: List[BatchJob]) -> None:
+        now: float = time.monotonic()
+        for job in jobs:
+            METRICS.observe("purepale_queue_wait_seconds", now - job.arrived, queue="batch")
+
+        outcomes: List[Tuple[Optional[List[Tuple[PIL.Image.Image, PrasedPrompt]]], Optional[BaseException]]] = []
+        try:
+            with self.registry.use(key.model) as pipes:
+                self._acquire_turn(jobs)
+                try:
+                    logger.debug(f"Run a batch of {len(jobs)} for {key}")
+                    results = pipes.generate_batch(
+                        requests=[job.request for job in jobs],
+                        callback=self._get_callback(jobs),
+                    )
+                    for job, result in zip(jobs, results):
+                        outcomes.append((None, GenerationCancelled()) if job.cancel_requested else (result, None))
+                except GenerationCancelled as e:
+                    outcomes = [(None, e) for _ in jobs]
+                except Exception as e:
+                    if len(jobs) == 1:
+                        outcomes = [(None, e)]
+                    else:
+                        # Do not let one broken request fail the others.
+                        # Each job runs as a batch of its own, which can be cancelled and takes turns
+                        outcomes = []
+                        for job in jobs:
+                            try:
+                                if job.cancel_requested:
+                                    raise GenerationCancelled()
+                                job.step = 0
+                                result = pipes.generate_batch(
+                                    requests=[job.request],
+                                    callback=self._get_callback([job]),
+                                )[0]
+                                outcomes.append((result, None))
+                            except Exception as e_single:
+                                outcomes.append((None, e_single))
+                finally:
+                    self._release_turn()
+        except Exception as e:
+            # Failed to load the model
+            logger.exception(f"Failed to load {key.model}")
+            outcomes = [(None, e) for _ in jobs]
+        finally:
+            with self._cond:
+                self._inflight[key.model] -= 1
+                if self._inflight[key.model] == 0:
+                    del self._inflight[key.model]
+                self._cond.notify()
+
+        # Done callbacks of futures (e.g. writing files) run after the batch leaves the in-flight ones
+        for job, (result, error) in zip(jobs, outcomes):
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)  # type: ignore
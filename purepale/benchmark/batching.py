@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+
+from purepale.batching import BatchScheduler
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.pipes import Pipes
+from purepale.registry import PipesRegistry
+from purepale.schema import ModelConfig, Parameters, PipesRequest
+
+
+def measure(
+    *,
+    pipes: Pipes,
+    max_batch: int,
+    window_ms: int,
+    num_images: int,
+    parameters: Parameters,
+) -> Dict[str, float]:
+    """Send ``num_images`` requests from ``max_batch`` concurrent clients and return throughput."""
+    batch_scheduler = BatchScheduler(
+        registry=PipesRegistry.of({"tiny": pipes}),
+        window_ms=window_ms,
+        max_batch=max_batch,
+        max_process=1,
+    )
+    seeds: List[int] = list(range(num_images))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if len(seeds) == 0:
+                    return
+                seed: int = seeds.pop()
+            batch_scheduler.generate(
+                model="tiny",
+                request=PipesRequest(parameters=parameters.copy(update={"seed": seed})),
+            )
+
+    threads = [threading.Thread(target=client) for _ in range(max_batch)]
+    start: float = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    elapsed: float = time.perf_counter() - start
+    batch_scheduler.close()
+
+    return {
+        "max_batch": max_batch,
+        "window_ms": window_ms,
+        "num_images": num_images,
+        "elapsed": elapsed,
+        "images_per_sec": num_images / elapsed,
+    }
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument("--model", help="Model to use (default: build a tiny random model)")
+    oparser.add_argument("--batch", type=int, action="append", help="Batch sizes (default: 1, 2, 4, 8)")
+    oparser.add_argument("--window-ms", type=int, default=50)
+    oparser.add_argument("--num-images", "-n", type=int, default=32)
+    oparser.add_argument("--size", type=int, default=256)
+    oparser.add_argument("--steps", type=int, default=10)
+    oparser.add_argument("--threads", type=int, help="torch.set_num_threads")
+    return oparser.parse_args()
+
+
+def main() -> None:
+    opts = get_opts()
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model: str = opts.model
+        if model is None:
+            model = f"{build_tiny_model(Path(tmpdir))}@fp32"
+        pipes = Pipes(
+            model_config=ModelConfig.parse(model),
+            device="cpu",
+            nosafety=True,
+            slice_size=-1,
+            local_files_only=True,
+        )
+        pipes.pipe.set_progress_bar_config(disable=True)
+
+        parameters = Parameters(
+            prompt="a photo of a cat",
+            height=opts.size,
+            width=opts.size,
+            num_inference_steps=opts.steps,
+        )
+        # warmup
+        pipes.generate(request=PipesRequest(parameters=parameters.copy(update={"seed": 0})))
+
+        for max_batch in opts.batch if opts.batch else [1, 2, 4, 8]:
+            result = measure(
+                pipes=pipes,
+                max_batch=max_batch,
+                window_ms=opts.window_ms,
+                num_images=opts.num_images,
+                parameters=parameters,
+            )
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from transformers import BertTokenizer
+
+from purepale.blip import BLIP, BLIP_MED_CONFIG, CaptionDecoder, CaptionOptions
+from purepale.third_party.blip.blip import BLIP_Decoder, create_vit
+from purepale.third_party.blip.med import BertConfig, BertLMHeadModel
+from purepale.third_party.blip.vit import VisionTransformer
+
+BERT_VOCAB_SIZE: int = 30522
+
+
+def build_tokenizer(path_out: Path) -> BertTokenizer:
+    """Return a tokenizer with the same special tokens and vocabulary size as that of BLIP."""
+    path_out.mkdir(exist_ok=True, parents=True)
+    words: List[str] = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "a", "picture", "of"]
+    words += [f"[unused{i}]" for i in range(BERT_VOCAB_SIZE - len(words))]
+    path_vocab: Path = path_out.joinpath("vocab.txt")
+    path_vocab.write_text("\n".join(words) + "\n")
+
+    tokenizer = BertTokenizer(vocab_file=str(path_vocab))
+    tokenizer.add_special_tokens({"bos_token": "[DEC]"})
+    tokenizer.add_special_tokens({"additional_special_tokens": ["[ENC]"]})
+    return tokenizer
+
+
+def build_random_model(path_tokenizer: Path) -> Any:
+    """Return a randomly initialized captioning model of the same size as the pretrained BLIP."""
+    torch.manual_seed(0)
+    visual_encoder, vision_width = create_vit("base", 384)
+    med_config = BertConfig.from_json_file(str(BLIP_MED_CONFIG))
+    med_config.encoder_width = vision_width
+    return SimpleNamespace(
+        visual_encoder=visual_encoder.eval(),
+        text_decoder=BertLMHeadModel(config=med_config).eval(),
+        tokenizer=build_tokenizer(path_tokenizer),
+        prompt="a picture of ",
+    )
+
+
+def build_tiny_model(path_tokenizer: Path) -> Any:
+    """Return a tiny randomly initialized captioning model with the same inputs and tokenizer as BLIP."""
+    torch.manual_seed(0)
+    vision_width: int = 32
+    visual_encoder = VisionTransformer(img_size=384, patch_size=16, embed_dim=vision_width, depth=1, num_heads=2)
+    med_config = BertConfig.from_json_file(str(BLIP_MED_CONFIG))
+    med_config.update(
+        {
+            "hidden_size": 32,
+            "num_hidden_layers": 1,
+            "num_attention_heads": 2,
+            "intermediate_size": 64,
+            "encoder_width": vision_width,
+        }
+    )
+    return SimpleNamespace(
+        visual_encoder=visual_encoder.eval(),
+        text_decoder=BertLMHeadModel(config=med_config).eval(),
+        tokenizer=build_tokenizer(path_tokenizer),
+        prompt="a picture of ",
+    )
+
+
+def measure(*, name: str, func: Callable[[], List[str]], repeat: int) -> Dict[str, Any]:
+    func()  # warmup
+    elapsed: List[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        captions: List[str] = func()
+        elapsed.append(time.perf_counter() - start)
+    return {
+        "mode": name,
+        "mean_sec": sum(elapsed) / repeat,
+        "min_sec": min(elapsed),
+        "captions": captions,
+    }
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument("--pretrained", action="store_true", help="Use the pretrained model (default: random weights)")
+    oparser.add_argument("--batch", type=int, default=1, help="Number of images captioned at once")
+    oparser.add_argument("--repeat", "-n", type=int, default=5)
+    oparser.add_argument("--threads", type=int, help="torch.set_num_threads")
+    return oparser.parse_args()
+
+
+def main() -> None:
+    opts = get_opts()
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model: Any = BLIP("cpu").blip_model if opts.pretrained else build_random_model(Path(tmpdir))
+    decoder = CaptionDecoder(text_decoder=model.text_decoder, tokenizer=model.tokenizer, prompt=model.prompt)
+    images = torch.rand((opts.batch, 3, 384, 384))
+
+    def run_reference() -> List[str]:
+        # Same as BLIP.predict_batch before incremental decoding
+        with torch.no_grad():
+            return BLIP_Decoder.generate(model, images, sample=False, num_beams=3, max_length=20, min_length=5)
+
+    def run_decoder(num_beams: int) -> List[str]:
+        with torch.no_grad():
+            return decoder.generate(
+                image_embeds=model.visual_encoder(images),
+                options=CaptionOptions(num_beams=num_beams),
+            )
+
+    reference: Optional[List[str]] = None
+    for name, func in [
+        ("reference_beam3", run_reference),
+        ("beam3", lambda: run_decoder(3)),
+        ("beam2", lambda: run_decoder(2)),
+        ("greedy", lambda: run_decoder(1)),
+    ]:
+        result = measure(name=name, func=func, repeat=opts.repeat)
+        if reference is None:
+            reference = result["captions"]
+        result["same_as_reference"] = result["captions"] == reference
+        del result["captions"]
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.components import get_module_nbytes
+from purepale.pipes import Pipes
+from purepale.schema import ModelConfig, Parameters, PipesRequest
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument("--model", help="Model to use without dtype (default: build a tiny random model)")
+    oparser.add_argument(
+        "--dtype",
+        action="append",
+        choices=["fp32", "bf16", "int8"],
+        help="Dtypes to compare with the first one (default: fp32, bf16, int8)",
+    )
+    oparser.add_argument("--num-images", "-n", type=int, default=4, help="Number of seeds")
+    oparser.add_argument("--size", type=int, default=256)
+    oparser.add_argument("--steps", type=int, default=10)
+    oparser.add_argument("--threads", type=int, help="torch.set_num_threads")
+    return oparser.parse_args()
+
+
+def main() -> None:
+    opts = get_opts()
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model: str = opts.model
+        if model is None:
+            model = str(build_tiny_model(Path(tmpdir)))
+        parameters = Parameters(
+            prompt="a photo of a cat",
+            height=opts.size,
+            width=opts.size,
+            num_inference_steps=opts.steps,
+        )
+
+        references: Optional[List[np.ndarray]] = None
+        for dtype in opts.dtype if opts.dtype else ["fp32", "bf16", "int8"]:
+            start: float = time.perf_counter()
+            pipes = Pipes(
+                model_config=ModelConfig.parse(f"{model}@{dtype}"),
+                device="cpu",
+                nosafety=True,
+                slice_size=-1,
+                local_files_only=True,
+                quantization_cache_dir=Path(tmpdir).joinpath("quantized"),
+            )
+            elapsed_load: float = time.perf_counter() - start
+            pipes.pipe.set_progress_bar_config(disable=True)
+            # warmup
+            pipes.generate(request=PipesRequest(parameters=parameters.copy(update={"seed": 0})))
+
+            images: List[np.ndarray] = []
+            start = time.perf_counter()
+            for seed in range(opts.num_images):
+                image, _ = pipes.generate(request=PipesRequest(parameters=parameters.copy(update={"seed": seed})))[0]
+                images.append(np.asarray(image).astype(np.float64))
+            elapsed: float = time.perf_counter() - start
+            if references is None:
+                references = images
+
+            mse: float = float(np.mean([np.mean((a - b) ** 2) for a, b in zip(images, references)]))
+            result = {
+                "dtype": dtype,
+                "load_sec": elapsed_load,
+                "sec_per_image": elapsed / opts.num_images,
+                "model_mib": sum(
+                    get_module_nbytes(m) for m in [pipes.pipe.unet, pipes.pipe.text_encoder, pipes.pipe.vae]
+                )
+                / 1024
+                / 1024,
+                "mean_abs_diff": float(np.mean([np.mean(np.abs(a - b)) for a, b in zip(images, references)])),
+                "psnr": None if mse == 0 else 10 * math.log10(255**2 / mse),
+            }
+            print(json.dumps(result), flush=True)
+            del pipes
+
+
+if __name__ == "__main__":
+    main()
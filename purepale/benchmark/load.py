@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+
+from purepale.benchmark import blip as blip_benchmark
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.blip import BLIP
+from purepale.metrics import get_peak_rss
+from purepale.serve import get_app
+from purepale.serve import get_opts as get_server_opts
+
+KINDS: List[str] = ["txt2img", "img2img", "inpaint", "tile", "random", "img2prompt"]
+DEFAULT_MIX: str = "txt2img=4,img2img=2,inpaint=1,tile=1,random=1,img2prompt=1"
+
+# Metrics compared with a baseline, where larger values of throughput are better
+COMPARED_METRICS: List[str] = ["p50", "p95", "p99", "requests_per_sec"]
+
+PROMPT: str = "a photo of a cat"
+RANDOM_PROMPT: str = "a photo of a {cat|dog|bird} on a {red|blue|green} {hat|box} --random"
+
+
+class ASGIClient:
+    """Send HTTP requests to an ASGI application in this process without sockets."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        body: bytes = b"",
+        content_type: Optional[str] = None,
+    ) -> Tuple[int, bytes]:
+        headers: List[Tuple[bytes, bytes]] = [
+            (b"host", b"testserver"),
+            (b"content-length", str(len(body)).encode("ascii")),
+        ]
+        if content_type is not None:
+            headers.append((b"content-type", content_type.encode("ascii")))
+        scope: Dict[str, Any] = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode("ascii"),
+            "query_string": b"",
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+        }
+        requested: bool = False
+        finished = asyncio.Event()
+        status: int = 0
+        chunks: List[bytes] = []
+
+        async def receive() -> Dict[str, Any]:
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The client disconnects only after the whole response
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    finished.set()
+
+        await self.app(scope, receive, send)
+        return status, b"".join(chunks)
+
+    async def get_text(self, path: str) -> str:
+        status, content = await self.request("GET", path)
+        if status != 200:
+            raise RuntimeError(f"GET {path} failed with {status}: {content[:1000]!r}")
+        return content.decode("utf8")
+
+    async def post_json(self, path: str, data: Dict[str, Any]) -> Any:
+        status, content = await self.request(
+            "POST",
+            path,
+            body=json.dumps(data).encode("utf8"),
+            content_type="application/json",
+        )
+        if status != 200:
+            raise RuntimeError(f"POST {path} failed with {status}: {content[:1000]!r}")
+        return json.loads(content)
+
+    async def upload(self, name: str, data: bytes) -> str:
+        """Upload a file and return its path on the server."""
+        boundary: str = "purepale-benchmark-boundary"
+        body: bytes = (
+            (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode("utf8")
+            + data
+            + f"\r\n--{boundary}--\r\n".encode("utf8")
+        )
+        status, content = await self.request(
+            "POST",
+            "/api/upload",
+            body=body,
+            content_type=f"multipart/form-data; boundary={boundary}",
+        )
+        if status != 200:
+            raise RuntimeError(f"Upload failed with {status}: {content[:1000]!r}")
+        return json.loads(content)["path"]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parse weights of kinds of requests like ``txt2img=4,img2prompt=1``."""
+    kind2weight: Dict[str, float] = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind of requests: {kind} (supported: {', '.join(KINDS)})")
+        kind2weight[kind] = float(weight) if weight else 1.0
+    return {k: w for k, w in kind2weight.items() if w > 0}
+
+
+def get_images(size: int) -> Tuple[bytes, bytes]:
+    """Return PNG files of a random initial image and a mask of its center."""
+    rng = np.random.default_rng(0)
+    image = PIL.Image.fromarray(rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8))
+    mask = PIL.Image.new("L", (size, size), 0)
+    PIL.ImageDraw.Draw(mask).rectangle((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill=255)
+
+    outs: List[bytes] = []
+    for im in (image, mask):
+        buf = io.BytesIO()
+        im.save(buf, format="PNG")
+        outs.append(buf.getvalue())
+    return outs[0], outs[1]
+
+
+def get_request(
+    *,
+    kind: str,
+    model: str,
+    seed: int,
+    size: int,
+    steps: int,
+    path_image: str,
+    path_mask: str,
+) -> Tuple[str, Dict[str, Any]]:
+    """Return the path and the body of a request of the kind.
+
+    Every request has its own seed, so that no response is served from the cache.
+    """
+    if kind == "img2prompt":
+        return "/api/img2prompt", {"path": path_image, "num_beams": 1}
+    data: Dict[str, Any] = {
+        "model": model,
+        "parameters": {
+            "prompt": {"tile": f"{PROMPT} --tile", "random": RANDOM_PROMPT}.get(kind, PROMPT),
+            "height": size,
+            "width": size,
+            "num_inference_steps": steps,
+            "seed": seed,
+        },
+    }
+    if kind in {"img2img", "inpaint"}:
+        data["path_initial_image"] = path_image
+    if kind == "inpaint":
+        data["path_initial_image_mask"] = path_mask
+    return "/api/generate", data
+
+
+def summarize(latencies: List[float]) -> Dict[str, Any]:
+    if len(latencies) == 0:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+    return {
+        "count": len(latencies),
+        "mean": float(np.mean(latencies)),
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "max": max(latencies),
+    }
+
+
+async def measure(
+    *,
+    client: ASGIClient,
+    requests: List[Tuple[str, str, Dict[str, Any]]],
+    concurrency: int,
+) -> Dict[str, Any]:
+    """Send requests from ``concurrency`` concurrent clients and return latencies and throughput."""
+    kind2latencies: Dict[str, List[float]] = {}
+    errors: List[str] = []
+    pending = list(reversed(requests))
+
+    async def run_client() -> None:
+        while len(pending) > 0:
+            kind, path, data = pending.pop()
+            start: float = time.perf_counter()
+            try:
+                await client.post_json(path, data)
+            except RuntimeError as e:
+                errors.append(f"{kind}: {e}")
+                continue
+            kind2latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    start: float = time.perf_counter()
+    await asyncio.gather(*[run_client() for _ in range(concurrency)])
+    elapsed: float = time.perf_counter() - start
+
+    num_succeeded: int = sum(len(v) for v in kind2latencies.values())
+    return {
+        "concurrency": concurrency,
+        "num_requests": len(requests),
+        "num_errors": len(errors),
+        "errors": errors[:10],
+        "elapsed": elapsed,
+        "requests_per_sec": num_succeeded / elapsed,
+        **summarize([v for vs in kind2latencies.values() for v in vs]),
+        "kinds": {kind: summarize(kind2latencies.get(kind, [])) for kind in KINDS if kind in kind2latencies},
+    }
+
+
+def get_peak_rss_of_processes(metrics: str) -> Dict[str, float]:
+    """Return peak resident set sizes of processes in MiB from the Prometheus text of the server."""
+    process2rss: Dict[str, float] = {}
+    for line in metrics.splitlines():
+        if line.startswith("purepale_peak_rss_bytes{"):
+            labels, _, value = line.rpartition(" ")
+            process: str = labels.split('process="', 1)[1].split('"', 1)[0]
+            process2rss[process] = float(value) / 1024 / 1024
+    return process2rss
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(*, baseline: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> None:
+    """Print ratios of metrics to those of the baseline with the same concurrency."""
+    concurrency2baseline: Dict[int, Dict[str, Any]] = {r["concurrency"]: r for r in baseline}
+    for result in results:
+        base: Optional[Dict[str, Any]] = concurrency2baseline.get(result["concurrency"])
+        if base is None:
+            continue
+        for name in COMPARED_METRICS:
+            if base.get(name) is None or result.get(name) is None or base[name] == 0:
+                continue
+            print(
+                json.dumps(
+                    {
+                        "concurrency": result["concurrency"],
+                        "metric": name,
+                        "baseline": base[name],
+                        "current": result[name],
+                        "ratio": result[name] / base[name],
+                    }
+                ),
+                flush=True,
+            )
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument("--model", help="Model to use (default: build a tiny random model)")
+    oparser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weights of kinds of requests (default: {DEFAULT_MIX})")
+    oparser.add_argument("--concurrency", "-c", type=int, action="append", help="Concurrent clients (default: 1, 4)")
+    oparser.add_argument("--num-requests", "-n", type=int, default=40)
+    oparser.add_argument("--size", type=int, default=128)
+    oparser.add_argument("--steps", type=int, default=5)
+    oparser.add_argument("--seed", type=int, default=0, help="Seed of the order of requests")
+    oparser.add_argument("--output", type=Path, help="Save results to this JSON file")
+    oparser.add_argument("--baseline", type=Path, help="Compare results with this JSON file saved by --output")
+    oparser.add_argument(
+        "server_args",
+        nargs=argparse.REMAINDER,
+        help="Options of the server after --, e.g. -- --max-batch 4 --batch-window-ms 50",
+    )
+    return oparser.parse_args()
+
+
+async def run(opts: argparse.Namespace, path_tmp: Path) -> Dict[str, Any]:
+    kind2weight: Dict[str, float] = parse_mix(opts.mix)
+    model: str = opts.model
+    if model is None:
+        model = f"{build_tiny_model(path_tmp.joinpath('model'))}@fp32"
+    server_args: List[str] = ["--model", model, "-o", str(path_tmp.joinpath("out")), "--local", "--no-safety"]
+    model_blip: Optional[BLIP] = None
+    if "img2prompt" in kind2weight:
+        server_args += ["--feature", "blip"]
+        model_blip = BLIP("cpu", blip_benchmark.build_tiny_model(path_tmp.joinpath("blip")))
+    server_args += [a for a in opts.server_args if a != "--"]
+
+    app = get_app(get_server_opts(server_args), model_blip=model_blip)
+    client = ASGIClient(app)
+    await app.router.startup()
+    try:
+        image, mask = get_images(opts.size)
+        path_image: str = await client.upload("init.png", image)
+        path_mask: str = await client.upload("mask.png", mask)
+
+        rng = random.Random(opts.seed)
+        kinds: List[str] = list(kind2weight.keys())
+        seed: int = 0
+
+        def get_requests(kinds: List[str]) -> List[Tuple[str, str, Dict[str, Any]]]:
+            nonlocal seed
+            requests = []
+            for kind in kinds:
+                seed += 1
+                path, data = get_request(
+                    kind=kind,
+                    model=model,
+                    seed=seed,
+                    size=opts.size,
+                    steps=opts.steps,
+                    path_image=path_image,
+                    path_mask=path_mask,
+                )
+                requests.append((kind, path, data))
+            return requests
+
+        # Warm up every kind of requests
+        await measure(client=client, requests=get_requests(kinds), concurrency=1)
+
+        results: List[Dict[str, Any]] = []
+        for concurrency in opts.concurrency if opts.concurrency else [1, 4]:
+            requests = get_requests(rng.choices(kinds, weights=[kind2weight[k] for k in kinds], k=opts.num_requests))
+            result = await measure(client=client, requests=requests, concurrency=concurrency)
+            print(json.dumps({k: v for k, v in result.items() if k != "kinds"}), flush=True)
+            results.append(result)
+        peak_rss_mib: Dict[str, float] = get_peak_rss_of_processes(await client.get_text("/metrics"))
+    finally:
+        await app.router.shutdown()
+
+    peak_rss_mib["server"] = get_peak_rss() / 1024 / 1024
+    return {
+        "commit": get_commit(),
+        "model": opts.model,
+        "mix": kind2weight,
+        "size": opts.size,
+        "steps": opts.steps,
+        "server_args": server_args,
+        "peak_rss_mib": peak_rss_mib,
+        "results": results,
+    }
+
+
+def main() -> None:
+    opts = get_opts()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        report: Dict[str, Any] = asyncio.run(run(opts, Path(tmpdir)))
+    print(json.dumps({"peak_rss_mib": report["peak_rss_mib"]}), flush=True)
+
+    if opts.output is not None:
+        opts.output.parent.mkdir(exist_ok=True, parents=True)
+        with opts.output.open("w") as outf:
+            json.dump(report, outf, indent=2)
+            outf.write("\n")
+    if opts.baseline is not None:
+        with opts.baseline.open() as inf:
+            compare(baseline=json.load(inf)["results"], results=report["results"])
+
+
+if __name__ == "__main__":
+    main()
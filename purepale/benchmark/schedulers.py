@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import torch
+
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.pipes import Pipes
+from purepale.schema import ModelConfig, Parameters, PipesRequest, SchedulerName
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument("--model", help="Model to use (default: build a tiny random model)")
+    oparser.add_argument(
+        "--scheduler",
+        type=SchedulerName,
+        action="append",
+        choices=list(SchedulerName),
+        help="Schedulers (default: all)",
+    )
+    oparser.add_argument("--steps", type=int, action="append", help="Numbers of steps (default: 10, 15, 20, 30, 50)")
+    oparser.add_argument("--size", type=int, default=256)
+    oparser.add_argument("--seed", type=int, default=0)
+    oparser.add_argument("--threads", type=int, help="torch.set_num_threads")
+    return oparser.parse_args()
+
+
+def main() -> None:
+    opts = get_opts()
+    if opts.threads is not None:
+        torch.set_num_threads(opts.threads)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model: str = opts.model
+        if model is None:
+            model = f"{build_tiny_model(Path(tmpdir))}@fp32"
+        pipes = Pipes(
+            model_config=ModelConfig.parse(model),
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            nosafety=True,
+            slice_size=-1,
+            local_files_only=True,
+        )
+        pipes.pipe.set_progress_bar_config(disable=True)
+
+    steps_list: List[int] = sorted(opts.steps if opts.steps else [10, 15, 20, 30, 50])
+    schedulers: List[Optional[SchedulerName]] = opts.scheduler if opts.scheduler else [None] + list(SchedulerName)
+    for scheduler in schedulers:
+        images = []
+        for steps in steps_list:
+            request = PipesRequest(
+                parameters=Parameters(
+                    prompt="a photo of a cat",
+                    height=opts.size,
+                    width=opts.size,
+                    num_inference_steps=steps,
+                    seed=opts.seed,
+                    scheduler=scheduler,
+                )
+            )
+            start: float = time.perf_counter()
+            image, _ = pipes.generate(request=request)[0]
+            elapsed: float = time.perf_counter() - start
+            images.append((steps, elapsed, np.asarray(image).astype(np.float32)))
+
+        # Images of deterministic schedulers converge as steps increase
+        final = images[-1][2]
+        for steps, elapsed, image in images:
+            result = {
+                "scheduler": None if scheduler is None else scheduler.value,
+                "steps": steps,
+                "elapsed": elapsed,
+                "diff_to_max_steps": float(np.abs(image - final).mean()),
+            }
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
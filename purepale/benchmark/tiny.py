@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+TINY_MODEL_MAX_LENGTH: int = 77
+
+
+def _bytes_to_unicode() -> List[str]:
+    # Same table as CLIP's byte-level BPE
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return [chr(c) for c in cs]
+
+
+def build_tokenizer(path_out: Path) -> CLIPTokenizer:
+    path_out.mkdir(exist_ok=True, parents=True)
+    chars: List[str] = _bytes_to_unicode()
+    vocab: Dict[str, int] = {}
+    for token in chars + [f"{c}</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"]:
+        vocab[token] = len(vocab)
+
+    path_vocab: Path = path_out.joinpath("vocab.json")
+    with path_vocab.open("w") as outf:
+        json.dump(vocab, outf, ensure_ascii=False)
+    path_merges: Path = path_out.joinpath("merges.txt")
+    with path_merges.open("w") as outf:
+        outf.write("#version: 0.2\n")
+
+    return CLIPTokenizer(
+        vocab_file=str(path_vocab),
+        merges_file=str(path_merges),
+        model_max_length=TINY_MODEL_MAX_LENGTH,
+    )
+
+
+def build_tiny_model(path_out: Path, *, seed: int = 0) -> Path:
+    """Save a randomly initialized Stable Diffusion pipeline that runs on CPU without network access."""
+    torch.manual_seed(seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tokenizer = build_tokenizer(Path(tmpdir))
+
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=4,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 32, 32),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=1,
+    )
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            hidden_size=32,
+            intermediate_size=37,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            max_position_embeddings=TINY_MODEL_MAX_LENGTH,
+            vocab_size=len(tokenizer),
+        )
+    )
+    scheduler = PNDMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        skip_prk_steps=True,
+        set_alpha_to_one=False,
+        steps_offset=1,
+    )
+
+    pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,  # type: ignore
+        feature_extractor=None,  # type: ignore
+        requires_safety_checker=False,
+    )
+    pipe.save_pretrained(str(path_out))
+    return path_out
+
+
+def get_opts() -> argparse.Namespace:
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument("--output", "-o", type=Path, required=True)
+    oparser.add_argument("--seed", type=int, default=0)
+    return oparser.parse_args()
+
+
+def main() -> None:
+    opts = get_opts()
+    build_tiny_model(opts.output, seed=opts.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,375 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import logging
+import multiprocessing
+import pickle
+import shutil
+import zipfile
+from collections import OrderedDict
+from contextlib import ExitStack
+from logging import getLogger
 from pathlib import Path
-from typing import List
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 import torch
-from diffusers import DiffusionPipeline
 
 from purepale.schema import ModelConfig
 
-# from diffusers import StableDiffusionPipeline
+logger = getLogger(__name__)
 
+WEIGHT_FILE_NAMES: List[str] = [
+    "diffusion_pytorch_model.safetensors",
+    "diffusion_pytorch_model.bin",
+    "model.safetensors",
+    "pytorch_model.bin",
+]
 
-def operation(models: List[str], weight: List[float], path_out: Path) -> None:
-    assert len(models) >= 2
-    assert sum(weight) == 1
-    assert len(models) == len(models)
-    out_pipe = None
-    for j, model in enumerate(models):
-        model_config: ModelConfig = ModelConfig.parse(model)
-        pipe = DiffusionPipeline.from_pretrained(
-            pretrained_model_name_or_path=model_config.model_id,
+_STORAGE_DTYPES: Dict[str, torch.dtype] = {
+    "DoubleStorage": torch.float64,
+    "FloatStorage": torch.float32,
+    "HalfStorage": torch.float16,
+    "BFloat16Storage": torch.bfloat16,
+    "LongStorage": torch.int64,
+    "IntStorage": torch.int32,
+    "ShortStorage": torch.int16,
+    "CharStorage": torch.int8,
+    "ByteStorage": torch.uint8,
+    "BoolStorage": torch.bool,
+}
+
+_SAFETENSORS_DTYPES: Dict[str, torch.dtype] = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class LazyTensor:
+    """A tensor in a checkpoint file which is read when ``load`` is called."""
+
+    dtype: torch.dtype
+    shape: Tuple[int, ...]
+
+    def __init__(self, *, dtype: torch.dtype, shape: Tuple[int, ...], reader: Any, args: Tuple):
+        self.dtype = dtype
+        self.shape = shape
+        self._reader = reader
+        self._args = args
+
+    def load(self) -> torch.Tensor:
+        return self._reader(*self._args)
+
+
+def _read_bytes(f: BinaryIO, offset: int, size: int) -> bytearray:
+    buf = bytearray(size)
+    f.seek(offset)
+    f.readinto(buf)  # type: ignore
+    return buf
+
+
+def _open_safetensors(path: Path, *, stack: ExitStack) -> Dict[str, LazyTensor]:
+    f: BinaryIO = stack.enter_context(path.open("rb"))
+    n: int = int.from_bytes(f.read(8), "little")
+    header: Dict[str, Any] = json.loads(f.read(n))
+    header.pop("__metadata__", None)
+
+    def read(dtype: torch.dtype, shape: Tuple[int, ...], begin: int, end: int) -> torch.Tensor:
+        if begin == end:
+            return torch.empty(shape, dtype=dtype)
+        return torch.frombuffer(_read_bytes(f, 8 + n + begin, end - begin), dtype=dtype).reshape(shape)
+
+    name2tensor: Dict[str, LazyTensor] = {}
+    for name, info in header.items():
+        dtype: torch.dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        shape: Tuple[int, ...] = tuple(info["shape"])
+        name2tensor[name] = LazyTensor(
+            dtype=dtype,
+            shape=shape,
+            reader=read,
+            args=(dtype, shape, *info["data_offsets"]),
+        )
+    return name2tensor
+
+
+class _LazyUnpickler(pickle.Unpickler):
+    """Unpickle a state_dict in the zip format of torch.save without reading storages."""
+
+    def __init__(self, f: BinaryIO, *, zf: zipfile.ZipFile, prefix: str):
+        super().__init__(f)
+        self.zf = zf
+        self.prefix = prefix
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return self._rebuild_tensor
+        if module == "torch" and name in _STORAGE_DTYPES:
+            return _STORAGE_DTYPES[name]
+        return super().find_class(module, name)
+
+    def persistent_load(self, pid: Tuple) -> Any:
+        _, dtype, key, _, _ = pid
+        return (dtype, f"{self.prefix}/data/{key}")
+
+    def _rebuild_tensor(self, storage, storage_offset, size, stride, *args) -> LazyTensor:
+        dtype, name = storage
+        return LazyTensor(
+            dtype=dtype,
+            shape=tuple(size),
+            reader=self._read,
+            args=(dtype, name, storage_offset, tuple(size), tuple(stride)),
+        )
+
+    def _read(self, dtype: torch.dtype, name: str, storage_offset: int, size, stride) -> torch.Tensor:
+        buf = bytearray(self.zf.read(name))
+        if len(buf) == 0:
+            return torch.empty(size, dtype=dtype)
+        storage = torch.frombuffer(buf, dtype=dtype)
+        return torch.as_strided(storage, size, stride, storage_offset)
+
+
+def _open_torch(path: Path, *, stack: ExitStack) -> Dict[str, LazyTensor]:
+    if not zipfile.is_zipfile(path):
+        # The legacy format of torch.save can not be read lazily
+        logger.warning(f"{path} is in the legacy format and is loaded at once")
+        state_dict = torch.load(path, map_location="cpu")
+        return {
+            name: LazyTensor(dtype=t.dtype, shape=tuple(t.shape), reader=lambda t: t, args=(t,))
+            for name, t in state_dict.items()
+        }
+
+    zf: zipfile.ZipFile = stack.enter_context(zipfile.ZipFile(path))
+    name_pkl: str = [name for name in zf.namelist() if name.endswith("/data.pkl")][0]
+    with zf.open(name_pkl) as f:
+        return _LazyUnpickler(f, zf=zf, prefix=name_pkl[: -len("/data.pkl")]).load()  # type: ignore
+
+
+def open_checkpoint(path: Path, *, stack: ExitStack) -> Dict[str, LazyTensor]:
+    """Return tensors in a checkpoint (safetensors or torch.save) without reading them.
+
+    The file is open until ``stack`` is closed.
+    """
+    if path.suffix == ".safetensors":
+        return _open_safetensors(path, stack=stack)
+    return _open_torch(path, stack=stack)
+
+
+class _StorageRef:
+    def __init__(self, *, key: int, dtype: torch.dtype, numel: int):
+        self.key = key
+        self.dtype = dtype
+        self.numel = numel
+
+
+class _TensorRef:
+    def __init__(self, *, storage: _StorageRef, shape: Tuple[int, ...]):
+        self.storage = storage
+        self.shape = shape
+
+    def __reduce__(self):
+        stride: List[int] = []
+        n: int = 1
+        for v in reversed(self.shape):
+            stride.insert(0, n)
+            n *= v
+        return (
+            torch._utils._rebuild_tensor_v2,
+            (self.storage, 0, self.shape, tuple(stride), False, OrderedDict()),
+        )
+
+
+class _StateDictPickler(pickle.Pickler):
+    def persistent_id(self, obj: Any) -> Optional[Tuple]:
+        if isinstance(obj, _StorageRef):
+            storage_name: str = {v: k for k, v in _STORAGE_DTYPES.items()}[obj.dtype]
+            return ("storage", getattr(torch, storage_name), str(obj.key), "cpu", obj.numel)
+        return None
+
+
+class CheckpointWriter:
+    """Write a state_dict in the zip format of torch.save tensor by tensor.
+
+    Dtypes and shapes of all tensors should be given first.
+    """
+
+    def __init__(self, *, path: Path, shapes: Dict[str, Tuple[torch.dtype, Tuple[int, ...]]]):
+        self.prefix: str = path.stem
+        self.shapes: Dict[str, Tuple[torch.dtype, Tuple[int, ...]]] = shapes
+        self.name2key: Dict[str, int] = {name: i for i, name in enumerate(shapes.keys())}
+        self.zf = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED)
+
+    def write(self, name: str, tensor: torch.Tensor) -> None:
+        dtype, shape = self.shapes[name]
+        assert tensor.dtype == dtype and tuple(tensor.shape) == shape, name
+        data = tensor.contiguous().reshape(-1).view(torch.uint8).numpy() if tensor.numel() > 0 else b""
+        self.zf.writestr(f"{self.prefix}/data/{self.name2key[name]}", data)  # type: ignore
+
+    def close(self) -> None:
+        state_dict: "OrderedDict[str, _TensorRef]" = OrderedDict()
+        for name, key in self.name2key.items():
+            dtype, shape = self.shapes[name]
+            numel: int = 1
+            for v in shape:
+                numel *= v
+            state_dict[name] = _TensorRef(storage=_StorageRef(key=key, dtype=dtype, numel=numel), shape=shape)
+        with self.zf.open(f"{self.prefix}/data.pkl", "w") as f:
+            _StateDictPickler(f, protocol=2).dump(state_dict)
+        self.zf.writestr(f"{self.prefix}/version", "3\n")
+        self.zf.close()
+
+
+def find_weight_file(path_dir: Path) -> Optional[Path]:
+    for name in WEIGHT_FILE_NAMES:
+        path: Path = path_dir.joinpath(name)
+        if path.exists():
+            return path
+    return None
+
+
+def get_model_dir(model_config: ModelConfig, *, local_files_only: bool) -> Path:
+    path = Path(model_config.model_id)
+    if path.exists():
+        return path
+    from huggingface_hub import snapshot_download
+
+    return Path(
+        snapshot_download(
+            model_config.model_id,
             revision=model_config.revision,
-            torch_dtype=torch.float16 if model_config.dtype == "fp16" else torch.float32,
+            local_files_only=local_files_only,
+            # Skip large checkpoints in the root (e.g. *.ckpt)
+            allow_patterns=["model_index.json", "*/*"],
         )
-        if j == 0:
-            out_pipe = pipe
+    )
+
+
+# Checkpoints opened in each worker process, and their files
+_inputs: List[Dict[str, LazyTensor]] = []
+_input_files = ExitStack()
+
+
+def _open_inputs(paths: List[Path]) -> None:
+    global _inputs
+    _close_inputs()
+    _inputs = [open_checkpoint(path, stack=_input_files) for path in paths]
+
 
-        assert out_pipe is not None
-        for _m in [pipe.unet, pipe.vae]:
-            _sd = _m.state_dict()
-            for target, v in _m.named_parameters():
-                if j == 0:
-                    _sd[target] = v * weight[j] / 1.0
-                else:
-                    _sd[target] += v * weight[j] / 1.0
-    assert out_pipe is not None
-    out_pipe.save_pretrained(path_out)
+def _close_inputs() -> None:
+    global _inputs
+    _inputs = []
+    _input_files.close()
+
+
+def _init_worker(paths: List[Path]) -> None:
+    torch.set_num_threads(1)
+    _open_inputs(paths)
+
+
+def _blend_tensor(args: Tuple[str, List[float], torch.dtype]) -> Tuple[str, torch.Tensor]:
+    name, weights, dtype = args
+    first: LazyTensor = _inputs[0][name]
+    if not first.dtype.is_floating_point:
+        return name, first.load()
+
+    accumulated: Optional[torch.Tensor] = None
+    for tensors, weight in zip(_inputs, weights):
+        t: Optional[LazyTensor] = tensors.get(name)
+        if t is None or t.shape != first.shape:
+            raise ValueError(f"Shapes of {name} do not match")
+        v: torch.Tensor = t.load().to(torch.float32) * weight
+        accumulated = v if accumulated is None else accumulated.add_(v)
+    assert accumulated is not None
+    return name, accumulated.to(dtype)
+
+
+def blend_checkpoints(
+    *,
+    paths: List[Path],
+    weights: List[float],
+    path_out: Path,
+    dtype: torch.dtype,
+    num_workers: int,
+) -> None:
+    """Write the weighted sum of checkpoints reading a few tensors at a time.
+
+    Floating point tensors are accumulated in fp32 and saved in ``dtype``.
+    Other tensors are copied from the first checkpoint.
+    """
+    _open_inputs(paths)
+    try:
+        shapes: Dict[str, Tuple[torch.dtype, Tuple[int, ...]]] = {
+            name: (dtype if t.dtype.is_floating_point else t.dtype, t.shape) for name, t in _inputs[0].items()
+        }
+        tasks: Iterator[Tuple[str, List[float], torch.dtype]] = ((name, weights, dtype) for name in shapes.keys())
+
+        writer = CheckpointWriter(path=path_out, shapes=shapes)
+        try:
+            if num_workers <= 1:
+                for name, tensor in map(_blend_tensor, tasks):
+                    writer.write(name, tensor)
+            else:
+                ctx = multiprocessing.get_context("spawn")
+                with ctx.Pool(num_workers, initializer=_init_worker, initargs=(paths,)) as pool:
+                    for name, tensor in pool.imap_unordered(_blend_tensor, tasks):
+                        writer.write(name, tensor)
+        finally:
+            writer.close()
+    finally:
+        # Inputs are closed after the writer finishes
+        _close_inputs()
+
+
+def operation(
+    models: List[str],
+    weight: List[float],
+    path_out: Path,
+    *,
+    text_encoder: bool = False,
+    num_workers: int = 1,
+    local_files_only: bool = False,
+) -> None:
+    """Blend UNets and VAEs (and text encoders) of models and save the pipeline of the first model with them."""
+    assert len(models) >= 2
+    assert len(models) == len(weight)
+    assert abs(sum(weight) - 1) < 1e-6, "Sum of weights should be 1"
+    model_configs: List[ModelConfig] = [ModelConfig.parse(model) for model in models]
+    model_dirs: List[Path] = [get_model_dir(mc, local_files_only=local_files_only) for mc in model_configs]
+    dtype: torch.dtype = torch.float16 if model_configs[0].dtype == "fp16" else torch.float32
+
+    components: List[str] = ["unet", "vae"] + (["text_encoder"] if text_encoder else [])
+
+    # Copy other files of the first model
+    def ignore(path_dir: str, names: List[str]) -> List[str]:
+        if Path(path_dir).name in components:
+            return [name for name in names if name in WEIGHT_FILE_NAMES]
+        return []
+
+    shutil.copytree(model_dirs[0], path_out, ignore=ignore, dirs_exist_ok=True)
+
+    for component in components:
+        paths: List[Path] = []
+        for model_dir in model_dirs:
+            path: Optional[Path] = find_weight_file(model_dir.joinpath(component))
+            if path is None:
+                raise FileNotFoundError(f"Weights of {component} are not found in {model_dir}")
+            paths.append(path)
+        name_out: str = "diffusion_pytorch_model.bin" if paths[0].name.startswith("diffusion_") else "pytorch_model.bin"
+        logger.info(f"Blending {component}")
+        blend_checkpoints(
+            paths=paths,
+            weights=weight,
+            path_out=path_out.joinpath(component, name_out),
+            dtype=dtype,
+            num_workers=num_workers,
+        )
 
 
 def get_opts() -> argparse.Namespace:
@@ -44,12 +377,37 @@ def get_opts() -> argparse.Namespace:
     oparser.add_argument("--model", action="append", required=True)
     oparser.add_argument("--weight", "-w", type=float, action="append", required=True)
     oparser.add_argument("--output", "-o", type=Path, required=True)
+    oparser.add_argument(
+        "--text-encoder",
+        action="store_true",
+        help="Blend text encoders too",
+    )
+    oparser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of processes to blend tensors",
+    )
+    oparser.add_argument(
+        "--local",
+        action="store_true",
+        help="Do not access to HuggingFace",
+    )
     return oparser.parse_args()
 
 
 def main() -> None:
+    logging.basicConfig(level=logging.INFO)
     opts = get_opts()
-    operation(opts.model, opts.weight, opts.output)
+    operation(
+        opts.model,
+        opts.weight,
+        opts.output,
+        text_encoder=opts.text_encoder,
+        num_workers=opts.jobs,
+        local_files_only=opts.local,
+    )
 
 
 if __name__ == "__main__":
@@ -1,54 +1,538 @@
 #!/usr/bin/env python3
 
-
+import hashlib
+import math
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+from logging import getLogger
 from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
+import PIL
+import PIL.Image
 import torch
 import torch.backends.cudnn
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
+from purepale.cache import LRUCache
 from purepale.third_party.blip.blip import blip_decoder
+from purepale.third_party.blip.med import BertLMHeadModel, BertSelfAttention
+
+logger = getLogger(__name__)
+
+BLIP_MED_CONFIG: Path = Path(__file__).parent.joinpath("third_party/blip/med_config.json")
+
+KeyValue = Tuple[torch.Tensor, torch.Tensor]
+
+
+class CaptionOptions(NamedTuple):
+    num_beams: int = 3
+    max_length: int = 20
+    min_length: int = 5
+
+
+class _BeamHypotheses:
+    """Best finished hypotheses of an image scored by the mean log probability of tokens."""
+
+    num_beams: int
+    beams: List[Tuple[float, List[int]]]
+    worst_score: float
+
+    def __init__(self, *, num_beams: int):
+        self.num_beams = num_beams
+        self.beams = []
+        self.worst_score = 1e9
+
+    def add(self, tokens: List[int], sum_logprobs: float) -> None:
+        score: float = sum_logprobs / len(tokens)
+        if len(self.beams) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, tokens))
+            if len(self.beams) > self.num_beams:
+                sorted_scores = sorted((s, idx) for idx, (s, _) in enumerate(self.beams))
+                del self.beams[sorted_scores[0][1]]
+                self.worst_score = sorted_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs: float, cur_len: int) -> bool:
+        """Return True when no running beam can be better than the worst finished one."""
+        return len(self.beams) >= self.num_beams and self.worst_score >= best_sum_logprobs / cur_len
+
+    def best(self) -> List[int]:
+        return sorted(self.beams, key=lambda x: x[0])[-1][1]
+
+
+def _split_heads(attn: BertSelfAttention, x: torch.Tensor) -> torch.Tensor:
+    return attn.transpose_for_scores(x)
+
+
+def _merge_heads(x: torch.Tensor) -> torch.Tensor:
+    return x.permute(0, 2, 1, 3).flatten(2)
+
+
+def _attend(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: Optional[torch.Tensor]) -> torch.Tensor:
+    scores = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(q.size(-1))
+    if mask is not None:
+        scores = scores.masked_fill(mask, float("-inf"))
+    return torch.matmul(scores.softmax(dim=-1), v)
+
+
+class CaptionDecoder:
+    """Decode captions incrementally with keys and values of attention cached across steps.
+
+    Keys and values of the cross-attention over image embeddings are computed once per image
+    and shared by all beams of the image.
+    The prompt runs once per image, and each step runs only the last token of each beam.
+    ``num_beams=1`` decodes greedily.
+    """
+
+    def __init__(self, *, text_decoder: BertLMHeadModel, tokenizer: Any, prompt: str):
+        self.text_decoder: BertLMHeadModel = text_decoder
+        self.tokenizer = tokenizer
+        self.prompt: str = prompt
+        self.prompt_ids: List[int] = tokenizer(prompt).input_ids[:-1]
+        self.prompt_ids[0] = tokenizer.bos_token_id
+        self.eos_token_id: int = tokenizer.sep_token_id
+
+    def _get_cross_key_values(self, image_embeds: torch.Tensor) -> List[KeyValue]:
+        key_values: List[KeyValue] = []
+        for layer in self.text_decoder.bert.encoder.layer:
+            attn: BertSelfAttention = layer.crossattention.self
+            key_values.append(
+                (_split_heads(attn, attn.key(image_embeds)), _split_heads(attn, attn.value(image_embeds)))
+            )
+        return key_values
+
+    def _forward(
+        self,
+        *,
+        input_ids: torch.Tensor,
+        past: Optional[List[KeyValue]],
+        cross_key_values: List[KeyValue],
+        num_beams: int,
+    ) -> Tuple[torch.Tensor, List[KeyValue]]:
+        """Return logits of the next token and keys and values of self-attention up to the input.
+
+        ``input_ids`` has ``num_beams`` rows per image.
+        """
+        bert = self.text_decoder.bert
+        num_tokens: int = input_ids.size(1)
+        past_length: int = 0 if past is None else past[0][0].size(2)
+        hidden = bert.embeddings(input_ids=input_ids, past_key_values_length=past_length)
+        mask: Optional[torch.Tensor] = None
+        if num_tokens > 1:
+            mask = ~torch.ones(
+                (num_tokens, past_length + num_tokens),
+                dtype=torch.bool,
+                device=hidden.device,
+            ).tril(diagonal=past_length)
+
+        present: List[KeyValue] = []
+        for i, layer in enumerate(bert.encoder.layer):
+            attn: BertSelfAttention = layer.attention.self
+            q = _split_heads(attn, attn.query(hidden))
+            k = _split_heads(attn, attn.key(hidden))
+            v = _split_heads(attn, attn.value(hidden))
+            if past is not None:
+                k = torch.cat([past[i][0], k], dim=2)
+                v = torch.cat([past[i][1], v], dim=2)
+            present.append((k, v))
+            hidden = layer.attention.output(_merge_heads(_attend(q, k, v, mask)), hidden)
+
+            # Queries of all beams of an image attend to the same keys and values
+            cross: BertSelfAttention = layer.crossattention.self
+            cross_k, cross_v = cross_key_values[i]
+            num_images, num_heads, _, head_size = cross_k.shape
+            q = (
+                _split_heads(cross, cross.query(hidden))
+                .reshape(num_images, num_beams, num_heads, num_tokens, head_size)
+                .transpose(1, 2)
+                .reshape(num_images, num_heads, num_beams * num_tokens, head_size)
+            )
+            context = (
+                _attend(q, cross_k, cross_v, None)
+                .reshape(num_images, num_heads, num_beams, num_tokens, head_size)
+                .transpose(1, 2)
+                .reshape(num_images * num_beams, num_heads, num_tokens, head_size)
+            )
+            hidden = layer.crossattention.output(_merge_heads(context), hidden)
+            hidden = layer.feed_forward_chunk(hidden)
+        return self.text_decoder.cls(hidden[:, -1, :]).float(), present
+
+    @staticmethod
+    def _select(key_values: List[KeyValue], index: torch.Tensor) -> List[KeyValue]:
+        return [(k.index_select(0, index), v.index_select(0, index)) for k, v in key_values]
+
+    def _greedy(self, *, image_embeds: torch.Tensor, options: CaptionOptions) -> List[List[int]]:
+        device = image_embeds.device
+        cross_key_values: List[KeyValue] = self._get_cross_key_values(image_embeds)
+        sequences: List[List[int]] = [list(self.prompt_ids) for _ in range(image_embeds.size(0))]
+        active: List[int] = list(range(image_embeds.size(0)))
+        logits, past = self._forward(
+            input_ids=torch.tensor([self.prompt_ids] * len(active), device=device),
+            past=None,
+            cross_key_values=cross_key_values,
+            num_beams=1,
+        )
+        cur_len: int = len(self.prompt_ids)
+        while True:
+            if cur_len < options.min_length:
+                logits[:, self.eos_token_id] = float("-inf")
+            tokens: List[int] = logits.argmax(dim=-1).tolist()
+            for row, idx in enumerate(active):
+                sequences[idx].append(tokens[row])
+            cur_len += 1
+            rows: List[int] = [row for row, token in enumerate(tokens) if token != self.eos_token_id]
+            if len(rows) == 0 or cur_len >= options.max_length:
+                break
+            if len(rows) < len(active):
+                # Drop finished images from the batch
+                index = torch.tensor(rows, device=device)
+                past = self._select(past, index)
+                cross_key_values = self._select(cross_key_values, index)
+                active = [active[row] for row in rows]
+                tokens = [tokens[row] for row in rows]
+            logits, past = self._forward(
+                input_ids=torch.tensor(tokens, device=device).unsqueeze(1),
+                past=past,
+                cross_key_values=cross_key_values,
+                num_beams=1,
+            )
+        return sequences
+
+    def _beam_search(self, *, image_embeds: torch.Tensor, options: CaptionOptions) -> List[List[int]]:
+        device = image_embeds.device
+        num_beams: int = options.num_beams
+        cross_key_values: List[KeyValue] = self._get_cross_key_values(image_embeds)
+        hypotheses: List[_BeamHypotheses] = [_BeamHypotheses(num_beams=num_beams) for _ in range(image_embeds.size(0))]
+        active: List[int] = list(range(image_embeds.size(0)))
+
+        # All beams of an image start from the prompt, which runs once per image
+        logits, past = self._forward(
+            input_ids=torch.tensor([self.prompt_ids] * len(active), device=device),
+            past=None,
+            cross_key_values=cross_key_values,
+            num_beams=1,
+        )
+        logits = logits.repeat_interleave(num_beams, dim=0)
+        past = [(k.repeat_interleave(num_beams, dim=0), v.repeat_interleave(num_beams, dim=0)) for k, v in past]
+        sequences: List[List[int]] = [list(self.prompt_ids) for _ in range(len(active) * num_beams)]
+        beam_scores = torch.zeros((len(active), num_beams), device=device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+
+        while True:
+            cur_len: int = len(sequences[0])
+            scores = torch.log_softmax(logits, dim=-1)
+            if cur_len < options.min_length:
+                scores[:, self.eos_token_id] = float("-inf")
+            vocab_size: int = scores.size(-1)
+            top_scores, top_ids = (
+                (scores + beam_scores[:, None]).view(len(active), num_beams * vocab_size).topk(2 * num_beams, dim=1)
+            )
+
+            next_rows: List[int] = []
+            next_tokens: List[int] = []
+            next_scores: List[float] = []
+            kept: List[int] = []
+            for row, (row_scores, row_ids) in enumerate(zip(top_scores.tolist(), top_ids.tolist())):
+                hyps: _BeamHypotheses = hypotheses[active[row]]
+                num_next: int = 0
+                for rank, (score, token_id) in enumerate(zip(row_scores, row_ids)):
+                    beam, token = divmod(token_id, vocab_size)
+                    src: int = row * num_beams + beam
+                    if token == self.eos_token_id:
+                        if rank < num_beams:
+                            hyps.add(sequences[src], score)
+                        continue
+                    next_rows.append(src)
+                    next_tokens.append(token)
+                    next_scores.append(score)
+                    num_next += 1
+                    if num_next == num_beams:
+                        break
+                if hyps.is_done(max(row_scores), cur_len):
+                    # Drop candidates of the finished image
+                    del next_rows[-num_beams:], next_tokens[-num_beams:], next_scores[-num_beams:]
+                else:
+                    kept.append(row)
+
+            sequences = [sequences[src] + [token] for src, token in zip(next_rows, next_tokens)]
+            active = [active[row] for row in kept]
+            if len(active) == 0:
+                break
+            beam_scores = torch.tensor(next_scores, device=device)
+            if cur_len + 1 >= options.max_length:
+                for row, idx in enumerate(active):
+                    for src in range(row * num_beams, (row + 1) * num_beams):
+                        hypotheses[idx].add(sequences[src], next_scores[src])
+                break
+
+            past = self._select(past, torch.tensor(next_rows, device=device))
+            if len(kept) < cross_key_values[0][0].size(0):
+                cross_key_values = self._select(cross_key_values, torch.tensor(kept, device=device))
+            logits, past = self._forward(
+                input_ids=torch.tensor(next_tokens, device=device).unsqueeze(1),
+                past=past,
+                cross_key_values=cross_key_values,
+                num_beams=num_beams,
+            )
+        return [hyps.best() for hyps in hypotheses]
+
+    def generate(self, *, image_embeds: torch.Tensor, options: CaptionOptions) -> List[str]:
+        assert options.num_beams >= 1
+        if options.num_beams == 1:
+            sequences = self._greedy(image_embeds=image_embeds, options=options)
+        else:
+            sequences = self._beam_search(image_embeds=image_embeds, options=options)
+        return [self.tokenizer.decode(sequence, skip_special_tokens=True)[len(self.prompt) :] for sequence in sequences]
 
 
 class BLIP:
-    def __init__(self, device: str):
+    def __init__(self, device: str, blip_model: Optional[Any] = None):
+        """Load the pretrained captioning model unless ``blip_model`` is given.
+
+        ``blip_model`` has ``visual_encoder``, ``text_decoder``, ``tokenizer`` and ``prompt``,
+        and is already on the device.
+        """
         self.device: str = device
         self.blip_image_eval_size: int = 384
-        blip_model_url = (
-            "https://storage.googleapis.com/sfr-vision-language-research/BLIP/models/model*_base_caption.pth"
-        )
-        blip_model = blip_decoder(
-            med_config=str(Path(__file__).parent.joinpath("third_party/blip/med_config.json")),
-            pretrained=blip_model_url,
-            image_size=self.blip_image_eval_size,
-            vit="base",
+        if blip_model is None:
+            blip_model_url = (
+                "https://storage.googleapis.com/sfr-vision-language-research/BLIP/models/model*_base_caption.pth"
+            )
+            blip_model = blip_decoder(
+                med_config=str(BLIP_MED_CONFIG),
+                pretrained=blip_model_url,
+                image_size=self.blip_image_eval_size,
+                vit="base",
+            )
+            blip_model.eval()
+            blip_model = blip_model.to(device)
+        self.blip_model = blip_model
+        self.decoder = CaptionDecoder(
+            text_decoder=self.blip_model.text_decoder,
+            tokenizer=self.blip_model.tokenizer,
+            prompt=self.blip_model.prompt,
         )
-        blip_model.eval()
-        self.blip_model = blip_model.to(device)
-
-    def predict(self, image):
-        gpu_image = (
-            transforms.Compose(
-                [
-                    transforms.Resize(
-                        (self.blip_image_eval_size, self.blip_image_eval_size),
-                        interpolation=InterpolationMode.BICUBIC,
-                    ),
-                    transforms.ToTensor(),
-                    transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
-                ]
-            )(image)
-            .unsqueeze(0)
-            .to(self.device)
+        self.transform = transforms.Compose(
+            [
+                transforms.Resize(
+                    (self.blip_image_eval_size, self.blip_image_eval_size),
+                    interpolation=InterpolationMode.BICUBIC,
+                ),
+                transforms.ToTensor(),
+                transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
+            ]
         )
 
+    def preprocess(self, image: PIL.Image.Image) -> torch.Tensor:
+        return self.transform(image)
+
+    def encode(self, images: List[torch.Tensor]) -> torch.Tensor:
+        """Return image embeddings of preprocessed images."""
+        gpu_images = torch.stack(images).to(self.device)
         with torch.no_grad():
-            caption = self.blip_model.generate(
-                gpu_image,
-                sample=False,
-                num_beams=3,
-                max_length=20,
-                min_length=5,
-            )
-        return caption[0]
+            return self.blip_model.visual_encoder(gpu_images)
+
+    def decode(self, image_embeds: torch.Tensor, options: CaptionOptions = CaptionOptions()) -> List[str]:
+        with torch.no_grad():
+            return self.decoder.generate(image_embeds=image_embeds, options=options)
+
+    def predict_batch(self, images: List[torch.Tensor], options: CaptionOptions = CaptionOptions()) -> List[str]:
+        """Caption preprocessed images in one batch."""
+        return self.decode(self.encode(images), options)
+
+    def predict(self, image: PIL.Image.Image, options: CaptionOptions = CaptionOptions()) -> str:
+        return self.predict_batch([self.preprocess(image)], options)[0]
+
+
+class _Item:
+    key: Optional[str]
+    tensor: Optional[torch.Tensor]
+    image_embeds: Optional[torch.Tensor]
+    options: Optional[CaptionOptions]
+    arrived: float
+    future: "Future[str]"
+
+    def __init__(
+        self,
+        *,
+        key: Optional[str],
+        tensor: Optional[torch.Tensor],
+        image_embeds: Optional[torch.Tensor],
+        options: Optional[CaptionOptions],
+    ):
+        self.key = key  # Content hash of the image file
+        self.tensor = tensor
+        self.image_embeds = image_embeds
+        self.options = options  # None only caches the image embeddings
+        self.arrived = time.monotonic()
+        self.future = Future()
+
+
+class BLIPBatcher:
+    """Caption images of concurrent requests together.
+
+    Images arriving within ``window_ms`` (and while a batch is running) are captioned in one batch
+    of up to ``max_batch`` images.
+    Only images with the same options are captioned together.
+    Image embeddings of files are cached in ``embedding_cache`` by their content hash,
+    so captioning the same file again skips the image encoder.
+    """
+
+    def __init__(
+        self,
+        *,
+        model: BLIP,
+        window_ms: int,
+        max_batch: int,
+        embedding_cache: Optional[LRUCache[torch.Tensor]] = None,
+    ):
+        assert window_ms >= 0
+        assert max_batch >= 1
+        self.model: BLIP = model
+        self.window: float = window_ms / 1000.0
+        self.max_batch: int = max_batch
+        self.embedding_cache: Optional[LRUCache[torch.Tensor]] = embedding_cache
+
+        self._cond = threading.Condition()
+        self._pending: List[_Item] = []
+        self._closed: bool = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def get_key(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _get_item(self, data: bytes, options: Optional[CaptionOptions]) -> Optional[_Item]:
+        """Return an item of an image file, or None when only caching is requested and it is already cached."""
+        key: str = self.get_key(data)
+        if self.embedding_cache is not None:
+            if options is None and key in self.embedding_cache:
+                return None
+            image_embeds: Optional[torch.Tensor] = self.embedding_cache.get(key)
+            if image_embeds is not None:
+                return _Item(key=key, tensor=None, image_embeds=image_embeds, options=options)
+        image = PIL.Image.open(BytesIO(data)).convert("RGB")
+        return _Item(key=key, tensor=self.model.preprocess(image), image_embeds=None, options=options)
+
+    def _submit(self, items: List[_Item]) -> List["Future[str]"]:
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BLIPBatcher is closed")
+            self._pending.extend(items)
+            self._cond.notify()
+        return [item.future for item in items]
+
+    def submit_many(
+        self,
+        images: List[PIL.Image.Image],
+        options: CaptionOptions = CaptionOptions(),
+    ) -> List["Future[str]"]:
+        # Preprocessing runs in the thread of the caller
+        return self._submit(
+            [
+                _Item(key=None, tensor=self.model.preprocess(image), image_embeds=None, options=options)
+                for image in images
+            ]
+        )
+
+    def submit_files(self, datas: List[bytes], options: CaptionOptions = CaptionOptions()) -> List["Future[str]"]:
+        """Caption contents of image files."""
+        items: List[_Item] = []
+        for data in datas:
+            item = self._get_item(data, options)
+            assert item is not None
+            items.append(item)
+        return self._submit(items)
+
+    def prewarm(self, data: bytes) -> None:
+        """Cache image embeddings of an image file in the background."""
+        if self.embedding_cache is None:
+            return
+        item = self._get_item(data, None)
+        if item is not None:
+            self._submit([item])
+
+    def predict(self, image: PIL.Image.Image, options: CaptionOptions = CaptionOptions()) -> str:
+        return self.submit_many([image], options)[0].result()
+
+    def predict_many(self, images: List[PIL.Image.Image], options: CaptionOptions = CaptionOptions()) -> List[str]:
+        return [future.result() for future in self.submit_many(images, options)]
+
+    def predict_files(self, datas: List[bytes], options: CaptionOptions = CaptionOptions()) -> List[str]:
+        return [future.result() for future in self.submit_files(datas, options)]
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _pop_ready(self) -> Optional[List[_Item]]:
+        """Return images with the same options which fill a batch or whose oldest one has waited for the window."""
+        now: float = time.monotonic()
+        groups: Dict[Optional[CaptionOptions], List[_Item]] = {}
+        for item in self._pending:
+            groups.setdefault(item.options, []).append(item)
+        for items in groups.values():
+            if len(items) >= self.max_batch or now - items[0].arrived >= self.window:
+                batch = items[: self.max_batch]
+                self._pending = [item for item in self._pending if all(item is not other for other in batch)]
+                return batch
+        return None
+
+    def _run(self, batch: List[_Item]) -> List[str]:
+        if self.embedding_cache is not None:
+            # Embeddings may have been cached by another batch after the image was queued
+            for item in batch:
+                if item.image_embeds is None and item.key is not None and item.key in self.embedding_cache:
+                    item.image_embeds = self.embedding_cache.get(item.key)
+
+        misses: List[_Item] = [item for item in batch if item.image_embeds is None]
+        if len(misses) > 0:
+            assert all(item.tensor is not None for item in misses)
+            image_embeds: torch.Tensor = self.model.encode([item.tensor for item in misses])  # type: ignore
+            for item, embeds in zip(misses, image_embeds):
+                # Copy not to keep the whole batch in the cache
+                item.image_embeds = embeds.clone()
+                if self.embedding_cache is not None and item.key is not None:
+                    self.embedding_cache.put(item.key, item.image_embeds)
+
+        options: Optional[CaptionOptions] = batch[0].options
+        if options is None:
+            return ["" for _ in batch]
+        return self.model.decode(torch.stack([item.image_embeds for item in batch]), options)  # type: ignore
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                batch: Optional[List[_Item]] = None
+                while batch is None and not self._closed:
+                    batch = self._pop_ready()
+                    if batch is None:
+                        self._cond.wait(
+                            timeout=self._pending[0].arrived + self.window - time.monotonic() if self._pending else None
+                        )
+                if batch is None:
+                    left: List[_Item] = self._pending
+                    self._pending = []
+                    break
+
+            logger.debug(f"Caption a batch of {len(batch)}")
+            try:
+                captions: List[str] = self._run(batch)
+            except Exception as e:
+                for item in batch:
+                    item.future.set_exception(e)
+                continue
+            for item, caption in zip(batch, captions):
+                item.future.set_result(caption)
+
+        for item in left:
+            item.future.set_exception(RuntimeError("BLIPBatcher is closed"))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+import torch
+
+from purepale.output import read_metadata
+from purepale.schema import CacheStats, WebResponse
+
+logger = getLogger(__name__)
+
+V = TypeVar("V")
+
+
+class LRUCache(Generic[V]):
+    """Thread-safe LRU cache bounded by the total size of values in bytes."""
+
+    def __init__(
+        self,
+        *,
+        max_bytes: int,
+        get_size: Callable[[V], int],
+    ):
+        self.max_bytes: int = max_bytes
+        self.get_size: Callable[[V], int] = get_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self.total_bytes: int = 0
+
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[Hashable, Tuple[V, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Return whether the key is cached without counting a hit or a miss."""
+        with self._lock:
+            return key in self._data
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, value: V) -> None:
+        size: int = self.get_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._data[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                entries=len(self._data),
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+def get_tensor_cache(max_mb: int) -> Optional[LRUCache[torch.Tensor]]:
+    """Return a cache of tensors within ``max_mb`` MiB, or None when it is 0."""
+    if max_mb <= 0:
+        return None
+    return LRUCache(max_bytes=max_mb * 1024 * 1024, get_size=lambda v: v.element_size() * v.nelement())
+
+
+class ResultCache:
+    """Map canonical generation requests to images and logs already written in ``path_out``.
+
+    Responses are read from logs, or from metadata of images when logs are not written.
+
+    The index is kept in SQLite at ``path_index`` and survives restarts.
+    Each change writes only its rows, so the cost of a write does not grow with the number of entries.
+    Least recently used entries are evicted when there are more than ``max_entries``
+    or their images are larger than ``max_bytes`` in total (0 means no limit).
+    Evicted entries are only removed from the index and their files are kept.
+    """
+
+    def __init__(
+        self,
+        *,
+        path_out: Path,
+        path_index: Path,
+        max_entries: int,
+        max_bytes: int = 0,
+    ):
+        self.path_out: Path = path_out
+        self.path_index: Path = path_index
+        self.max_entries: int = max_entries
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self.total_bytes: int = 0
+
+        self._lock = threading.Lock()
+        # key -> (log or image file name, image size)
+        self._data: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        # Order of the last use of entries, which is saved to restore the LRU order
+        self._clock: int = 0
+        try:
+            self._conn: sqlite3.Connection = self._open()
+        except sqlite3.DatabaseError:
+            logger.exception(f"Failed to load {path_index}. Start with an empty result cache")
+            # The write-ahead log and its index belong to the broken database
+            for suffix in ["", "-wal", "-shm"]:
+                Path(f"{path_index}{suffix}").unlink(missing_ok=True)
+            self._data.clear()
+            self.total_bytes = 0
+            self._conn = self._open()
+        # The limits may be smaller than the last time
+        with self._conn:
+            self._evict()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path_index), check_same_thread=False)
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS results "
+                    "(key TEXT PRIMARY KEY, name TEXT NOT NULL, nbytes INTEGER NOT NULL, used INTEGER NOT NULL)"
+                )
+            for key, name, nbytes, used in conn.execute("SELECT key, name, nbytes, used FROM results ORDER BY used"):
+                self._data[key] = (name, nbytes)
+                self.total_bytes += nbytes
+                self._clock = used
+        except sqlite3.DatabaseError:
+            conn.close()
+            raise
+        return conn
+
+    @staticmethod
+    def get_key(obj: Dict[str, Any]) -> str:
+        return hashlib.sha256(
+            json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf8")
+        ).hexdigest()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _remove(self, key: str) -> None:
+        _, nbytes = self._data.pop(key)
+        self.total_bytes -= nbytes
+        self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def _evict(self) -> None:
+        while len(self._data) > 0 and (
+            len(self._data) > self.max_entries or (self.max_bytes > 0 and self.total_bytes > self.max_bytes)
+        ):
+            self._remove(next(iter(self._data)))
+
+    def get(self, key: str) -> Optional[WebResponse]:
+        with self._lock:
+            item = self._data.get(key)
+            response: Optional[WebResponse] = None
+            if item is not None:
+                path_log: Path = self.path_out.joinpath(item[0])
+                try:
+                    if path_log.suffix == ".json":
+                        response = WebResponse.parse_file(path_log)
+                    else:
+                        metadata: Optional[str] = read_metadata(path_log)
+                        response = None if metadata is None else WebResponse.parse_raw(metadata)
+                    if not self.path_out.joinpath(Path(response.path).name).exists():
+                        response = None
+                except Exception:
+                    response = None
+                if response is None:
+                    # Files were removed
+                    with self._conn:
+                        self._remove(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            with self._conn:
+                self._conn.execute("UPDATE results SET used = ? WHERE key = ?", (self._tick(), key))
+            return response
+
+    def put(self, key: str, *, path_log: Optional[Path], path_image: Path) -> None:
+        name: str = (path_image if path_log is None else path_log).name
+        nbytes: int = path_image.stat().st_size
+        with self._lock, self._conn:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (name, nbytes)
+            self.total_bytes += nbytes
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, name, nbytes, used) VALUES (?, ?, ?, ?)",
+                (key, name, nbytes, self._tick()),
+            )
+            self._evict()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                entries=len(self._data),
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import threading
+import weakref
+from logging import getLogger
+from typing import Any, Dict
+
+import torch
+import torch.ao.nn.quantized.dynamic
+
+logger = getLogger(__name__)
+
+SHARED_COMPONENT_NAMES = ["vae", "text_encoder", "tokenizer", "safety_checker"]
+
+
+def get_module_nbytes(module: torch.nn.Module) -> int:
+    nbytes: int = sum(t.numel() * t.element_size() for t in list(module.parameters()) + list(module.buffers()))
+    for m in module.modules():
+        # Weights of quantized layers are neither parameters nor buffers
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):
+            nbytes += sum(t.numel() * t.element_size() for t in m._weight_bias() if t is not None)
+    return nbytes
+
+
+def get_fingerprint(component: Any) -> str:
+    """Return a hash of the class, configuration and weights (or vocabulary) of a component."""
+    h = hashlib.sha256()
+    h.update(f"{type(component).__module__}.{type(component).__qualname__}".encode("utf8"))
+    if isinstance(component, torch.nn.Module):
+        config = getattr(component, "config", None)
+        if config is not None:
+            # Ignore paths and library versions
+            config_dict: Dict[str, Any] = {
+                k: v
+                for k, v in (config.to_dict() if hasattr(config, "to_dict") else dict(config)).items()
+                if not k.startswith("_") and k != "transformers_version"
+            }
+            h.update(json.dumps(config_dict, sort_keys=True, default=str).encode("utf8"))
+        for name, tensor in sorted(component.state_dict().items()):
+            h.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode("utf8"))
+            h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    else:
+        h.update(json.dumps(component.get_vocab(), sort_keys=True).encode("utf8"))
+        h.update(
+            json.dumps(sorted((" ".join(k), v) for k, v in getattr(component, "bpe_ranks", {}).items())).encode("utf8")
+        )
+        h.update(json.dumps(component.special_tokens_map, sort_keys=True).encode("utf8"))
+        h.update(str(component.model_max_length).encode("utf8"))
+    return h.hexdigest()
+
+
+class ComponentRegistry:
+    """Share identical components (VAE, text encoder, tokenizer and safety checker) among pipelines.
+
+    Components are held by weak references, so they are freed when no pipeline uses them.
+    """
+
+    def __init__(self):
+        self.saved_bytes: int = 0
+        self._lock = threading.Lock()
+        self._components: "weakref.WeakValueDictionary[str, Any]" = weakref.WeakValueDictionary()
+
+    def share(self, pipe: Any) -> Dict[str, str]:
+        """Replace components of the pipeline with identical ones already loaded and return their fingerprints."""
+        name2fingerprint: Dict[str, str] = {}
+        for name in SHARED_COMPONENT_NAMES:
+            component = getattr(pipe, name, None)
+            if component is None:
+                continue
+            fingerprint: str = get_fingerprint(component)
+            name2fingerprint[name] = fingerprint
+            with self._lock:
+                shared = self._components.get(fingerprint)
+                if shared is None:
+                    self._components[fingerprint] = component
+                    continue
+                if shared is component:
+                    continue
+                saved: int = get_module_nbytes(component) if isinstance(component, torch.nn.Module) else 0
+                self.saved_bytes += saved
+            logger.info(
+                f"Sharing {name} ({fingerprint[:12]}) with a loaded model (saved {saved / 1024 / 1024:.1f} MiB)"
+            )
+            setattr(pipe, name, shared)
+        return name2fingerprint
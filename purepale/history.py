@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+import PIL
+import PIL.Image
+
+from purepale.output import is_sidecar
+from purepale.schema import HistoryItem, HistoryResponse, WebResponse
+
+logger = getLogger(__name__)
+
+THUMBNAIL_DIR_NAME: str = "thumbnails"
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS generations (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    used_prompt TEXT NOT NULL,
+    seed INTEGER,
+    created REAL NOT NULL,
+    thumbnail TEXT,
+    response TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS generations_created ON generations (created, name);
+CREATE INDEX IF NOT EXISTS generations_model ON generations (model, created);
+CREATE INDEX IF NOT EXISTS generations_seed ON generations (seed);
+"""
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class HistoryIndex:
+    """Index of generations in ``path_out`` in SQLite to list and search them without reading every log.
+
+    Responses are added when their images are written.
+    JSON logs already in ``path_out`` are added in the background at startup.
+    Thumbnails are made in the background and saved in ``path_out/thumbnails``.
+    """
+
+    def __init__(self, *, path_out: Path, path_db: Path, thumbnail_size: int):
+        self.path_out: Path = path_out
+        self.thumbnail_size: int = thumbnail_size
+        self.path_out.joinpath(THUMBNAIL_DIR_NAME).mkdir(exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path_db), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+        self._closed: bool = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thumbnail")
+        self._backfill_thread = threading.Thread(target=self._backfill, daemon=True)
+        self._backfill_thread.start()
+
+    @staticmethod
+    def _get_row(response: WebResponse, *, name: str, created: float) -> Tuple[Any, ...]:
+        return (
+            name,
+            response.path,
+            response.request.model,
+            response.request.parameters.prompt,
+            response.parsed_prompt.used_prompt,
+            response.request.parameters.seed,
+            created,
+            response.json(ensure_ascii=False),
+        )
+
+    def _insert(self, rows: List[Tuple[Any, ...]]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO generations "
+                "(name, path, model, prompt, used_prompt, seed, created, response) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def add(self, response: WebResponse, *, name: str, image: Optional[PIL.Image.Image] = None) -> None:
+        """Add the response of the image file whose name without the suffix is ``name``."""
+        self._insert([self._get_row(response, name=name, created=datetime.datetime.now().timestamp())])
+        self._executor.submit(self._make_thumbnail, name, response.path, image)
+
+    def _make_thumbnail(self, name: str, path_image: str, image: Optional[PIL.Image.Image]) -> None:
+        thumbnail: str = f"{THUMBNAIL_DIR_NAME}/{name}.webp"
+        path: Path = self.path_out.joinpath(thumbnail)
+        try:
+            if image is None:
+                image = PIL.Image.open(self.path_out.joinpath(Path(path_image).name))
+            image = image.convert("RGB")
+            image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            path_tmp: Path = path.with_name(f"{path.name}.tmp")
+            image.save(path_tmp, format="WEBP", quality=80)
+            os.replace(path_tmp, path)
+        except Exception:
+            logger.exception(f"Failed to make a thumbnail of {path_image}")
+            return
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE generations SET thumbnail = ? WHERE name = ?", (thumbnail, name))
+
+    def _backfill(self) -> None:
+        with self._lock:
+            names = {row[0] for row in self._conn.execute("SELECT name FROM generations")}
+        rows: List[Tuple[Any, ...]] = []
+        num_added: int = 0
+        for path in self.path_out.glob("*.json"):
+            if self._closed:
+                return
+            if path.name.startswith(".") or is_sidecar(path) or path.stem in names:
+                continue
+            try:
+                with path.open() as inf:
+                    data = json.load(inf)
+                if not isinstance(data, dict) or "request" not in data:
+                    continue  # Not a log of generation
+                rows.append(self._get_row(WebResponse.parse_obj(data), name=path.stem, created=path.stat().st_mtime))
+            except Exception:
+                logger.warning(f"Failed to read {path} for the history")
+                continue
+            if len(rows) >= 1000:
+                self._insert(rows)
+                num_added += len(rows)
+                rows = []
+        self._insert(rows)
+        num_added += len(rows)
+
+        with self._lock:
+            missing = list(
+                self._conn.execute("SELECT name, path FROM generations WHERE thumbnail IS NULL ORDER BY created DESC")
+            )
+        logger.info(f"Added {num_added} logs to the history, and {len(missing)} thumbnails are to be made")
+        for name, path_image in missing:
+            if self._closed:
+                return
+            # Made in this thread, so that thumbnails of new images do not wait for all of them
+            self._make_thumbnail(name, path_image, None)
+
+    def search(
+        self,
+        *,
+        model: Optional[str] = None,
+        prompt: Optional[str] = None,
+        seed: Optional[int] = None,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        offset: int = 0,
+        limit: int = 50,
+    ) -> HistoryResponse:
+        """Return generations matching all given conditions from the newest.
+
+        ``prompt`` matches a substring of the original or the used prompt.
+        """
+        conditions: List[str] = []
+        params: List[Any] = []
+        if model is not None:
+            conditions.append("model = ?")
+            params.append(model)
+        if prompt is not None:
+            conditions.append("(prompt LIKE ? ESCAPE '\\' OR used_prompt LIKE ? ESCAPE '\\')")
+            params += [f"%{_escape_like(prompt)}%"] * 2
+        if seed is not None:
+            conditions.append("seed = ?")
+            params.append(seed)
+        if since is not None:
+            conditions.append("created >= ?")
+            params.append(since.timestamp())
+        if until is not None:
+            conditions.append("created < ?")
+            params.append(until.timestamp())
+        where: str = "" if len(conditions) == 0 else "WHERE " + " AND ".join(conditions)
+
+        with self._lock:
+            total: int = self._conn.execute(f"SELECT COUNT(*) FROM generations {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT name, created, thumbnail, response FROM generations {where} "
+                "ORDER BY created DESC, name DESC LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return HistoryResponse(
+            items=[
+                HistoryItem(
+                    name=name,
+                    created=datetime.datetime.fromtimestamp(created),
+                    thumbnail=None if thumbnail is None else f"images/{thumbnail}",
+                    response=WebResponse.parse_raw(response),
+                )
+                for name, created, thumbnail, response in rows
+            ],
+            total=total,
+            offset=offset,
+            limit=limit,
+        )
+
+    def close(self) -> None:
+        self._closed = True
+        self._backfill_thread.join()
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import hashlib
+from io import BytesIO
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+import PIL
+import PIL.Image
+import PIL.ImageOps
+
+from purepale.cache import LRUCache
+from purepale.schema import CacheStats
+
+logger = getLogger(__name__)
+
+
+def get_image_nbytes(image: PIL.Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+def to_mask(image: PIL.Image.Image) -> PIL.Image.Image:
+    """Return a mask whose white pixels are repainted: the alpha channel, or the inverted image."""
+    if image.mode == "RGBA":
+        _, _, _, a = image.split()
+        image = PIL.Image.merge("RGB", (a, a, a))
+    else:
+        image = PIL.ImageOps.invert(image)
+    return image.convert("L")
+
+
+class ImageStore:
+    """Decoded images of files in ``path_out`` cached in memory.
+
+    Uploaded files are decoded once when they are saved.
+    Images converted and resized for requests are cached by the file name and the size.
+    Files in ``path_out`` are never overwritten, so their hashes are cached by the file name.
+    """
+
+    def __init__(self, *, path_out: Path, max_bytes: int):
+        self.path_out: Path = path_out
+        self._images: LRUCache[PIL.Image.Image] = LRUCache(max_bytes=max_bytes, get_size=get_image_nbytes)
+        self._digests: LRUCache[str] = LRUCache(max_bytes=1024 * 1024, get_size=len)
+
+    def _get_path(self, path: str) -> Path:
+        p: Path = self.path_out.joinpath(Path(path).name)
+        if not p.exists():
+            raise FileNotFoundError(f"Not Found: {path}")
+        return p
+
+    def put_file(self, name: str, data: bytes) -> Path:
+        """Save an uploaded file and decode it."""
+        path: Path = self.path_out.joinpath(name)
+        with path.open("wb") as outf:
+            outf.write(data)
+        self._digests.put(name, hashlib.sha256(data).hexdigest())
+        try:
+            self._images.put((name, None), self._decode(data))
+        except Exception:
+            # Not an image
+            logger.debug(f"Failed to decode {name}")
+        return path
+
+    @staticmethod
+    def _decode(data: bytes) -> PIL.Image.Image:
+        image = PIL.Image.open(BytesIO(data))
+        image.load()
+        return image
+
+    def get_digest(self, path: str) -> str:
+        name: str = Path(path).name
+        digest: Optional[str] = self._digests.get(name)
+        if digest is None:
+            digest = hashlib.sha256(self._get_path(path).read_bytes()).hexdigest()
+            self._digests.put(name, digest)
+        return digest
+
+    def _get_decoded(self, path: str) -> PIL.Image.Image:
+        name: str = Path(path).name
+        image: Optional[PIL.Image.Image] = self._images.get((name, None))
+        if image is None:
+            image = self._decode(self._get_path(path).read_bytes())
+            self._images.put((name, None), image)
+        return image
+
+    def _get(self, path: str, *, mask: bool, width: int, height: int) -> PIL.Image.Image:
+        key = (Path(path).name, mask, width, height)
+        image: Optional[PIL.Image.Image] = self._images.get(key)
+        if image is None:
+            decoded: PIL.Image.Image = self._get_decoded(path)
+            image = (to_mask(decoded) if mask else decoded.convert("RGB")).resize((width, height))
+            self._images.put(key, image)
+        return image
+
+    def get_image(self, path: str, *, width: int, height: int) -> PIL.Image.Image:
+        """Return the RGB image resized. It is shared and must not be modified."""
+        return self._get(path, mask=False, width=width, height=height)
+
+    def get_mask(self, path: str, *, width: int, height: int) -> PIL.Image.Image:
+        """Return the mask resized. It is shared and must not be modified."""
+        return self._get(path, mask=True, width=width, height=height)
+
+    def stats(self) -> CacheStats:
+        return self._images.stats()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from logging import getLogger
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import PIL
+import PIL.Image
+
+from purepale.batching import BatchJob, BatchScheduler
+from purepale.pipes import GenerationCancelled
+from purepale.schema import JobState, JobStatus, PipesRequest, PrasedPrompt, WebJobRequest, WebRequest, WebResponse
+from purepale.workers import WorkerPool
+
+logger = getLogger(__name__)
+
+TERMINAL_JOB_STATES = {JobState.finished, JobState.failed, JobState.cancelled}
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    id: str
+    request: WebJobRequest
+    batch_job: BatchJob
+    state: Optional[JobState]  # set when the job is done
+    response: Optional[WebResponse]
+    error: Optional[str]
+    finished_at: Optional[float]
+    listeners: List[Callable[[JobStatus], None]]
+
+    def __init__(self, *, request: WebJobRequest, batch_job: BatchJob):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.batch_job = batch_job
+        self.state = None
+        self.response = None
+        self.error = None
+        self.finished_at = None
+        self.listeners = []
+
+
+class JobQueue:
+    """Asynchronous generation jobs on top of BatchScheduler.
+
+    Finished jobs are kept ``keep_sec`` seconds for polling.
+    """
+
+    def __init__(
+        self,
+        *,
+        batch_scheduler: Union[BatchScheduler, WorkerPool],
+        max_queue: int,
+        on_generated: Callable[[WebRequest, List[Tuple[PIL.Image.Image, PrasedPrompt]]], WebResponse],
+        keep_sec: float = 3600,
+    ):
+        self.batch_scheduler: Union[BatchScheduler, WorkerPool] = batch_scheduler
+        self.max_queue: int = max_queue
+        self.on_generated = on_generated
+        self.keep_sec: float = keep_sec
+
+        self._lock = threading.RLock()
+        self._jobs: Dict[str, Job] = {}
+
+    def _status(self, job: Job) -> JobStatus:
+        state: JobState
+        if job.state is not None:
+            state = job.state
+        elif job.batch_job.future.running():
+            state = JobState.running
+        else:
+            state = JobState.queued
+        return JobStatus(
+            id=job.id,
+            state=state,
+            priority=job.batch_job.priority,
+            queue_position=self.batch_scheduler.queue_position(job.batch_job) if state == JobState.queued else None,
+            step=job.batch_job.step,
+            total_steps=job.batch_job.total_steps,
+            response=job.response,
+            error=job.error,
+        )
+
+    def _notify(self, job: Job) -> None:
+        with self._lock:
+            if len(job.listeners) == 0:
+                return
+            status: JobStatus = self._status(job)
+            for listener in job.listeners:
+                listener(status)
+
+    def _prune(self) -> None:
+        now: float = time.monotonic()
+        with self._lock:
+            for job_id in [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job.finished_at is not None and now - job.finished_at > self.keep_sec
+            ]:
+                del self._jobs[job_id]
+
+    @property
+    def num_queued(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.state is None and not job.batch_job.future.running())
+
+    def submit(
+        self,
+        *,
+        request: WebJobRequest,
+        pipes_request: PipesRequest,
+        cached_response: Optional[WebResponse] = None,
+        client: str = "",
+    ) -> JobStatus:
+        """Queue a job of the client, or add a finished one when ``cached_response`` is given."""
+        self._prune()
+        with self._lock:
+            if cached_response is not None:
+                batch_job = BatchJob(request=pipes_request, priority=request.priority, on_progress=None, client=client)
+                batch_job.future.set_running_or_notify_cancel()
+                job = Job(request=request, batch_job=batch_job)
+                job.response = cached_response
+                job.state = JobState.finished
+                job.finished_at = time.monotonic()
+                self._jobs[job.id] = job
+                return self._status(job)
+
+            if self.max_queue > 0 and self.num_queued >= self.max_queue:
+                raise QueueFull(f"Queue is full ({self.max_queue} jobs)")
+
+            job_holder: List[Job] = []
+            batch_job: BatchJob = self.batch_scheduler.submit(
+                model=request.model,
+                request=pipes_request,
+                priority=request.priority,
+                on_progress=lambda _: self._notify(job_holder[0]),
+                client=client,
+            )
+            job = Job(request=request, batch_job=batch_job)
+            job_holder.append(job)
+            self._jobs[job.id] = job
+            batch_job.future.add_done_callback(lambda future: self._on_done(job, future))
+            return self._status(job)
+
+    def _on_done(self, job: Job, future: "Future[List[Tuple[PIL.Image.Image, PrasedPrompt]]]") -> None:
+        response: Optional[WebResponse] = None
+        error: Optional[str] = None
+        state: JobState = JobState.finished
+        if future.cancelled():
+            state = JobState.cancelled
+        else:
+            e = future.exception()
+            if isinstance(e, GenerationCancelled):
+                state = JobState.cancelled
+            elif e is not None:
+                state = JobState.failed
+                error = "".join(str(v) for v in e.args)
+            else:
+                try:
+                    response = self.on_generated(job.request, future.result())
+                except Exception as e_save:
+                    logger.exception("Failed to save the result")
+                    state = JobState.failed
+                    error = "".join(str(v) for v in e_save.args)
+
+        with self._lock:
+            job.response = response
+            job.error = error
+            job.state = state
+            job.finished_at = time.monotonic()
+            self._notify(job)
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        with self._lock:
+            job: Optional[Job] = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return self._status(job)
+
+    def cancel(self, job_id: str) -> Optional[JobStatus]:
+        with self._lock:
+            job: Optional[Job] = self._jobs.get(job_id)
+            if job is None:
+                return None
+        self.batch_scheduler.cancel(job.batch_job)
+        with self._lock:
+            return self._status(job)
+
+    def subscribe(self, job_id: str, listener: Callable[[JobStatus], None]) -> Optional[JobStatus]:
+        """Register a listener for status changes and return the current status."""
+        with self._lock:
+            job: Optional[Job] = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.listeners.append(listener)
+            return self._status(job)
+
+    def unsubscribe(self, job_id: str, listener: Callable[[JobStatus], None]) -> None:
+        with self._lock:
+            job: Optional[Job] = self._jobs.get(job_id)
+            if job is not None and listener in job.listeners:
+                job.listeners.remove(listener)
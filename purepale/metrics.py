@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import bisect
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import torch
+
+logger = getLogger(__name__)
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+HELPS: Dict[str, Tuple[str, str]] = {
+    "purepale_stage_seconds": ("histogram", "Time of each stage of generation"),
+    "purepale_queue_wait_seconds": ("histogram", "Time of jobs waiting for a batch"),
+    "purepale_request_seconds": ("histogram", "Time to respond to generation requests"),
+    "purepale_requests_total": ("counter", "Number of generation requests"),
+    "purepale_inflight_requests": ("gauge", "Number of generation requests in progress"),
+    "purepale_peak_rss_bytes": ("gauge", "Peak resident set size of processes"),
+    "purepale_peak_cuda_bytes": ("gauge", "Peak memory allocated by torch on CUDA devices"),
+    "purepale_cache_hits_total": ("counter", "Number of cache hits"),
+    "purepale_cache_misses_total": ("counter", "Number of cache misses"),
+    "purepale_cache_bytes": ("gauge", "Size of cached values"),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+Changes = Tuple[Dict[Tuple[str, Labels], float], Dict[Tuple[str, Labels], Tuple[List[int], float]]]
+
+
+def get_peak_rss() -> int:
+    """Return the peak resident set size of this process in bytes."""
+    maxrss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS and KiB on Linux
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class _Histogram:
+    counts: List[int]
+    total: float
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms exposed in the Prometheus text format.
+
+    Worker processes send their changes with ``pop_changes`` and the server adds them with ``merge``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        self._changed_counters: Dict[Tuple[str, Labels], float] = {}
+        self._changed_histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        self._collectors: List[Callable[[], List[Sample]]] = []
+
+    @staticmethod
+    def _get_labels(labels: Dict[str, str]) -> Labels:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, self._get_labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+            self._changed_counters[key] = self._changed_counters.get(key, 0.0) + value
+
+    def add(self, name: str, value: float, **labels: str) -> None:
+        """Add the value to a gauge."""
+        key = (name, self._get_labels(labels))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._gauges[(name, self._get_labels(labels))] = value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, self._get_labels(labels))
+        index: int = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            for histograms in (self._histograms, self._changed_histograms):
+                h = histograms.get(key)
+                if h is None:
+                    h = histograms[key] = _Histogram()
+                h.counts[index] += 1
+                h.total += seconds
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Measure a stage of generation, which is also labeled in profiler traces."""
+        with self.time("purepale_stage_seconds", stage=stage), torch.profiler.record_function(stage):
+            yield
+
+    def add_collector(self, collector: Callable[[], List[Sample]]) -> None:
+        """Add a function which returns samples of gauges and counters when metrics are rendered."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def pop_changes(self) -> Changes:
+        """Return counters and histograms changed since the last call."""
+        with self._lock:
+            counters = self._changed_counters
+            histograms = {key: (h.counts, h.total) for key, h in self._changed_histograms.items()}
+            self._changed_counters = {}
+            self._changed_histograms = {}
+        return counters, histograms
+
+    def merge(self, changes: Changes) -> None:
+        counters, histograms = changes
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0.0) + value
+            for key, (counts, total) in histograms.items():
+                h = self._histograms.get(key)
+                if h is None:
+                    h = self._histograms[key] = _Histogram()
+                h.counts = [a + b for a, b in zip(h.counts, counts)]
+                h.total += total
+
+    def render(self) -> str:
+        samples: List[Sample] = [("purepale_peak_rss_bytes", (("process", "server"),), get_peak_rss())]
+        if torch.cuda.is_available():
+            for i in range(torch.cuda.device_count()):
+                samples.append(
+                    ("purepale_peak_cuda_bytes", (("device", f"cuda:{i}"),), torch.cuda.max_memory_allocated(i))
+                )
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            samples += collector()
+
+        name2lines: Dict[str, List[str]] = {}
+        with self._lock:
+            items = list(self._counters.items()) + list(self._gauges.items())
+            for (name, labels), value in items + [((name, labels), value) for name, labels, value in samples]:
+                name2lines.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            for (name, labels), h in self._histograms.items():
+                lines = name2lines.setdefault(name, [])
+                cumulative: int = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), h.counts):
+                    cumulative += count
+                    le: str = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(h.total)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        out: List[str] = []
+        for name in sorted(name2lines.keys()):
+            if name in HELPS:
+                out.append(f"# HELP {name} {HELPS[name][1]}")
+                out.append(f"# TYPE {name} {HELPS[name][0]}")
+            out += name2lines[name]
+        return "\n".join(out) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+@contextmanager
+def profile(path: Path) -> Iterator[None]:
+    """Save a trace of torch profiler, which can be opened with chrome://tracing or Perfetto."""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+        yield
+    path.parent.mkdir(parents=True, exist_ok=True)
+    prof.export_chrome_trace(str(path))
+    logger.info(f"Saved a profile to {path}")
+
+
+# Metrics of this process
+METRICS = Metrics()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import argparse
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Union
+
+import torch
+
+from purepale.batching import BatchScheduler
+from purepale.cache import get_tensor_cache
+from purepale.components import ComponentRegistry
+from purepale.quantization import get_default_cache_dir
+from purepale.registry import PipesRegistry
+from purepale.schema import OutputFormat, PurepaleFeatures
+from purepale.workers import WorkerPool
+
+logger = getLogger(__name__)
+
+
+def add_pipes_options(oparser: argparse.ArgumentParser) -> None:
+    """Add options of models, batching, caches and outputs shared by the server and purepale-batch."""
+    oparser.add_argument(
+        "--max_process",
+        "-P",
+        default=1,
+        type=int,
+    )
+    oparser.add_argument(
+        "--batch-window-ms",
+        type=int,
+        help="Wait for requests which can be generated in the same batch up to this time",
+        default=0,
+    )
+    oparser.add_argument(
+        "--max-batch",
+        type=int,
+        help="Maximum number of images generated in one batch",
+        default=1,
+    )
+    oparser.add_argument(
+        "--model-memory-mb",
+        type=int,
+        help="Evict least recently used idle models to keep loaded models within this size. 0 means unlimited",
+        default=0,
+    )
+    oparser.add_argument(
+        "--no-safety",
+        action="store_true",
+        help="Disable safety_checker with your responsibility",
+    )
+    oparser.add_argument(
+        "--feature",
+        "-f",
+        action="append",
+        type=PurepaleFeatures,
+        help="Enabled features",
+        default=[PurepaleFeatures.negative],
+        choices=list(PurepaleFeatures),
+    )
+    oparser.add_argument(
+        "--slice-size",
+        type=int,
+        help="0 means auto, Negative number means disabled. Large number saves VRAM but makes slow.",
+        default=0,
+    )
+    oparser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="Use the channels-last memory format for UNets and VAEs, which is faster on CPU",
+    )
+    oparser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile UNets and VAE decoders with torch.compile and warm them up at startup",
+    )
+    oparser.add_argument(
+        "--quantization-cache-dir",
+        type=Path,
+        help="Directory to save quantized weights of models with @int8",
+        default=get_default_cache_dir(),
+    )
+    oparser.add_argument(
+        "--profile",
+        type=Path,
+        help="Directory to save traces of torch profiler for sampled batches",
+    )
+    oparser.add_argument(
+        "--profile-rate",
+        type=float,
+        help="Ratio of batches profiled with --profile",
+        default=0.1,
+    )
+    oparser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of intra-op threads of torch (per worker process). 0 means the default",
+        default=0,
+    )
+    oparser.add_argument(
+        "--interop-threads",
+        type=int,
+        help="Number of inter-op threads of torch. 0 means the default",
+        default=0,
+    )
+    oparser.add_argument(
+        "--vae-tiling-pixels",
+        type=int,
+        help="Encode and decode images with more pixels than this in tiles to bound memory. 0 means disabled",
+        default=1024 * 1024,
+    )
+    oparser.add_argument(
+        "--embedding-cache-mb",
+        type=int,
+        help="Memory size for the cache of prompt embeddings. 0 means disabled",
+        default=64,
+    )
+    oparser.add_argument(
+        "--latent-cache-mb",
+        type=int,
+        help="Memory size for the cache of encoded initial images and masks. 0 means disabled",
+        default=64,
+    )
+    oparser.add_argument(
+        "--output-format",
+        type=OutputFormat,
+        help="Default format of output images (WebP is lossless)",
+        default=OutputFormat.png,
+        choices=list(OutputFormat),
+    )
+    oparser.add_argument(
+        "--output-quality",
+        type=int,
+        help="Default PNG compression level (0-9), WebP compression effort (0-100) or JPEG quality (1-95)",
+    )
+    oparser.add_argument(
+        "--image-cache-mb",
+        type=int,
+        help="Memory size for decoded and resized initial images and masks. 0 means disabled",
+        default=256,
+    )
+    oparser.add_argument(
+        "--writer-threads",
+        type=int,
+        help="Number of threads to write output images and logs. 0 means writing in the threads generating them",
+        default=2,
+    )
+    oparser.add_argument(
+        "--local",
+        action="store_true",
+        help="Do not access to HuggingFace",
+    )
+
+
+def get_pipes_kwargs(opts: argparse.Namespace) -> Dict[str, Any]:
+    """Return keyword arguments of Pipes for options added by ``add_pipes_options``."""
+    return {
+        "nosafety": opts.no_safety,
+        "slice_size": opts.slice_size,
+        "local_files_only": opts.local,
+        "channels_last": opts.channels_last,
+        "compile": opts.compile,
+        "quantization_cache_dir": opts.quantization_cache_dir,
+        "vae_tiling_pixels": opts.vae_tiling_pixels,
+        "profile_dir": opts.profile,
+        "profile_rate": opts.profile_rate,
+    }
+
+
+def get_batch_scheduler(
+    opts: argparse.Namespace,
+    *,
+    models: List[str],
+    replicas: int,
+    max_inflight: Optional[int] = None,
+    evict_to: Literal["drop", "cpu"] = "drop",
+    load_all: bool = False,
+) -> Union[BatchScheduler, WorkerPool]:
+    """Return the scheduler of generation for options added by ``add_pipes_options``.
+
+    With ``replicas`` of 1 or more, each model runs in that many worker processes, and otherwise in this process,
+    whose threads should be set with ``--threads`` and ``--interop-threads`` beforehand.
+    With ``--profile``, batches run one at a time so that a trace does not include steps of other batches.
+    """
+    device: str = "cuda" if torch.cuda.is_available() else "cpu"
+    max_process: int = opts.max_process
+    if opts.profile is not None and max(max_process, max_inflight or 0) > 1:
+        logger.warning("Run batches one at a time to profile them")
+        max_process, max_inflight = 1, 1
+    if replicas > 0:
+        return WorkerPool(
+            models=models,
+            replicas=replicas,
+            device=device,
+            pipes_kwargs=get_pipes_kwargs(opts),
+            feature_negative_prompt=PurepaleFeatures.negative in opts.feature,
+            embedding_cache_mb=opts.embedding_cache_mb,
+            latent_cache_mb=opts.latent_cache_mb,
+            window_ms=opts.batch_window_ms,
+            max_batch=opts.max_batch,
+            max_process=max_process,
+            max_inflight=max_inflight,
+            num_threads=opts.threads,
+            num_interop_threads=opts.interop_threads,
+        )
+
+    components = ComponentRegistry()
+    registry = PipesRegistry(
+        models=models,
+        device=device,
+        pipes_kwargs=get_pipes_kwargs(opts),
+        feature_negative_prompt=PurepaleFeatures.negative in opts.feature,
+        embedding_cache=get_tensor_cache(opts.embedding_cache_mb),
+        latent_cache=get_tensor_cache(opts.latent_cache_mb),
+        components=components,
+        max_bytes=opts.model_memory_mb * 1024 * 1024,
+        evict_to=evict_to,
+    )
+    if load_all:
+        registry.load_all()
+        logger.info(f"Sharing identical components among models saved {components.saved_bytes / 1024 / 1024:.1f} MiB")
+    return BatchScheduler(
+        registry=registry,
+        window_ms=opts.batch_window_ms,
+        max_batch=opts.max_batch,
+        max_process=max_process,
+        max_inflight=max_inflight,
+    )
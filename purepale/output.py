@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import re
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import PIL
+import PIL.Image
+import PIL.PngImagePlugin
+
+from purepale.metrics import METRICS
+from purepale.prompt import Prompt
+from purepale.schema import OutputFormat, OutputOptions, WebRequest, WebResponse
+
+logger = getLogger(__name__)
+
+METADATA_KEY: str = "purepale"
+EXIF_IFD: int = 0x8769
+EXIF_USER_COMMENT: int = 0x9286
+EXIF_UNICODE_PREFIX: bytes = b"UNICODE\x00"
+# Exif is stored in a JPEG APP1 segment of up to 64 KiB. WebP keeps the same limit to behave alike
+EXIF_MAX_BYTES: int = 65533
+# Not ".json", which is the suffix of logs of generations written next to images
+SIDECAR_SUFFIX: str = ".meta.json"
+
+SUFFIXES: Dict[OutputFormat, str] = {
+    OutputFormat.png: ".png",
+    OutputFormat.webp: ".webp",
+    OutputFormat.jpeg: ".jpg",
+}
+
+
+def get_suffix(options: OutputOptions) -> str:
+    return SUFFIXES[options.format]
+
+
+def get_sidecar_path(path: Path) -> Path:
+    """Return the path of the JSON file with metadata which does not fit in the image."""
+    return path.with_suffix(SIDECAR_SUFFIX)
+
+
+def is_sidecar(path: Path) -> bool:
+    return path.name.endswith(SIDECAR_SUFFIX)
+
+
+def save_image(
+    image: PIL.Image.Image,
+    path: Path,
+    *,
+    options: OutputOptions,
+    metadata: Optional[str] = None,
+) -> None:
+    """Encode the image with ``metadata`` embedded (a PNG text chunk, or the Exif UserComment of WebP and JPEG).
+
+    Metadata too large for Exif is written to a JSON sidecar (see ``get_sidecar_path``) instead.
+    """
+    if options.format == OutputFormat.png:
+        pnginfo: Optional[PIL.PngImagePlugin.PngInfo] = None
+        if metadata is not None:
+            pnginfo = PIL.PngImagePlugin.PngInfo()
+            pnginfo.add_itxt(METADATA_KEY, metadata)
+        image.save(
+            path,
+            format="PNG",
+            compress_level=6 if options.quality is None else options.quality,
+            pnginfo=pnginfo,
+        )
+        return
+
+    exif = PIL.Image.Exif()
+    sidecar: Optional[str] = None
+    if metadata is not None:
+        exif.get_ifd(EXIF_IFD)[EXIF_USER_COMMENT] = EXIF_UNICODE_PREFIX + metadata.encode("utf-16-be")
+        if len(exif.tobytes()) > EXIF_MAX_BYTES:
+            exif, sidecar = PIL.Image.Exif(), metadata
+    if options.format == OutputFormat.webp:
+        image.save(
+            path,
+            format="WEBP",
+            lossless=True,
+            quality=80 if options.quality is None else options.quality,
+            exif=exif.tobytes(),
+        )
+    else:
+        image.convert("RGB").save(
+            path,
+            format="JPEG",
+            quality=90 if options.quality is None else options.quality,
+            exif=exif.tobytes(),
+        )
+    if sidecar is not None:
+        # Written after the image, so that a sidecar always has its image
+        logger.warning(f"Metadata of {path.name} is too large for Exif and saved to a JSON file")
+        with get_sidecar_path(path).open("w", encoding="utf8") as outf:
+            outf.write(sidecar)
+            outf.write("\n")
+
+
+def read_metadata(path: Path) -> Optional[str]:
+    """Return metadata embedded by ``save_image``, or in its JSON sidecar."""
+    with PIL.Image.open(path) as image:
+        text: Optional[str] = getattr(image, "text", {}).get(METADATA_KEY)
+        if text is not None:
+            return text
+        comment = image.getexif().get_ifd(EXIF_IFD).get(EXIF_USER_COMMENT)
+        if isinstance(comment, bytes) and comment.startswith(EXIF_UNICODE_PREFIX):
+            return comment[len(EXIF_UNICODE_PREFIX) :].decode("utf-16-be")
+    path_sidecar: Path = get_sidecar_path(path)
+    if path.suffix != ".png" and path_sidecar.exists():
+        with path_sidecar.open(encoding="utf8") as inf:
+            return inf.read().strip()
+    return None
+
+
+def fix_random_words(prompt: str, *, seed: int, used_prompt: Optional[str]) -> str:
+    """Return the prompt whose word sets of ``--random`` are replaced with fixed words.
+
+    Words are recovered from ``used_prompt`` of a log when it matches, or drawn with the seed otherwise.
+    """
+    parsed = Prompt(original=prompt)
+    if used_prompt is not None:
+        wordsets: List[List[str]] = []
+
+        def to_placeholder(words: List[str]) -> str:
+            wordsets.append(words)
+            return f"\0{len(wordsets) - 1}\0"
+
+        template: str = Prompt(original=parsed.expand(to_placeholder))()
+        pattern: str = "".join(
+            re.escape(part) if i % 2 == 0 else "(" + "|".join(re.escape(w) for w in wordsets[int(part)]) + ")"
+            for i, part in enumerate(template.split("\0"))
+        )
+        m = re.fullmatch(pattern, used_prompt)
+        if m is not None:
+            words = iter(m.groups())
+            return parsed.expand(lambda _: next(words))
+    return parsed.expand(random.Random(seed).choice)
+
+
+def split_request(request: WebRequest, *, used_prompts: Optional[List[Optional[str]]] = None) -> List[WebRequest]:
+    """Return a request of each seed of the request.
+
+    Random words of each image are fixed with ``fix_random_words`` and its item of ``used_prompts``,
+    so that the request of each image generates the same image again.
+    """
+    assert request.seeds is not None
+    if used_prompts is None:
+        used_prompts = [None] * len(request.seeds)
+    return [
+        WebRequest(
+            **request.dict(include=set(WebRequest.__fields__.keys()) - {"parameters", "num_images", "seeds"}),
+            parameters=request.parameters.copy(
+                update={
+                    "seed": seed,
+                    "prompt": fix_random_words(request.parameters.prompt, seed=seed, used_prompt=used_prompt),
+                }
+            ),
+            seeds=[seed],
+        )
+        for seed, used_prompt in zip(request.seeds, used_prompts)
+    ]
+
+
+def write_result(
+    image: PIL.Image.Image,
+    *,
+    path_image: Path,
+    resp: WebResponse,
+    path_log: Optional[Path],
+    options: OutputOptions,
+) -> None:
+    """Write the image with the response as its metadata, and then the JSON log of the response.
+
+    The log is written atomically, so an existing log means that its image is complete.
+    """
+    with METRICS.stage("image_encode"):
+        save_image(image, path_image, options=options, metadata=resp.json(ensure_ascii=False))
+    if path_log is None:
+        return
+    with METRICS.stage("log_write"):
+        path_tmp: Path = path_log.with_name(f"{path_log.name}.{os.getpid()}.tmp")
+        with path_tmp.open("w") as outlogf:
+            outlogf.write(resp.json(indent=4, ensure_ascii=False))
+            outlogf.write("\n")
+        os.replace(path_tmp, path_log)
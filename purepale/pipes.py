@@ -1,23 +1,46 @@
+import datetime
+import os
+import random
+import time
+from contextlib import nullcontext
 from logging import getLogger
-from typing import Any, Dict, Tuple
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
 
 import PIL
 import PIL.Image
 import PIL.ImageDraw
 import torch
 import torch.backends.cudnn
-from diffusers import StableDiffusionImg2ImgPipeline, StableDiffusionInpaintPipelineLegacy, StableDiffusionPipeline
+from diffusers import StableDiffusionPipeline
+from diffusers.models.vae import DiagonalGaussianDistribution
+from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_inpaint_legacy import (
+    preprocess_image,
+    preprocess_mask,
+)
 
+from purepale.cache import LRUCache
+from purepale.components import ComponentRegistry, get_fingerprint
+from purepale.metrics import METRICS, profile
 from purepale.prompt import Prompt
-from purepale.schema import ModelConfig, PipesRequest, PrasedPrompt
+from purepale.quantization import QUANTIZED_COMPONENT_NAMES, quantize
+from purepale.runtime import compile_module, is_bf16_supported
+from purepale.schedulers import SchedulerRegistry
+from purepale.schema import GenerationMode, ModelConfig, Parameters, PipesRequest, PrasedPrompt, SchedulerName
+from purepale.tiling import circular_padding, make_tileable
+from purepale.vae import decode_latents_tiled, encode_tiled
 
 logger = getLogger(__name__)
 
 
+class GenerationCancelled(Exception):
+    pass
+
+
 class Pipes:
     @property
-    def scheduler_param(self) -> Dict[str, Any]:
-        return self.pipe_txt2img.scheduler.config
+    def scheduler_params(self) -> Dict[Optional[SchedulerName], Dict[str, Any]]:
+        return self.schedulers.params
 
     def __init__(
         self,
@@ -27,9 +50,33 @@ class Pipes:
         nosafety: bool,
         slice_size: int,
         local_files_only: bool,
+        embedding_cache: Optional[LRUCache[torch.Tensor]] = None,
+        latent_cache: Optional[LRUCache[torch.Tensor]] = None,
+        components: Optional[ComponentRegistry] = None,
+        channels_last: bool = False,
+        compile: bool = False,
+        quantization_cache_dir: Optional[Path] = None,
+        vae_tiling_pixels: int = 0,
+        profile_dir: Optional[Path] = None,
+        profile_rate: float = 0.0,
     ):
         self.device: str = device
         self.feature_egative_prompt: bool = False
+        self.model_config: ModelConfig = model_config
+        self.embedding_cache: Optional[LRUCache[torch.Tensor]] = embedding_cache
+        # Encoded initial images and downsampled masks keyed by their content
+        self.latent_cache: Optional[LRUCache[torch.Tensor]] = latent_cache
+        # The VAE works in tiles for images with more pixels than this (0 means never)
+        self.vae_tiling_pixels: int = vae_tiling_pixels
+        # Traces of torch profiler are saved for this ratio of batches
+        self.profile_dir: Optional[Path] = profile_dir
+        self.profile_rate: float = profile_rate
+        self.autocast_dtype: Optional[torch.dtype] = None
+        if model_config.dtype == "bf16":
+            if is_bf16_supported(device):
+                self.autocast_dtype = torch.bfloat16
+            else:
+                logger.warning(f"{device} does not support bf16 natively, so {model_config.model_id} runs in fp32")
 
         logger.info(f"Loading {model_config})")
         model_id: str = model_config.model_id
@@ -39,105 +86,374 @@ class Pipes:
         if nosafety:
             kwargs["safety_checker"] = None
 
-        self.pipe_txt2img = StableDiffusionPipeline.from_pretrained(
+        # txt2img, img2img and inpaint share this pipeline.
+        # The denoising loop is in Pipes so that requests with different seeds can be batched
+        self.pipe = StableDiffusionPipeline.from_pretrained(
             model_id,
             revision=model_config.revision,
             torch_dtype=torch.float16 if model_config.dtype == "fp16" else torch.float32,
             local_files_only=local_files_only,
             **kwargs,
-        ).to(device)
+        )
+        self.schedulers = SchedulerRegistry(self.pipe.scheduler)
+        # Hash weights before moving them to the device
+        self.component_fingerprints: Dict[str, str] = {}
+        if components is not None:
+            self.component_fingerprints = components.share(self.pipe)
+        if model_config.dtype == "int8":
+            if device == "cpu":
+                self._quantize(cache_dir=quantization_cache_dir)
+            else:
+                logger.warning(f"int8 quantization runs only on CPU, so {model_config.model_id} runs in fp32")
+        self.pipe.to(device)
         if slice_size >= 0:
-            self.pipe_txt2img.enable_attention_slicing(
+            self.pipe.enable_attention_slicing(
                 slice_size="auto" if slice_size == 0 else None if slice_size < 0 else slice_size,
             )
 
-        targets = [
-            self.pipe_txt2img.vae,
-            self.pipe_txt2img.text_encoder,
-            self.pipe_txt2img.unet,
-        ]
-        self.conv_layers = []
-        self.conv_layers_original_paddings = []
-        for target in targets:
-            for module in target.modules():
-                if isinstance(module, torch.nn.Conv2d) or isinstance(module, torch.nn.ConvTranspose2d):
-                    self.conv_layers.append(module)
-                    self.conv_layers_original_paddings.append(module.padding_mode)
-
-        self.pipe_img2img = StableDiffusionImg2ImgPipeline(
-            vae=self.pipe_txt2img.vae,
-            text_encoder=self.pipe_txt2img.text_encoder,
-            tokenizer=self.pipe_txt2img.tokenizer,
-            unet=self.pipe_txt2img.unet,
-            scheduler=self.pipe_txt2img.scheduler,
-            feature_extractor=self.pipe_txt2img.feature_extractor,
-            safety_checker=self.pipe_txt2img.safety_checker,
-        ).to(device)
-
-        self.pipe_masked_img2img = StableDiffusionInpaintPipelineLegacy(
-            vae=self.pipe_txt2img.vae,
-            text_encoder=self.pipe_txt2img.text_encoder,
-            tokenizer=self.pipe_txt2img.tokenizer,
-            unet=self.pipe_txt2img.unet,
-            scheduler=self.pipe_txt2img.scheduler,
-            feature_extractor=self.pipe_txt2img.feature_extractor,
-            safety_checker=self.pipe_txt2img.safety_checker,
-        ).to(device)
+        # Tiled generation pads circularly without changing modules shared by concurrent requests
+        for target in [self.pipe.vae, self.pipe.unet]:
+            make_tileable(target)
+
+        if channels_last:
+            self.pipe.unet.to(memory_format=torch.channels_last)
+            self.pipe.vae.to(memory_format=torch.channels_last)
+        if compile:
+            compiled: bool = compile_module(self.pipe.unet)
+            compiled = compile_module(self.pipe.vae.decoder) and compiled
+            if compiled:
+                self.warmup()
+
+    def _quantize(self, *, cache_dir: Optional[Path]) -> None:
+        for name in QUANTIZED_COMPONENT_NAMES:
+            module: torch.nn.Module = getattr(self.pipe, name)
+            fingerprint: str = self.component_fingerprints.get(name) or get_fingerprint(module)
+            setattr(self.pipe, name, quantize(module, fingerprint=fingerprint, cache_dir=cache_dir))
+            if name in self.component_fingerprints:
+                # Outputs of the quantized text encoder differ from ones of the shared original
+                self.component_fingerprints[name] = f"{fingerprint}:int8"
+
+    def warmup(self) -> None:
+        """Generate an image of the default size so that compilation does not delay the first request."""
+        logger.info(f"Warming up {self.model_config}")
+        self.generate(request=PipesRequest(parameters=Parameters(num_inference_steps=2, seed=0)))
+
+    def _autocast(self) -> ContextManager:
+        if self.autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=self.autocast_dtype)
+
+    def to(self, device: str, *, keep: Optional[List[torch.nn.Module]] = None) -> None:
+        """Move the pipeline to the device except modules in ``keep`` (e.g. ones shared with other models)."""
+        self.device = device
+        for module in self.pipe.components.values():
+            if isinstance(module, torch.nn.Module) and not any(module is k for k in keep or []):
+                module.to(device)
+
+    def _get_model_key(self, component_names: List[str]) -> Tuple[Optional[str], ...]:
+        """Return a key of outputs of the components, which models sharing them share."""
+        if all(name in self.component_fingerprints for name in component_names):
+            return tuple(self.component_fingerprints[name] for name in component_names)
+        return (self.model_config.model_id, self.model_config.revision, self.model_config.dtype)
+
+    def encode_texts(self, texts: List[str]) -> torch.Tensor:
+        """Return outputs of the text encoder for texts, reusing cached ones."""
+        pipe = self.pipe
+        model_key: Tuple[Optional[str], ...] = self._get_model_key(["tokenizer", "text_encoder"])
+        results: List[Optional[torch.Tensor]] = [None] * len(texts)
+        if self.embedding_cache is not None:
+            results = [self.embedding_cache.get((model_key, text)) for text in texts]
+
+        missing: List[str] = sorted({text for text, r in zip(texts, results) if r is None})
+        if len(missing) > 0:
+            text_inputs = pipe.tokenizer(
+                missing,
+                padding="max_length",
+                max_length=pipe.tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="pt",
+            )
+            attention_mask = None
+            if getattr(pipe.text_encoder.config, "use_attention_mask", False):
+                attention_mask = text_inputs.attention_mask.to(pipe._execution_device)
+            encoded = pipe.text_encoder(
+                text_inputs.input_ids.to(pipe._execution_device),
+                attention_mask=attention_mask,
+            )[0]
+            text2encoded: Dict[str, torch.Tensor] = {text: e for text, e in zip(missing, encoded.split(1))}
+            if self.embedding_cache is not None:
+                for text, e in text2encoded.items():
+                    # Copy not to keep the whole batch in the cache
+                    self.embedding_cache.put((model_key, text), e.clone())
+            results = [text2encoded[text] if r is None else r for text, r in zip(texts, results)]
+        return torch.cat(results, dim=0)  # type: ignore
+
+    def encode_initial_image(
+        self,
+        request: PipesRequest,
+        *,
+        dtype: torch.dtype,
+        tiled: bool,
+    ) -> DiagonalGaussianDistribution:
+        """Return the latent distribution of the initial image, reusing cached ones."""
+        pipe = self.pipe
+        device = pipe._execution_device
+        key: Optional[Tuple[Any, ...]] = None
+        if self.latent_cache is not None and request.initial_image_key is not None:
+            key = (
+                self._get_model_key(["vae"]),
+                str(device),
+                str(dtype),
+                tiled,
+                request.initial_image_key,
+                request.parameters.height,
+                request.parameters.width,
+            )
+            moments: Optional[torch.Tensor] = self.latent_cache.get(key)
+            if moments is not None:
+                # Each image samples from the distribution with its own generator as if it were encoded
+                return DiagonalGaussianDistribution(moments)
+
+        image = preprocess_image(request.initial_image).to(device=device, dtype=dtype)
+        with METRICS.stage("vae_encode"):
+            if tiled:
+                latent_dist = encode_tiled(pipe.vae, image, pipe.vae_scale_factor)
+            else:
+                latent_dist = pipe.vae.encode(image).latent_dist
+        if self.latent_cache is not None and key is not None:
+            self.latent_cache.put(key, latent_dist.parameters)
+        return latent_dist
+
+    def get_latent_mask(self, request: PipesRequest) -> torch.Tensor:
+        """Return the mask of inpainting downsampled to the latent resolution, reusing cached ones."""
+        scale_factor: int = self.pipe.vae_scale_factor
+        key: Optional[Tuple[Any, ...]] = None
+        if self.latent_cache is not None and request.initial_image_mask_key is not None:
+            key = (
+                "mask",
+                request.initial_image_mask_key,
+                request.parameters.height,
+                request.parameters.width,
+                scale_factor,
+            )
+            mask: Optional[torch.Tensor] = self.latent_cache.get(key)
+            if mask is not None:
+                return mask
+        mask = preprocess_mask(request.initial_image_mask, scale_factor)
+        if self.latent_cache is not None and key is not None:
+            self.latent_cache.put(key, mask)
+        return mask
+
+    def get_generator(self, seed: int) -> torch.Generator:
+        rand_device: str = "cpu" if self.device == "mps" else self.device
+        return torch.Generator(device=rand_device).manual_seed(seed)
 
     def generate(
         self,
         *,
         request: PipesRequest,
-    ) -> Tuple[PIL.Image.Image, PrasedPrompt]:
-        assert request.parameters.seed is not None
+    ) -> List[Tuple[PIL.Image.Image, PrasedPrompt]]:
+        return self.generate_batch(requests=[request])[0]
 
-        kwargs = {}
-        model = self.pipe_txt2img
-        if request.initial_image_mask is not None:
-            model = self.pipe_masked_img2img
-            kwargs["image"] = request.initial_image  # no preprocess
-            kwargs["mask_image"] = request.initial_image_mask
-            kwargs["strength"] = request.parameters.strength
-        elif request.initial_image is not None:
-            model = self.pipe_img2img
-            kwargs["image"] = request.initial_image
-            kwargs["strength"] = request.parameters.strength
-        else:
-            kwargs["height"] = request.parameters.height
-            kwargs["width"] = request.parameters.width
+    def generate_batch(
+        self,
+        *,
+        requests: List[PipesRequest],
+        callback: Optional[Callable[[int, int], bool]] = None,
+    ) -> List[List[Tuple[PIL.Image.Image, PrasedPrompt]]]:
+        """Generate images for all seeds of requests in one batch.
 
-        prompt: Prompt = Prompt(
-            original=request.parameters.prompt,
-        )
-        for cl, opad in zip(self.conv_layers, self.conv_layers_original_paddings):
-            if prompt.tileable:
-                # This hack is based on lox9973's snippet
-                # https://gitlab.com/-/snippets/2395088
-                cl.padding_mode = "circular"
-            else:
-                cl.padding_mode = opad
+        Requests should share mode, size, steps, eta, strength, scheduler and the tile flag.
+        Each image keeps its own seed and generator, so the result is the same as running it alone.
+        ``callback`` is called after each step with the numbers of finished and total steps.
+        When it returns False, GenerationCancelled is raised.
+        """
+        assert len(requests) > 0
+        first = requests[0].parameters
+        mode: GenerationMode = requests[0].get_mode()
+        for r in requests:
+            assert r.get_mode() == mode
+            assert (r.parameters.height, r.parameters.width) == (first.height, first.width)
+            assert r.parameters.num_inference_steps == first.num_inference_steps
+            assert r.parameters.eta == first.eta
+            assert r.parameters.scheduler == first.scheduler
+            assert mode == GenerationMode.txt2img or r.parameters.strength == first.strength
+
+        # Each image is a sample of the batch
+        samples: List[Tuple[PipesRequest, int]] = [(r, seed) for r in requests for seed in r.get_seeds()]
+        with METRICS.stage("prompt"):
+            prompts: List[Prompt] = [Prompt(original=r.parameters.prompt) for r, _ in samples]
+            used_prompts: List[str] = [p() for p in prompts]
+            parsed_prompts: List[PrasedPrompt] = [
+                p.get_parsed(
+                    used_prompt=used_prompt,
+                    tokenizer=self.pipe.tokenizer,
+                )
+                for p, used_prompt in zip(prompts, used_prompts)
+            ]
+        tileable: bool = prompts[0].tileable
+        assert all(p.tileable == tileable for p in prompts)
+        negative_prompts: Optional[List[str]] = None
+        if self.feature_egative_prompt:
+            negative_prompts = [p.negative for p in prompts]
+
+        generators: List[torch.Generator] = [self.get_generator(seed) for _, seed in samples]
+
+        profile_path: Optional[Path] = None
+        if self.profile_dir is not None and random.random() < self.profile_rate:
+            profile_path = self.profile_dir.joinpath(
+                datetime.datetime.now().strftime(f"%Y-%m-%d_%H-%M-%S_{os.getpid()}_{random.randint(0, 10000):05}.json")
+            )
+        with torch.no_grad(), circular_padding(tileable), profile(profile_path) if profile_path else nullcontext():
+            images = self._run(
+                requests=[r for r, _ in samples],
+                mode=mode,
+                used_prompts=used_prompts,
+                negative_prompts=negative_prompts,
+                generators=generators,
+                callback=callback,
+            )
+        results: List[List[Tuple[PIL.Image.Image, PrasedPrompt]]] = []
+        outputs = iter(zip(images, parsed_prompts))
+        for r in requests:
+            results.append([next(outputs) for _ in r.get_seeds()])
+        return results
+
+    def _run(
+        self,
+        *,
+        requests: List[PipesRequest],
+        mode: GenerationMode,
+        used_prompts: List[str],
+        negative_prompts: Optional[List[str]],
+        generators: List[torch.Generator],
+        callback: Optional[Callable[[int, int], bool]],
+    ) -> List[PIL.Image.Image]:
+        # Based on StableDiffusionPipeline, StableDiffusionImg2ImgPipeline and StableDiffusionInpaintPipelineLegacy
+        # of diffusers 0.11.1, but every random draw uses the generator of each request
+        pipe = self.pipe
+        device = pipe._execution_device
+        rand_device = "cpu" if device.type == "mps" else device
+        parameters = requests[0].parameters
+        batch_size: int = len(requests)
+        tiled_vae: bool = 0 < self.vae_tiling_pixels < parameters.height * parameters.width
+
+        # guidance_scale <= 1 means no guidance, which is the same as guidance_scale == 1
+        guidance_scales: List[float] = [max(r.parameters.guidance_scale, 1.0) for r in requests]
+        do_classifier_free_guidance: bool = any(g > 1.0 for g in guidance_scales)
+        with METRICS.stage("text_encode"):
+            text_embeddings = self.encode_texts(used_prompts)
+            if do_classifier_free_guidance:
+                uncond_embeddings = self.encode_texts(
+                    [""] * batch_size if negative_prompts is None else negative_prompts,
+                )
+                text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        dtype = text_embeddings.dtype
 
-        generator = None
-        if self.device == "cpu":
-            generator = torch.manual_seed(request.parameters.seed)
+        # The scheduler has states, so a batch uses its own instance.
+        # When the step consumes random numbers, each sample has its own one to keep reproducibility
+        stochastic: bool = self.schedulers.accepts(parameters.scheduler, "generator")
+        schedulers = [self.schedulers.create(parameters.scheduler) for _ in range(batch_size if stochastic else 1)]
+        for scheduler in schedulers:
+            scheduler.set_timesteps(parameters.num_inference_steps, device=device)
+        timesteps = schedulers[0].timesteps
+
+        mask = None
+        init_latents_orig = None
+        noise = None
+        if mode == GenerationMode.txt2img:
+            shape = (
+                1,
+                pipe.unet.in_channels,
+                parameters.height // pipe.vae_scale_factor,
+                parameters.width // pipe.vae_scale_factor,
+            )
+            latents = torch.cat(
+                [torch.randn(shape, generator=g, device=rand_device, dtype=dtype) for g in generators],
+                dim=0,
+            ).to(device)
+            latents = latents * schedulers[0].init_noise_sigma
         else:
-            generator = torch.cuda.manual_seed(request.parameters.seed)
+            init_timestep: int = min(
+                int(parameters.num_inference_steps * parameters.strength), parameters.num_inference_steps
+            )
+            t_start: int = max(parameters.num_inference_steps - init_timestep, 0)
+            # Second order schedulers have two timesteps per step
+            timesteps = timesteps[t_start * getattr(schedulers[0], "order", 1) :]
+            latent_timestep = timesteps[:1].repeat(batch_size)
 
-        used_prompt: str = prompt()
-        parsed_prompt = prompt.get_parsed(
-            used_prompt=used_prompt,
-            tokenizer=self.pipe_txt2img.tokenizer,
-        )
-        if self.feature_egative_prompt:
-            kwargs["negative_prompt"] = prompt.negative
-
-        with torch.no_grad():
-            image = model(
-                used_prompt,
-                num_inference_steps=request.parameters.num_inference_steps,
-                guidance_scale=request.parameters.guidance_scale,
-                eta=request.parameters.eta,
-                generator=generator,
-                **kwargs,
-            ).images[0]
-        return image, parsed_prompt
+            init_latents_list = []
+            noise_list = []
+            # Images of a request share the encoded initial image
+            latent_dists: Dict[int, DiagonalGaussianDistribution] = {}
+            for r, g in zip(requests, generators):
+                if id(r) not in latent_dists:
+                    latent_dists[id(r)] = self.encode_initial_image(r, dtype=dtype, tiled=tiled_vae)
+                init_latent = latent_dists[id(r)].sample(g)
+                init_latents_list.append(0.18215 * init_latent)
+                noise_list.append(torch.randn(init_latent.shape, generator=g, device=rand_device, dtype=dtype))
+            init_latents_orig = torch.cat(init_latents_list, dim=0)
+            noise = torch.cat(noise_list, dim=0).to(device)
+            latents = schedulers[0].add_noise(init_latents_orig, noise, latent_timestep)
+
+            if mode == GenerationMode.inpaint:
+                mask = torch.cat([self.get_latent_mask(r) for r in requests], dim=0).to(device=device, dtype=dtype)
+
+        guidance = torch.tensor(guidance_scales, device=device, dtype=dtype).view(-1, 1, 1, 1)
+        step_kwargs = {}
+        if self.schedulers.accepts(parameters.scheduler, "eta"):
+            step_kwargs["eta"] = parameters.eta
+
+        with pipe.progress_bar(total=len(timesteps)) as progress_bar:
+            for step, t in enumerate(timesteps):
+                step_start: float = time.perf_counter()
+                if stochastic:
+                    latent_model_input = torch.cat(
+                        [s.scale_model_input(latents[i : i + 1], t) for i, s in enumerate(schedulers)],
+                        dim=0,
+                    )
+                else:
+                    latent_model_input = schedulers[0].scale_model_input(latents, t)
+                if do_classifier_free_guidance:
+                    latent_model_input = torch.cat([latent_model_input] * 2)
+
+                with self._autocast():
+                    noise_pred = pipe.unet(latent_model_input, t, encoder_hidden_states=text_embeddings).sample
+                noise_pred = noise_pred.to(dtype)
+                if do_classifier_free_guidance:
+                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                    noise_pred = noise_pred_uncond + guidance * (noise_pred_text - noise_pred_uncond)
+
+                if stochastic:
+                    latents = torch.cat(
+                        [
+                            s.step(
+                                noise_pred[i : i + 1],
+                                t,
+                                latents[i : i + 1],
+                                generator=generators[i],
+                                **step_kwargs,
+                            ).prev_sample
+                            for i, s in enumerate(schedulers)
+                        ],
+                        dim=0,
+                    )
+                else:
+                    latents = schedulers[0].step(noise_pred, t, latents, **step_kwargs).prev_sample
+
+                if mask is not None:
+                    init_latents_proper = schedulers[0].add_noise(init_latents_orig, noise, torch.tensor([t]))
+                    latents = (init_latents_proper * mask) + (latents * (1 - mask))
+                progress_bar.update()
+                METRICS.observe("purepale_stage_seconds", time.perf_counter() - step_start, stage="denoise_step")
+                if callback is not None and not callback(step + 1, len(timesteps)):
+                    raise GenerationCancelled()
+
+        with self._autocast(), METRICS.stage("vae_decode"):
+            if tiled_vae:
+                image = decode_latents_tiled(pipe.vae, latents, pipe.vae_scale_factor)
+            else:
+                image = pipe.decode_latents(latents)
+        with METRICS.stage("safety_checker"):
+            image, _ = pipe.run_safety_checker(image, device, dtype)
+        return pipe.numpy_to_pil(image)
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 import random
-from typing import Final, List
+import re
+from typing import Callable, Final, List
 
 from purepale.schema import PrasedPrompt
 
@@ -14,6 +15,9 @@ SET_SEPARATOR: Final[str] = "|"
 
 NEGATIVE_COMMAND: Final[str] = "--no"
 
+# A word set, which is a group of negative words when it follows NEGATIVE_COMMAND
+WORDSET_PATTERN: Final["re.Pattern[str]"] = re.compile(r"(--no\s+)?\{([^{}]*)\}")
+
 
 class Prompt:
     original: str
@@ -116,6 +120,22 @@ class Prompt:
                     tail: str = item[sep_pos + 1 :]
                     self.split_prompt.append(tail)
 
+    def expand(self, choose: Callable[[List[str]], str]) -> str:
+        """Return the original prompt whose word sets are replaced with ``choose(words)``.
+
+        Other commands are kept, so the returned prompt is parsed in the same way except for randomness.
+        """
+        if REPALCE_COMMAND not in self.original:
+            return self.original
+
+        def replace(m: "re.Match[str]") -> str:
+            if m.group(1) is not None:
+                return m.group(0)
+            wordset: List[str] = m.group(2).split(SET_SEPARATOR)
+            return choose(wordset) if len(wordset) >= 2 else wordset[0]
+
+        return WORDSET_PATTERN.sub(replace, self.original).replace(REPALCE_COMMAND, "")
+
     def __call__(self) -> str:
         if not self.enable_replace:
             return "".join(self._parsed_str)
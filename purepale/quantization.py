@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import copy
+import hashlib
+import itertools
+import os
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import torch
+import torch.ao.nn.quantized.dynamic
+
+logger = getLogger(__name__)
+
+QUANTIZED_COMPONENT_NAMES = ["unet", "text_encoder"]
+
+
+def get_default_cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")).joinpath("purepale", "quantized")
+
+
+def _copy_sharing_tensors(module: torch.nn.Module) -> torch.nn.Module:
+    """Return a copy of the module whose parameters and buffers are the ones of the original."""
+    memo: Dict[int, Any] = {id(t): t for t in itertools.chain(module.parameters(), module.buffers())}
+    return copy.deepcopy(module, memo)
+
+
+def _swap_linears(module: torch.nn.Module) -> None:
+    """Replace Linear layers with empty int8 dynamic quantized ones, which are filled by load_state_dict."""
+    for name, child in module.named_children():
+        if type(child) is torch.nn.Linear:
+            setattr(
+                module,
+                name,
+                torch.ao.nn.quantized.dynamic.Linear(
+                    child.in_features,
+                    child.out_features,
+                    bias_=child.bias is not None,
+                    dtype=torch.qint8,
+                ),
+            )
+        else:
+            _swap_linears(child)
+
+
+def _get_quantized_state_dict(module: torch.nn.Module) -> Dict[str, Any]:
+    """Return the state of quantized layers, which excludes weights shared with the original module."""
+    prefixes = tuple(
+        f"{name}." for name, m in module.named_modules() if isinstance(m, torch.ao.nn.quantized.dynamic.Linear)
+    )
+    state_dict = module.state_dict()
+    result = OrderedDict((k, v) for k, v in state_dict.items() if k.startswith(prefixes))
+    # Versions of layers are needed to load their states
+    result._metadata = state_dict._metadata  # type: ignore
+    return result
+
+
+def quantize(module: torch.nn.Module, *, fingerprint: str, cache_dir: Optional[Path]) -> torch.nn.Module:
+    """Return a copy of the module whose Linear layers are quantized dynamically to int8.
+
+    The module itself is not changed because it may be shared with other models,
+    and other layers of the copy share weights with it.
+    ``fingerprint`` identifies the weights of the module.
+    Quantized weights are saved in ``cache_dir``, so that later loads skip the quantization pass.
+    """
+    key: str = hashlib.sha256(
+        f"{fingerprint}:{torch.__version__}:{torch.backends.quantized.engine}".encode("utf8")
+    ).hexdigest()
+    path: Optional[Path] = None if cache_dir is None else cache_dir.joinpath(f"{type(module).__name__}_{key}.pt")
+
+    quantized: torch.nn.Module = _copy_sharing_tensors(module)
+    if path is not None and path.exists():
+        try:
+            _swap_linears(quantized)
+            state_dict: Dict[str, Any] = torch.load(path, map_location="cpu")
+            if state_dict.keys() != _get_quantized_state_dict(quantized).keys():
+                raise ValueError("Layers do not match")
+            quantized.load_state_dict(state_dict, strict=False)
+            logger.info(f"Loaded quantized weights from {path}")
+            return quantized
+        except Exception:
+            logger.exception(f"Failed to load quantized weights from {path}, so they are made again")
+            quantized = _copy_sharing_tensors(module)
+
+    torch.ao.quantization.quantize_dynamic(quantized, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp: Path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        torch.save(_get_quantized_state_dict(quantized), path_tmp)
+        os.replace(path_tmp, path)
+        logger.info(f"Saved quantized weights to {path}")
+    return quantized
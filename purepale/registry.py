@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from logging import getLogger
+from typing import Any, Dict, Iterator, List, Literal, Optional
+
+import torch
+
+from purepale.cache import LRUCache
+from purepale.components import ComponentRegistry, get_module_nbytes
+from purepale.pipes import Pipes
+from purepale.schedulers import load_scheduler_params
+from purepale.schema import ModelConfig, SchedulerName
+
+logger = getLogger(__name__)
+
+
+class _Entry:
+    name: str
+    pipes: Optional[Pipes]
+    resident: bool
+    in_use: int
+    last_used: float
+    nbytes: int
+    scheduler_params: Dict[Optional[SchedulerName], Dict[str, Any]]
+    load_lock: threading.Lock
+
+    def __init__(self, *, name: str, scheduler_params: Dict[Optional[SchedulerName], Dict[str, Any]]):
+        self.name = name
+        self.pipes = None
+        self.resident = False
+        self.in_use = 0
+        self.last_used = 0.0
+        self.nbytes = 0
+        self.scheduler_params = scheduler_params
+        self.load_lock = threading.Lock()
+
+
+class PipesRegistry:
+    """Load Pipes of models when they are first used and evict idle ones under a memory budget.
+
+    ``max_bytes`` bounds the total size of models on the device (0 means unlimited).
+    Components shared among models are counted once.
+    Evicted models are dropped, or moved to CPU memory when ``evict_to`` is ``cpu``.
+    Configurations of schedulers are read when models are registered, so that requests are checked without loading.
+    """
+
+    def __init__(
+        self,
+        *,
+        models: List[str],
+        device: str,
+        pipes_kwargs: Dict[str, Any],
+        feature_negative_prompt: bool,
+        embedding_cache: Optional[LRUCache[torch.Tensor]] = None,
+        latent_cache: Optional[LRUCache[torch.Tensor]] = None,
+        components: Optional[ComponentRegistry] = None,
+        max_bytes: int = 0,
+        evict_to: Literal["drop", "cpu"] = "drop",
+    ):
+        self.device: str = device
+        self.pipes_kwargs: Dict[str, Any] = pipes_kwargs
+        self.feature_negative_prompt: bool = feature_negative_prompt
+        self.embedding_cache: Optional[LRUCache[torch.Tensor]] = embedding_cache
+        self.latent_cache: Optional[LRUCache[torch.Tensor]] = latent_cache
+        self.components: Optional[ComponentRegistry] = components
+        self.max_bytes: int = max_bytes
+        self.evict_to: Literal["drop", "cpu"] = evict_to
+
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {
+            name: _Entry(
+                name=name,
+                scheduler_params=load_scheduler_params(
+                    ModelConfig.parse(name),
+                    local_files_only=pipes_kwargs.get("local_files_only", False),
+                ),
+            )
+            for name in models
+        }
+
+    @staticmethod
+    def of(name2pipes: Dict[str, Pipes]) -> "PipesRegistry":
+        """Return a registry of already loaded Pipes, which are never evicted."""
+        registry = PipesRegistry(
+            models=[],
+            device="",
+            pipes_kwargs={},
+            feature_negative_prompt=False,
+        )
+        for name, pipes in name2pipes.items():
+            entry = _Entry(name=name, scheduler_params=pipes.scheduler_params)
+            entry.pipes = pipes
+            entry.resident = True
+            registry._entries[name] = entry
+        return registry
+
+    @property
+    def models(self) -> List[str]:
+        return list(self._entries.keys())
+
+    @property
+    def resident_models(self) -> List[str]:
+        with self._lock:
+            return [name for name, entry in self._entries.items() if entry.resident]
+
+    def scheduler_param(self, model: str, scheduler: Optional[SchedulerName] = None) -> Dict[str, Any]:
+        """Return the configuration of the scheduler of the model. Raise KeyError for unsupported ones."""
+        return self._entries[model].scheduler_params[scheduler]
+
+    def load_all(self) -> None:
+        for model in self.models:
+            with self.use(model):
+                pass
+
+    @staticmethod
+    def _get_modules(pipes_list: List[Pipes]) -> List[torch.nn.Module]:
+        """Return modules of the pipelines without duplicates of shared ones."""
+        modules: Dict[int, torch.nn.Module] = {}
+        for pipes in pipes_list:
+            for module in pipes.pipe.components.values():
+                if isinstance(module, torch.nn.Module):
+                    modules[id(module)] = module
+        return list(modules.values())
+
+    def _get_nbytes(self, pipes_list: List[Pipes]) -> int:
+        return sum(get_module_nbytes(module) for module in self._get_modules(pipes_list))
+
+    def _evict(self, *, keep: _Entry) -> None:
+        """Evict idle models in LRU order until models on the device and ``keep`` fit in the budget."""
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            resident: List[_Entry] = [e for e in self._entries.values() if e.resident and e is not keep]
+            if keep.resident:
+                resident.append(keep)
+
+            def get_total() -> int:
+                # The size of ``keep`` is known after the first load
+                total: int = self._get_nbytes([e.pipes for e in resident if e.pipes is not None])
+                return total if keep.resident else total + keep.nbytes
+
+            for entry in sorted(resident, key=lambda e: e.last_used):
+                if get_total() <= self.max_bytes:
+                    break
+                if entry is keep or entry.in_use > 0:
+                    continue
+                logger.info(f"Evicting {entry.name} ({entry.nbytes / 1024 / 1024:.1f} MiB, {self.evict_to})")
+                resident.remove(entry)
+                if self.evict_to == "cpu" and entry.pipes is not None:
+                    # Modules shared with models on the device stay there
+                    entry.pipes.to(
+                        "cpu",
+                        keep=self._get_modules([e.pipes for e in resident if e.pipes is not None]),
+                    )
+                else:
+                    entry.pipes = None
+                entry.resident = False
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _load(self, entry: _Entry) -> None:
+        if entry.resident:
+            return
+        self._evict(keep=entry)
+        if entry.pipes is not None:
+            logger.info(f"Restoring {entry.name} to {self.device}")
+            entry.pipes.to(self.device)
+        else:
+            entry.pipes = Pipes(
+                model_config=ModelConfig.parse(entry.name),
+                device=self.device,
+                embedding_cache=self.embedding_cache,
+                latent_cache=self.latent_cache,
+                components=self.components,
+                **self.pipes_kwargs,
+            )
+            entry.pipes.feature_egative_prompt = self.feature_negative_prompt
+            entry.nbytes = self._get_nbytes([entry.pipes])
+        with self._lock:
+            entry.resident = True
+        self._evict(keep=entry)
+
+    @contextmanager
+    def use(self, model: str) -> Iterator[Pipes]:
+        """Load the model if needed and keep it from eviction while in use."""
+        entry: _Entry = self._entries[model]
+        with self._lock:
+            entry.in_use += 1
+        try:
+            with entry.load_lock:
+                self._load(entry)
+            assert entry.pipes is not None
+            yield entry.pipes
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.monotonic()
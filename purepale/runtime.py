@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+from logging import getLogger
+from pathlib import Path
+from typing import Set
+
+import torch
+
+logger = getLogger(__name__)
+
+
+def is_bf16_supported(device: str) -> bool:
+    """Return whether the device computes bf16 natively."""
+    if device.startswith("cuda"):
+        return torch.cuda.is_bf16_supported()
+    if device != "cpu":
+        return False
+    try:
+        flags: Set[str] = set(Path("/proc/cpuinfo").read_text().split())
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def set_num_threads(*, intra_op: int, inter_op: int) -> None:
+    """Set numbers of threads of torch. 0 keeps the default.
+
+    The number of inter-op threads can be set only before any inter-op parallel work starts.
+    """
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        torch.set_num_interop_threads(inter_op)
+    logger.info(f"Threads of torch: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def compile_module(module: torch.nn.Module) -> bool:
+    """Replace forward of the module with the compiled one and return whether it succeeded.
+
+    The module object stays the same, so that it can still be shared, moved and inspected.
+    """
+    if "forward" in module.__dict__:
+        # Already compiled as a component shared with another model
+        return True
+    try:
+        module.forward = torch.compile(module.forward)  # type: ignore
+    except RuntimeError as e:
+        # e.g. torch 2.0 does not support Python 3.11
+        logger.warning(f"Failed to compile {type(module).__name__}, which runs eagerly: {e}")
+        return False
+    return True
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import inspect
+from logging import getLogger
+from typing import Any, Dict, Optional, Type
+
+import diffusers
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    HeunDiscreteScheduler,
+    KDPM2AncestralDiscreteScheduler,
+    KDPM2DiscreteScheduler,
+    LMSDiscreteScheduler,
+    PNDMScheduler,
+)
+
+from purepale.schema import ModelConfig, SchedulerName
+
+logger = getLogger(__name__)
+
+SCHEDULER_CLASSES: Dict[SchedulerName, Type] = {
+    SchedulerName.ddim: DDIMScheduler,
+    SchedulerName.pndm: PNDMScheduler,
+    SchedulerName.lms: LMSDiscreteScheduler,
+    SchedulerName.euler: EulerDiscreteScheduler,
+    SchedulerName.euler_a: EulerAncestralDiscreteScheduler,
+    SchedulerName.dpmpp_2m: DPMSolverMultistepScheduler,
+    SchedulerName.heun: HeunDiscreteScheduler,
+    SchedulerName.kdpm2: KDPM2DiscreteScheduler,
+    SchedulerName.kdpm2_a: KDPM2AncestralDiscreteScheduler,
+}
+
+
+class SchedulerRegistry:
+    """Schedulers of a model built once from the configuration of the scheduler shipped with it.
+
+    Schedulers have states, so ``create`` returns a new instance for each use.
+    ``None`` is the scheduler of the model.
+    """
+
+    def __init__(self, base: Any):
+        self._templates: Dict[Optional[SchedulerName], Any] = {None: base}
+        for name, cls in SCHEDULER_CLASSES.items():
+            try:
+                self._templates[name] = cls.from_config(base.config)
+            except Exception as e:
+                logger.warning(f"{name.value} is not available for this model: {e}")
+
+        self.params: Dict[Optional[SchedulerName], Dict[str, Any]] = {}
+        for name, template in self._templates.items():
+            # from_config keeps the class name of the original configuration
+            self.params[name] = {**template.config, "_class_name": template.__class__.__name__}
+
+    def create(self, name: Optional[SchedulerName]) -> Any:
+        template = self._get(name)
+        return template.__class__.from_config(template.config)
+
+    def accepts(self, name: Optional[SchedulerName], param: str) -> bool:
+        return param in inspect.signature(self._get(name).step).parameters
+
+    def _get(self, name: Optional[SchedulerName]) -> Any:
+        template = self._templates.get(name)
+        if template is None:
+            raise KeyError(f"Unsupported scheduler: {name}")
+        return template
+
+
+def load_scheduler_params(
+    model_config: ModelConfig,
+    *,
+    local_files_only: bool,
+) -> Dict[Optional[SchedulerName], Dict[str, Any]]:
+    """Return configurations of schedulers of the model, which reads only the configuration of its scheduler."""
+    # The class only tells the file name of the configuration, which is the same for all schedulers
+    config = PNDMScheduler.load_config(
+        model_config.model_id,
+        subfolder="scheduler",
+        revision=model_config.revision,
+        local_files_only=local_files_only,
+    )
+    return SchedulerRegistry(getattr(diffusers, config["_class_name"]).from_config(config)).params
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
+import datetime
 import enum
 from pathlib import Path
 from typing import Any, Dict, List, Literal, Optional
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, root_validator, validator
 
 
 @enum.unique
@@ -13,19 +14,62 @@ class PurepaleFeatures(enum.Enum):
     negative = "negative"
 
 
+@enum.unique
+class OutputFormat(enum.Enum):
+    png = "png"
+    webp = "webp"  # lossless
+    jpeg = "jpeg"
+
+
+@enum.unique
+class SchedulerName(enum.Enum):
+    ddim = "ddim"
+    pndm = "pndm"
+    lms = "lms"
+    euler = "euler"
+    euler_a = "euler_a"
+    dpmpp_2m = "dpmpp_2m"
+    heun = "heun"
+    kdpm2 = "kdpm2"
+    kdpm2_a = "kdpm2_a"
+
+
+# Steps used when a request selects a scheduler without steps
+SCHEDULER_DEFAULT_STEPS: Dict[SchedulerName, int] = {
+    SchedulerName.ddim: 50,
+    SchedulerName.pndm: 50,
+    SchedulerName.lms: 50,
+    SchedulerName.euler: 30,
+    SchedulerName.euler_a: 30,
+    SchedulerName.dpmpp_2m: 20,
+    SchedulerName.heun: 25,
+    SchedulerName.kdpm2: 25,
+    SchedulerName.kdpm2_a: 25,
+}
+
+
+@enum.unique
+class GenerationMode(enum.Enum):
+    txt2img = "txt2img"
+    img2img = "img2img"
+    inpaint = "inpaint"
+
+
 class ModelConfig(BaseModel):
     model_id: str
     revision: Optional[str] = None
-    dtype: Literal["fp16", "fp32"]
+    # bf16 loads weights in fp32 and runs the UNet and the VAE decoder with bf16 autocast.
+    # int8 quantizes Linear layers of the UNet and the text encoder dynamically
+    dtype: Literal["fp16", "fp32", "bf16", "int8"]
 
     @staticmethod
     def parse(query: str) -> "ModelConfig":
         r_at: int = query.rfind("@")
-        dtype: Literal["fp16", "fp32"] = "fp16"
+        dtype: Literal["fp16", "fp32", "bf16", "int8"] = "fp16"
         if r_at >= 0:
             v: str = query[r_at + 1 :]
-            assert v == "fp16" or v == "fp32", f"`{v}` is not acceptable"
-            dtype: Literal["fp16", "fp32"] = v
+            assert v in ("fp16", "fp32", "bf16", "int8"), f"`{v}` is not acceptable"
+            dtype: Literal["fp16", "fp32", "bf16", "int8"] = v
             query = query[:r_at]
 
         model_id: str = query
@@ -58,12 +102,59 @@ class Parameters(BaseModel):
     eta: float = 0.0
     strength: float = 0.8
     seed: Optional[int] = None
+    scheduler: Optional[SchedulerName] = None  # None means the scheduler of the model
+
+    @root_validator(pre=True)
+    def steps_of_scheduler(cls, values):
+        if values.get("scheduler") is not None and values.get("num_inference_steps") is None:
+            try:
+                values["num_inference_steps"] = SCHEDULER_DEFAULT_STEPS[SchedulerName(values["scheduler"])]
+            except ValueError:
+                pass  # Reported by the validation of the field
+        return values
 
 
 class PipesRequest(BaseModel):
     initial_image: Optional[Any] = None
     initial_image_mask: Optional[Any] = None
+    # Content hashes of the initial image and the mask, with which their latents are cached
+    initial_image_key: Optional[str] = None
+    initial_image_mask_key: Optional[str] = None
     parameters: Parameters
+    seeds: List[int] = []
+
+    def get_seeds(self) -> List[int]:
+        """Return seeds of images to generate, which default to the seed in parameters."""
+        if len(self.seeds) > 0:
+            return self.seeds
+        assert self.parameters.seed is not None
+        return [self.parameters.seed]
+
+    def get_mode(self) -> GenerationMode:
+        if self.initial_image_mask is not None:
+            return GenerationMode.inpaint
+        elif self.initial_image is not None:
+            return GenerationMode.img2img
+        return GenerationMode.txt2img
+
+
+class OutputOptions(BaseModel):
+    format: OutputFormat = OutputFormat.png
+    # PNG: compression level (0-9), WebP: compression effort (0-100), JPEG: quality (1-95)
+    quality: Optional[int] = None
+
+    @validator("quality")
+    def quality_range(cls, v, values, **kwargs):
+        if v is None or "format" not in values:
+            return v
+        lower, upper = {
+            OutputFormat.png: (0, 9),
+            OutputFormat.webp: (0, 100),
+            OutputFormat.jpeg: (1, 95),
+        }[values["format"]]
+        if not lower <= v <= upper:
+            raise ValueError(f"quality of {values['format'].value} should be between {lower} and {upper}")
+        return v
 
 
 class WebRequest(BaseModel):
@@ -71,6 +162,9 @@ class WebRequest(BaseModel):
     path_initial_image: Optional[str] = None
     path_initial_image_mask: Optional[str] = None
     parameters: Parameters = Parameters()
+    num_images: int = 1
+    seeds: Optional[List[int]] = None
+    output: Optional[OutputOptions] = None  # None means the default of the server
 
     @validator("path_initial_image_mask")
     def mask(cls, v, values, **kwargs):
@@ -78,6 +172,18 @@ class WebRequest(BaseModel):
             raise ValueError("Mask should be with original image")
         return v
 
+    @validator("num_images")
+    def num_images_positive(cls, v, **kwargs):
+        if v < 1:
+            raise ValueError("num_images should be positive")
+        return v
+
+    @validator("seeds")
+    def seeds_for_images(cls, v, values, **kwargs):
+        if v is not None and (len(v) == 0 or values.get("num_images", 1) not in {1, len(v)}):
+            raise ValueError("seeds should have num_images seeds")
+        return v
+
 
 class PrasedPrompt(BaseModel):
     used_prompt: str
@@ -93,16 +199,92 @@ class WebResponse(BaseModel):
     path: str
     scheduler: Dict[str, Any]
     parsed_prompt: PrasedPrompt
+    paths: List[str] = []
+    seeds: List[int] = []
+
+
+@enum.unique
+class JobState(enum.Enum):
+    queued = "queued"
+    running = "running"
+    finished = "finished"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+class WebJobRequest(WebRequest):
+    priority: int = 0
+
+
+class JobStatus(BaseModel):
+    id: str
+    state: JobState
+    priority: int
+    queue_position: Optional[int] = None
+    step: int = 0
+    total_steps: int = 0
+    response: Optional[WebResponse] = None
+    error: Optional[str] = None
+
+
+def _check_num_beams(cls, v, **kwargs):
+    if not 1 <= v <= 8:
+        raise ValueError("num_beams should be between 1 and 8")
+    return v
 
 
 class WebImg2PromptRequest(BaseModel):
     path: str
+    num_beams: int = 3  # 1 means greedy decoding, which is the fastest
+
+    _num_beams_range = validator("num_beams", allow_reuse=True)(_check_num_beams)
 
 
 class WebImg2PromptResponse(BaseModel):
     prompt: str
 
 
+class WebImg2PromptBatchRequest(BaseModel):
+    paths: List[str]
+    num_beams: int = 3
+
+    _num_beams_range = validator("num_beams", allow_reuse=True)(_check_num_beams)
+
+
+class WebImg2PromptBatchResponse(BaseModel):
+    prompts: List[str]
+
+
+class HistoryItem(BaseModel):
+    name: str
+    created: datetime.datetime
+    thumbnail: Optional[str]  # None until it is made
+    response: WebResponse
+
+
+class HistoryResponse(BaseModel):
+    items: List[HistoryItem]
+    total: int  # Number of all matched items
+    offset: int
+    limit: int
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    entries: int
+    bytes: int
+    max_bytes: int
+
+
+class SchedulerInfo(BaseModel):
+    name: Optional[SchedulerName]
+    default_steps: int
+
+
 class Info(BaseModel):
     default_parameters: Parameters
     supported_models: List[str]
+    supported_schedulers: List[SchedulerInfo] = []
+    resident_models: List[str] = []
+    caches: Dict[str, CacheStats] = {}
@@ -1,187 +1,545 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import datetime
 import logging
 import random
-import shutil
-import threading
 import traceback
-from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, MutableMapping, Optional, Tuple, Union
 
 import PIL
 import PIL.Image
 import PIL.ImageDraw
-import PIL.ImageOps
 import torch
 import torch.backends.cudnn
 import uvicorn
-from fastapi import FastAPI, UploadFile
+from fastapi import BackgroundTasks, FastAPI, Query, Request, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException
-
-from purepale.blip import BLIP
-from purepale.pipes import Pipes
+from starlette.responses import Response
+
+from purepale.batching import BatchScheduler
+from purepale.blip import BLIP, BLIPBatcher, CaptionOptions
+from purepale.cache import LRUCache, ResultCache, get_tensor_cache
+from purepale.history import HistoryIndex
+from purepale.ingest import ImageStore
+from purepale.jobs import TERMINAL_JOB_STATES, JobQueue, QueueFull
+from purepale.metrics import METRICS, Sample
+from purepale.options import add_pipes_options, get_batch_scheduler
+from purepale.output import get_suffix, split_request, write_result
+from purepale.prompt import Prompt
+from purepale.runtime import set_num_threads
 from purepale.schema import (
+    SCHEDULER_DEFAULT_STEPS,
+    CacheStats,
+    HistoryResponse,
     Info,
+    JobStatus,
     ModelConfig,
+    OutputOptions,
     Parameters,
     PipesRequest,
+    PrasedPrompt,
     PurepaleFeatures,
+    SchedulerInfo,
+    WebImg2PromptBatchRequest,
+    WebImg2PromptBatchResponse,
     WebImg2PromptRequest,
     WebImg2PromptResponse,
+    WebJobRequest,
     WebRequest,
     WebResponse,
 )
+from purepale.workers import WorkerPool
+from purepale.writer import BackgroundWriter
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Requests with the same value of this header share the device fairly as one client (the address by default)
+CLIENT_HEADER: str = "X-Purepale-Client"
+
+
+class OutputStaticFiles(StaticFiles):
+    """Serve output files after they are written."""
+
+    def __init__(self, *, writer: BackgroundWriter, **kwargs):
+        super().__init__(**kwargs)
+        self.writer: BackgroundWriter = writer
 
-def get_app(opts):
+    async def get_response(self, path: str, scope: MutableMapping[str, Any]) -> Response:
+        pending = self.writer.get_pending(Path(path).name)
+        if pending is not None:
+            await asyncio.wrap_future(pending)
+        return await super().get_response(path, scope)
+
+
+def get_app(opts, *, model_blip: Optional[BLIP] = None):
+    """Return the application. ``model_blip`` is used for the blip feature instead of the pretrained model."""
     path_out: Path = opts.output
     path_out.mkdir(exist_ok=True, parents=True)
 
     device: str = "cuda" if torch.cuda.is_available() else "cpu"
+    if not opts.process_per_model:
+        set_num_threads(intra_op=opts.threads, inter_op=opts.interop_threads)
 
-    model_blip: Optional[BLIP] = None
+    blip_batcher: Optional[BLIPBatcher] = None
+    blip_embedding_cache: Optional[LRUCache[torch.Tensor]] = None
     logger.info(f"Features: {[v.value for v in opts.feature]}")
     if PurepaleFeatures.blip in opts.feature:
-        logger.info("Loading BIIP")
-        model_blip = BLIP(device)
-        logger.info("Finished loading of BIIP")
-
-    name2pipes = {}
-    for name in opts.model:
-        _pipes = Pipes(
-            model_config=ModelConfig.parse(name),
-            device=device,
-            nosafety=opts.no_safety,
-            slice_size=opts.slice_size,
-            local_files_only=opts.local,
+        if model_blip is None:
+            logger.info("Loading BIIP")
+            model_blip = BLIP(device)
+            logger.info("Finished loading of BIIP")
+        blip_embedding_cache = get_tensor_cache(opts.blip_embedding_cache_mb)
+        blip_batcher = BLIPBatcher(
+            model=model_blip,
+            window_ms=opts.blip_batch_window_ms,
+            max_batch=opts.blip_max_batch,
+            embedding_cache=blip_embedding_cache,
+        )
+
+    batch_scheduler: Union[BatchScheduler, WorkerPool] = get_batch_scheduler(
+        opts,
+        models=opts.model,
+        replicas=opts.replicas if opts.process_per_model else 0,
+        max_inflight=max(opts.max_inflight, opts.max_process),
+        evict_to=opts.evict_to,
+        load_all=not opts.lazy_load,
+    )
+    # Caches of worker processes are not visible from here
+    embedding_cache: Optional[LRUCache[torch.Tensor]] = None
+    latent_cache: Optional[LRUCache[torch.Tensor]] = None
+    if isinstance(batch_scheduler, BatchScheduler):
+        embedding_cache = batch_scheduler.registry.embedding_cache
+        latent_cache = batch_scheduler.registry.latent_cache
+
+    default_output = OutputOptions(format=opts.output_format, quality=opts.output_quality)
+    image_store = ImageStore(path_out=path_out, max_bytes=opts.image_cache_mb * 1024 * 1024)
+    writer = BackgroundWriter(max_workers=opts.writer_threads)
+    history: Optional[HistoryIndex] = None
+    if not opts.no_history:
+        history = HistoryIndex(
+            path_out=path_out,
+            path_db=path_out.joinpath(".history.sqlite3"),
+            thumbnail_size=opts.thumbnail_size,
         )
-        if PurepaleFeatures.negative in opts.feature:
-            _pipes.feature_egative_prompt = True
-        name2pipes[name] = _pipes
 
     app = FastAPI()
-    app.mount("/images", StaticFiles(directory=str(path_out)), name="images")
-    semaphore = threading.Semaphore(opts.max_process)
+    app.mount("/images", OutputStaticFiles(writer=writer, directory=str(path_out)), name="images")
+
+    @app.on_event("shutdown")
+    def shutdown():
+        batch_scheduler.close()
+        if blip_batcher is not None:
+            blip_batcher.close()
+        writer.close()
+        if history is not None:
+            history.close()
+        if result_cache is not None:
+            result_cache.close()
 
     def generate_file_name_preifix() -> str:
         n: int = random.randint(0, 10000)
         return datetime.datetime.now().strftime(f"%Y-%m-%d_%H-%M-%S_{n:05}")
 
+    def prewarm_blip(path: Path) -> None:
+        assert blip_batcher is not None
+        try:
+            blip_batcher.prewarm(path.read_bytes())
+        except Exception:
+            logger.exception(f"Failed to cache image embeddings of {path}")
+
     @app.post("/api/upload")
-    async def upload(file: UploadFile):
+    def upload(file: UploadFile, background_tasks: BackgroundTasks):
         name: str = generate_file_name_preifix()
         outfile_name = f"uploaded_{name}{Path(file.filename).suffix}"
-        path_outfile: Path = path_out.joinpath(outfile_name)
-        with path_outfile.open("wb") as outf:
-            shutil.copyfileobj(file.file, outf)
+        path_outfile: Path = image_store.put_file(outfile_name, file.file.read())
+        if blip_batcher is not None and blip_embedding_cache is not None:
+            # Uploaded images are often captioned next
+            background_tasks.add_task(prewarm_blip, path_outfile)
         return {"path": f"images/{outfile_name}"}
 
-    @app.post("/api/img2prompt", response_model=WebImg2PromptResponse)
-    def api_img2prompt(request: WebImg2PromptRequest):
-        if model_blip is None:
+    def get_blip_batcher() -> BLIPBatcher:
+        if blip_batcher is None:
             raise HTTPException(
                 status_code=400,
                 detail="BLIP is disabled",
             )
+        return blip_batcher
 
-        path_ii = path_out.joinpath(Path(request.path).name)
+    def load_file(path: str) -> bytes:
+        path_ii = path_out.joinpath(Path(path).name)
         if not path_ii.exists():
-            raise FileNotFoundError(f"Not Found: {request.path}")
-        with path_ii.open("rb") as imgf:
-            image = PIL.Image.open(BytesIO(imgf.read())).convert("RGB")
-            prompt: str = model_blip.predict(image)
+            raise FileNotFoundError(f"Not Found: {path}")
+        return path_ii.read_bytes()
+
+    @app.post("/api/img2prompt", response_model=WebImg2PromptResponse)
+    def api_img2prompt(request: WebImg2PromptRequest):
+        batcher: BLIPBatcher = get_blip_batcher()
         return WebImg2PromptResponse(
-            prompt=prompt,
+            prompt=batcher.predict_files([load_file(request.path)], CaptionOptions(num_beams=request.num_beams))[0],
         )
 
-    @app.post("/api/generate", response_model=WebResponse)
-    def api_generate(request: WebRequest):
-        pipes = name2pipes.get(request.model)
-        if pipes is None:
-            raise HTTPException(
-                status_code=400,
-                detail="Unsupported model name",
-            )
+    @app.post("/api/img2prompt/batch", response_model=WebImg2PromptBatchResponse)
+    def api_img2prompt_batch(request: WebImg2PromptBatchRequest):
+        batcher: BLIPBatcher = get_blip_batcher()
+        return WebImg2PromptBatchResponse(
+            prompts=batcher.predict_files(
+                [load_file(path) for path in request.paths],
+                CaptionOptions(num_beams=request.num_beams),
+            ),
+        )
 
-        try:
-            init_image = None
+    def get_pipes_request(request: WebRequest) -> PipesRequest:
+        init_image = None
+        mask_img = None
+        init_image_key: Optional[str] = None
+        mask_img_key: Optional[str] = None
+        with METRICS.stage("image_load"):
             if request.path_initial_image:
-                path_ii: Path = path_out.joinpath(Path(request.path_initial_image).name)
-                if not path_ii.exists():
-                    raise FileNotFoundError(f"Not Found: {request.path_initial_image}")
-                with path_ii.open("rb") as imgf:
-                    init_image = PIL.Image.open(BytesIO(imgf.read())).convert("RGB")
-                init_image = init_image.resize((request.parameters.width, request.parameters.height))
-
-            mask_img = None
+                init_image = image_store.get_image(
+                    request.path_initial_image,
+                    width=request.parameters.width,
+                    height=request.parameters.height,
+                )
+                init_image_key = image_store.get_digest(request.path_initial_image)
             if request.path_initial_image_mask is not None:
-                path_ii_mask: Path = path_out.joinpath(Path(request.path_initial_image_mask).name)
-                if not path_ii_mask.exists():
-                    raise FileNotFoundError(f"Not Found: {request.path_initial_image}")
-                with path_ii_mask.open("rb") as imgf:
-                    im = PIL.Image.open(BytesIO(imgf.read()))
-                    if im.mode == "RGBA":
-                        _, _, _, a = im.split()
-                        im = PIL.Image.merge("RGB", (a, a, a))
-                    else:
-                        im = PIL.ImageOps.invert(im)
-                    mask_img = im.convert("L")
-                mask_img = mask_img.resize((request.parameters.width, request.parameters.height))
+                mask_img = image_store.get_mask(
+                    request.path_initial_image_mask,
+                    width=request.parameters.width,
+                    height=request.parameters.height,
+                )
+                mask_img_key = image_store.get_digest(request.path_initial_image_mask)
+
+        return PipesRequest(
+            initial_image=init_image,
+            initial_image_mask=mask_img,
+            initial_image_key=init_image_key,
+            initial_image_mask_key=mask_img_key,
+            parameters=request.parameters,
+            seeds=set_seeds(request),
+        )
 
+    def set_seeds(request: WebRequest) -> List[int]:
+        """Fill seeds of the request: consecutive ones from the given seed, or random ones."""
+        if request.seeds is None:
             if request.parameters.seed is None:
-                request.parameters.seed = random.randint(-9007199254740991, 9007199254740991)
-
-            with semaphore:
-                image, parsed_prompt = pipes.generate(
-                    request=PipesRequest(
-                        initial_image=init_image,
-                        initial_image_mask=mask_img,
-                        parameters=request.parameters,
-                    )
-                )
-                out_name_prefix: str = generate_file_name_preifix()
+                request.seeds = [random.randint(-9007199254740991, 9007199254740991) for _ in range(request.num_images)]
+            else:
+                request.seeds = [request.parameters.seed + i for i in range(request.num_images)]
+        request.num_images = len(request.seeds)
+        request.parameters.seed = request.seeds[0]
+        return request.seeds
+
+    def merge_responses(request: WebRequest, responses: List[WebResponse]) -> WebResponse:
+        return responses[0].copy(
+            update={
+                "request": WebRequest(**request.dict(include=set(WebRequest.__fields__.keys()))),
+                "paths": [r.path for r in responses],
+                "seeds": request.seeds,
+            }
+        )
 
-        except Exception as e:
-            tr: str = "\n".join(list(traceback.TracebackException.from_exception(e).format()))
+    result_cache: Optional[ResultCache] = None
+    if opts.result_cache_entries > 0:
+        result_cache = ResultCache(
+            path_out=path_out,
+            path_index=path_out.joinpath(".result_cache.sqlite3"),
+            max_entries=opts.result_cache_entries,
+            max_bytes=opts.result_cache_mb * 1024 * 1024,
+        )
+
+    def get_result_key(request: WebRequest) -> str:
+        """Return the key of a request with a seed for the result cache."""
+        images: Dict[str, str] = {}
+        for name, path in [
+            ("initial_image", request.path_initial_image),
+            ("initial_image_mask", request.path_initial_image_mask),
+        ]:
+            if path is not None:
+                images[name] = image_store.get_digest(path)
+        return ResultCache.get_key(
+            {
+                "model": ModelConfig.parse(request.model).dict(),
+                "parameters": request.parameters.dict(),
+                "images": images,
+                "scheduler": dict(batch_scheduler.scheduler_param(request.model, request.parameters.scheduler)),
+                "output": (request.output or default_output).dict(),
+                "nosafety": opts.no_safety,
+                "negative": PurepaleFeatures.negative in opts.feature,
+                # Options which change output pixels
+                "tiled_vae": 0 < opts.vae_tiling_pixels < request.parameters.height * request.parameters.width,
+                "slice_size": opts.slice_size,
+                "channels_last": opts.channels_last,
+                "compile": opts.compile,
+            }
+        )
+
+    def is_cacheable(request: WebRequest) -> bool:
+        """Return whether the result is determined by the request, which is not with randomly chosen words."""
+        return not Prompt(original=request.parameters.prompt).enable_replace
+
+    def get_cached_response(request: WebRequest) -> Optional[WebResponse]:
+        """Return the response when results of all images are cached."""
+        if result_cache is None or (request.seeds is None and request.parameters.seed is None):
+            return None
+        if not is_cacheable(request):
+            return None
+        set_seeds(request)
+        responses: List[WebResponse] = []
+        for image_request in split_request(request):
+            try:
+                response: Optional[WebResponse] = result_cache.get(get_result_key(image_request))
+            except FileNotFoundError:
+                return None
+            if response is None:
+                return None
+            responses.append(response)
+        return merge_responses(request, responses)
+
+    def write_and_index_result(
+        *,
+        image: PIL.Image.Image,
+        path_outfile: Path,
+        resp: WebResponse,
+        path_log: Optional[Path],
+    ) -> None:
+        write_result(
+            image,
+            path_image=path_outfile,
+            resp=resp,
+            path_log=path_log,
+            options=resp.request.output or default_output,
+        )
+        if result_cache is not None and is_cacheable(resp.request):
+            result_cache.put(get_result_key(resp.request), path_log=path_log, path_image=path_outfile)
+        if history is not None:
+            history.add(resp, name=path_outfile.stem, image=image)
+
+    def save_result(
+        request: WebRequest,
+        results: List[Tuple[PIL.Image.Image, PrasedPrompt]],
+    ) -> WebResponse:
+        responses: List[WebResponse] = []
+        # Requests of images have the random words which are used
+        image_requests: List[WebRequest] = split_request(
+            request, used_prompts=[parsed_prompt.used_prompt for _, parsed_prompt in results]
+        )
+        for image_request, (image, parsed_prompt) in zip(image_requests, results):
+            out_name_prefix: str = generate_file_name_preifix()
+            path_outfile: Path = path_out.joinpath(out_name_prefix + get_suffix(image_request.output or default_output))
+            resp = WebResponse(
+                request=image_request,
+                model=ModelConfig.parse(request.model),
+                path=f"images/{path_outfile.name}",
+                scheduler=batch_scheduler.scheduler_param(request.model, request.parameters.scheduler),
+                parsed_prompt=parsed_prompt,
+                paths=[f"images/{path_outfile.name}"],
+                seeds=image_request.seeds,
+            )
+            path_log: Optional[Path] = None if opts.no_log_file else path_out.joinpath(f"{out_name_prefix}.json")
+            writer.submit(
+                [path_outfile.name] + ([] if path_log is None else [path_log.name]),
+                lambda image=image, path_outfile=path_outfile, resp=resp, path_log=path_log: write_and_index_result(
+                    image=image,
+                    path_outfile=path_outfile,
+                    resp=resp,
+                    path_log=path_log,
+                ),
+            )
+            responses.append(resp)
+        return merge_responses(request, responses)
+
+    def to_http_exception(e: Exception) -> HTTPException:
+        tr: str = "\n".join(list(traceback.TracebackException.from_exception(e).format()))
+        return HTTPException(
+            status_code=400,
+            detail="".join(e.args) + "\n" + tr,
+        )
+
+    def get_client(http_request: Request) -> str:
+        client: Optional[str] = http_request.headers.get(CLIENT_HEADER)
+        if client:
+            return client
+        return "" if http_request.client is None else http_request.client.host
+
+    def check_model(request: WebRequest) -> None:
+        if request.model not in batch_scheduler.models:
             raise HTTPException(
                 status_code=400,
-                detail="".join(e.args) + "\n" + tr,
+                detail="Unsupported model name",
+            )
+        try:
+            batch_scheduler.scheduler_param(request.model, request.parameters.scheduler)
+        except KeyError:
+            raise HTTPException(
+                status_code=400,
+                detail="Unsupported scheduler for the model",
             )
 
-        path_outfile: Path = path_out.joinpath(f"{out_name_prefix}.png")
-        image.save(path_outfile)
+    job_queue = JobQueue(
+        batch_scheduler=batch_scheduler,
+        max_queue=opts.max_queue,
+        on_generated=save_result,
+    )
 
-        resp = WebResponse(
-            request=request,
-            model=ModelConfig.parse(name),
-            path=f"images/{path_outfile.name}",
-            scheduler=pipes.scheduler_param,
-            parsed_prompt=parsed_prompt,
-        )
-        path_log: Path = path_out.joinpath(f"{out_name_prefix}.json")
-        with path_log.open("w") as outlogf:
-            outlogf.write(
-                resp.json(
-                    indent=4,
-                    ensure_ascii=False,
+    @app.post("/api/generate", response_model=WebResponse)
+    def api_generate(request: WebRequest, http_request: Request):
+        check_model(request)
+        cached_response: Optional[WebResponse] = get_cached_response(request)
+        if cached_response is not None:
+            METRICS.inc("purepale_requests_total", model=request.model, endpoint="generate", result="cached")
+            return cached_response
+        try:
+            with METRICS.time("purepale_request_seconds", model=request.model):
+                results = batch_scheduler.generate(
+                    model=request.model,
+                    request=get_pipes_request(request),
+                    client=get_client(http_request),
                 )
+        except Exception as e:
+            METRICS.inc("purepale_requests_total", model=request.model, endpoint="generate", result="error")
+            raise to_http_exception(e)
+        METRICS.inc("purepale_requests_total", model=request.model, endpoint="generate", result="generated")
+        return save_result(request, results)
+
+    @app.post("/api/jobs", response_model=JobStatus)
+    def api_jobs_submit(request: WebJobRequest, http_request: Request):
+        check_model(request)
+        cached_response: Optional[WebResponse] = get_cached_response(request)
+        try:
+            pipes_request: PipesRequest = get_pipes_request(request)
+        except Exception as e:
+            raise to_http_exception(e)
+        try:
+            status: JobStatus = job_queue.submit(
+                request=request,
+                pipes_request=pipes_request,
+                cached_response=cached_response,
+                client=get_client(http_request),
+            )
+        except QueueFull as e:
+            METRICS.inc("purepale_requests_total", model=request.model, endpoint="jobs", result="rejected")
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+            )
+        METRICS.inc(
+            "purepale_requests_total",
+            model=request.model,
+            endpoint="jobs",
+            result="queued" if cached_response is None else "cached",
+        )
+        return status
+
+    def get_job_or_404(status: Optional[JobStatus]) -> JobStatus:
+        if status is None:
+            raise HTTPException(
+                status_code=404,
+                detail="Job not found",
+            )
+        return status
+
+    @app.get("/api/jobs/{job_id}", response_model=JobStatus)
+    def api_jobs_get(job_id: str):
+        return get_job_or_404(job_queue.get(job_id))
+
+    @app.delete("/api/jobs/{job_id}", response_model=JobStatus)
+    def api_jobs_cancel(job_id: str):
+        return get_job_or_404(job_queue.cancel(job_id))
+
+    @app.get("/api/jobs/{job_id}/events")
+    async def api_jobs_events(job_id: str):
+        """Stream JobStatus as server-sent events until the job is done."""
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[JobStatus]" = asyncio.Queue()
+
+        def listener(status: JobStatus) -> None:
+            loop.call_soon_threadsafe(queue.put_nowait, status)
+
+        status: JobStatus = get_job_or_404(job_queue.subscribe(job_id, listener))
+
+        async def events():
+            try:
+                _status: JobStatus = status
+                while True:
+                    yield f"data: {_status.json(ensure_ascii=False)}\n\n"
+                    if _status.state in TERMINAL_JOB_STATES:
+                        break
+                    _status = await queue.get()
+            finally:
+                job_queue.unsubscribe(job_id, listener)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def get_cache_stats() -> Dict[str, CacheStats]:
+        caches: Dict[str, CacheStats] = {}
+        if embedding_cache is not None:
+            caches["embedding"] = embedding_cache.stats()
+        if latent_cache is not None:
+            caches["latent"] = latent_cache.stats()
+        if result_cache is not None:
+            caches["result"] = result_cache.stats()
+        if blip_embedding_cache is not None:
+            caches["blip_embedding"] = blip_embedding_cache.stats()
+        caches["image"] = image_store.stats()
+        return caches
+
+    def collect_cache_metrics() -> List[Sample]:
+        samples: List[Sample] = []
+        for name, stats in get_cache_stats().items():
+            labels = (("cache", name),)
+            samples.append(("purepale_cache_hits_total", labels, stats.hits))
+            samples.append(("purepale_cache_misses_total", labels, stats.misses))
+            samples.append(("purepale_cache_bytes", labels, stats.bytes))
+        return samples
+
+    METRICS.add_collector(collect_cache_metrics)
+
+    @app.get("/api/history", response_model=HistoryResponse)
+    def api_history(
+        model: Optional[str] = None,
+        prompt: Optional[str] = None,
+        seed: Optional[int] = None,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        offset: int = Query(0, ge=0),
+        limit: int = Query(50, ge=1, le=500),
+    ):
+        if history is None:
+            raise HTTPException(
+                status_code=400,
+                detail="History is disabled",
             )
-            outlogf.write("\n")
-        return resp
+        return history.search(
+            model=model,
+            prompt=prompt,
+            seed=seed,
+            since=since,
+            until=until,
+            offset=offset,
+            limit=limit,
+        )
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
 
     @app.get("/api/info", response_model=Info)
     def api_info():
         dp = Parameters()
+        caches = get_cache_stats()
         return Info(
             default_parameters=dp,
-            supported_models=list(name2pipes.keys()),
+            supported_models=batch_scheduler.models,
+            supported_schedulers=[SchedulerInfo(name=None, default_steps=dp.num_inference_steps)]
+            + [SchedulerInfo(name=name, default_steps=steps) for name, steps in SCHEDULER_DEFAULT_STEPS.items()],
+            resident_models=batch_scheduler.resident_models,
+            caches=caches,
         )
 
     app.mount(
@@ -196,7 +554,7 @@ def get_app(opts):
     return app
 
 
-def get_opts() -> argparse.Namespace:
+def get_opts(args: Optional[List[str]] = None) -> argparse.Namespace:
     oparser = argparse.ArgumentParser()
     oparser.add_argument("--model", action="append", required=True)
     oparser.add_argument(
@@ -219,38 +577,88 @@ def get_opts() -> argparse.Namespace:
         "--root_path",
         default="",
     )
+    add_pipes_options(oparser)
     oparser.add_argument(
-        "--max_process",
-        "-P",
-        default=1,
+        "--max-inflight",
+        type=int,
+        help="Maximum number of batches in progress, which take turns at each step (at least --max_process)",
+        default=4,
+    )
+    oparser.add_argument(
+        "--max-queue",
+        type=int,
+        help="Maximum number of queued jobs of /api/jobs. 0 means unlimited",
+        default=100,
+    )
+    oparser.add_argument(
+        "--process-per-model",
+        action="store_true",
+        help="Run each model in its own worker process",
+    )
+    oparser.add_argument(
+        "--replicas",
         type=int,
+        help="Number of worker processes per model with --process-per-model",
+        default=1,
     )
     oparser.add_argument(
-        "--no-safety",
+        "--lazy-load",
         action="store_true",
-        help="Disable safety_checker with your responsibility",
+        help="Load models when they are first requested",
     )
     oparser.add_argument(
-        "--feature",
-        "-f",
-        action="append",
-        type=PurepaleFeatures,
-        help="Enabled features",
-        default=[PurepaleFeatures.negative],
-        choices=list(PurepaleFeatures),
+        "--evict-to",
+        choices=["drop", "cpu"],
+        help="Drop evicted models or move them to CPU memory for faster reloading",
+        default="drop",
     )
     oparser.add_argument(
-        "--slice-size",
+        "--blip-batch-window-ms",
         type=int,
-        help="0 means auto, Negative number means disabled. Large number saves VRAM but makes slow.",
+        help="Wait for other images to caption in the same batch up to this time",
         default=0,
     )
     oparser.add_argument(
-        "--local",
+        "--blip-max-batch",
+        type=int,
+        help="Maximum number of images captioned in one batch",
+        default=16,
+    )
+    oparser.add_argument(
+        "--blip-embedding-cache-mb",
+        type=int,
+        help="Memory size for the cache of image embeddings of BLIP. 0 means disabled",
+        default=64,
+    )
+    oparser.add_argument(
+        "--no-log-file",
         action="store_true",
-        help="Do not access to HuggingFace",
+        help="Do not write JSON logs beside images. Responses are still embedded in images",
+    )
+    oparser.add_argument(
+        "--result-cache-entries",
+        type=int,
+        help="Number of requests with seeds whose results are reused. 0 means disabled",
+        default=10000,
+    )
+    oparser.add_argument(
+        "--result-cache-mb",
+        type=int,
+        help="Maximum total size of images of reused results. 0 means no limit",
+        default=4096,
+    )
+    oparser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="Do not index generations for /api/history",
+    )
+    oparser.add_argument(
+        "--thumbnail-size",
+        type=int,
+        help="Maximum width and height of thumbnails of generations in /api/history",
+        default=256,
     )
-    return oparser.parse_args()
+    return oparser.parse_args(args)
 
 
 def main() -> None:
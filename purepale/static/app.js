@@ -44,6 +44,7 @@ async function get_query(vue) {
 
   const q = {
     model: deep_copy(vue.model_id),
+    num_images: Math.max(1, Number(vue.num_images)),
     parameters: deep_copy(vue.parameters),
     path_initial_image: deep_copy(vue.path_initial_image),
     path_initial_image_mask: deep_copy(vue.path_initial_image_mask),
@@ -58,6 +59,42 @@ async function get_query(vue) {
   return q;
 }
 
+//a result of each image
+function split_response(response) {
+  if (response.paths.length <= 1) {
+    return [response];
+  }
+  return response.paths.map((path, i) => {
+    const r = deep_copy(response);
+    r.path = path;
+    r.paths = [path];
+    r.seeds = [response.seeds[i]];
+    r.request.parameters.seed = response.seeds[i];
+    r.request.num_images = 1;
+    r.request.seeds = [response.seeds[i]];
+    return r;
+  });
+}
+
+function wait_job(job_id, on_progress) {
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(`/api/jobs/${job_id}/events`);
+    source.onmessage = (event) => {
+      const status = JSON.parse(event.data);
+      if (status.state === "queued" || status.state === "running") {
+        on_progress(status);
+        return;
+      }
+      source.close();
+      resolve(status);
+    };
+    source.onerror = (error) => {
+      source.close();
+      reject(error);
+    };
+  });
+}
+
 function disable_input(st) {
   const inputs = document.querySelectorAll("input,textarea,select,button");
   for (const inp of inputs) {
@@ -79,7 +116,9 @@ document.addEventListener("DOMContentLoaded", (event) => {
     data: () => ({
       model_id: "",
       supported_models: [],
+      supported_schedulers: [],
       parameters: {},
+      num_images: 1,
       results: [],
       finished: true,
       contorol_repeat: false,
@@ -88,6 +127,9 @@ document.addEventListener("DOMContentLoaded", (event) => {
 
       use_image_mask: false,
       path_initial_image_mask: null,
+      current_job_id: null,
+      history_offset: 0,
+      history_total: null,
     }),
 
     watch: {
@@ -101,6 +143,13 @@ document.addEventListener("DOMContentLoaded", (event) => {
       path_initial_image: function () {
         this.use_image_mask = false;
       },
+      "parameters.scheduler": function (new_val) {
+        for (const v of this.supported_schedulers) {
+          if (v.name === new_val) {
+            this.parameters.num_inference_steps = v.default_steps;
+          }
+        }
+      },
     },
     methods: {
       set_default_parameters: function (dparams) {
@@ -139,20 +188,38 @@ document.addEventListener("DOMContentLoaded", (event) => {
         this.finished = false;
 
         await axios
-          .post("/api/generate", query)
+          .post("/api/jobs", query)
           .then((response) => {
-            this.results[0] = response.data;
-            if (response.data.parsed_prompt.used_prompt_truncated.length > 0) {
-              const tp = response.data.parsed_prompt.used_prompt_truncated;
-              this.results[0].error = `Truncated prompt: ${tp}`;
+            this.current_job_id = response.data.id;
+            return wait_job(response.data.id, (status) => {
+              this.results[0].progress = `${status.step} / ${status.total_steps}`;
+              this.results.splice();
+            });
+          })
+          .then((status) => {
+            if (status.state !== "finished") {
+              this.results[0].error = status.error || status.state;
+              this.contorol_repeat = false;
+              return;
+            }
+            const responses = split_response(status.response);
+            for (const r of responses) {
+              if (r.parsed_prompt.used_prompt_truncated.length > 0) {
+                const tp = r.parsed_prompt.used_prompt_truncated;
+                r.error = `Truncated prompt: ${tp}`;
+              }
             }
+            this.results.splice(0, 1, ...responses);
           })
           .catch((error) => {
-            this.results[0].error = error.response.data.detail;
+            this.results[0].error = error.response
+              ? error.response.data.detail
+              : `${error}`;
             this.contorol_repeat = false;
             console.log(error);
           })
           .finally(() => {
+            this.current_job_id = null;
             this.finished = true;
             this.results.splice();
             disable_input(false);
@@ -206,6 +273,7 @@ document.addEventListener("DOMContentLoaded", (event) => {
         }
 
         delete r.path;
+        delete r.thumbnail;
 
         {
           if (r.request.path_initial_image_mask !== null) {
@@ -221,6 +289,28 @@ document.addEventListener("DOMContentLoaded", (event) => {
         alert("Copied JSON to clipbord!");
       },
 
+      load_history: async function () {
+        await axios
+          .get("/api/history", {
+            params: { offset: this.history_offset, limit: 20 },
+          })
+          .then((response) => {
+            const paths = new Set(this.results.map((r) => r.path));
+            for (const item of response.data.items) {
+              // Results of this session are also in the history
+              if (!paths.has(item.response.path)) {
+                item.response.thumbnail = item.thumbnail;
+                this.results.push(item.response);
+              }
+            }
+            this.history_offset += response.data.items.length;
+            this.history_total = response.data.total;
+          })
+          .catch((error) => {
+            alert(`Error: ${error.message}`);
+          });
+      },
+
       action_img2prompt: async function () {
         const query = {
           path: this.path_initial_image,
@@ -307,6 +397,16 @@ document.addEventListener("DOMContentLoaded", (event) => {
     },
   }).mount("#app");
 
+  //stop the running job when the page is closed
+  window.addEventListener("pagehide", () => {
+    if (vue.current_job_id !== null) {
+      fetch(`/api/jobs/${vue.current_job_id}`, {
+        method: "DELETE",
+        keepalive: true,
+      });
+    }
+  });
+
   //set default
   axios
     .get("/api/info")
@@ -317,6 +417,9 @@ document.addEventListener("DOMContentLoaded", (event) => {
       }
       vue.supported_models.splice();
       vue.model_id = vue.supported_models[0];
+      for (v of response.data.supported_schedulers) {
+        vue.supported_schedulers.push(v);
+      }
     })
     .catch((error) => {
       alert(`Error: ${error.message}`);
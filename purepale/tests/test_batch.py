@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import json
+from pathlib import Path
+from typing import Dict, List
+from unittest import mock
+
+import numpy as np
+import PIL.Image
+
+from purepale.batch import BatchEntry, get_opts, load_entries, main
+from purepale.output import split_request
+from purepale.prompt import Prompt
+from purepale.schema import Parameters, WebRequest
+from purepale.tests.util import TempDirTestCase, get_tiny_model, get_web_request, write_result
+
+PROMPTS: str = """# Comment
+a {red|blue|green} hat --random
+
+a cat
+"""
+
+RANDOM_PROMPT: str = "a {red|blue|green} hat --random"
+
+
+class TestSplitRequest(TempDirTestCase):
+    def test_used_prompts(self):
+        request = WebRequest(model="m", parameters=Parameters(prompt=RANDOM_PROMPT), seeds=[1, 2, 3])
+        used: List[str] = [Prompt(original=f"a {color} hat --random")() for color in ["green", "red"]]
+        requests: List[WebRequest] = split_request(request, used_prompts=[*used, None])
+        self.assertEqual([r.seeds for r in requests], [[1], [2], [3]])
+        self.assertEqual([r.parameters.seed for r in requests], [1, 2, 3])
+        # Words of each image are fixed, which makes the request cacheable
+        self.assertEqual([Prompt(original=r.parameters.prompt)() for r in requests[:2]], used)
+        self.assertRegex(requests[2].parameters.prompt, r"^a (red|blue|green) hat\s*$")
+        self.assertEqual(split_request(request)[2], requests[2])
+
+
+class TestLoadEntries(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path_prompts = self.path_dir.joinpath("prompts.txt")
+        self.path_prompts.write_text(PROMPTS)
+
+    def _load(self, *args: str) -> List[BatchEntry]:
+        argv: List[str] = ["purepale-batch", *args, "--output", str(self.path_dir.joinpath("out"))]
+        with mock.patch("sys.argv", argv):
+            return load_entries(get_opts())
+
+    def test_prompt_file(self):
+        entries: List[BatchEntry] = self._load(
+            str(self.path_prompts), "--model", "m1", "--model", "m2", "-n", "3", "--seed", "10", "--steps", "5"
+        )
+        self.assertEqual(len(entries), 6)
+        self.assertEqual({e.request.model for e in entries}, {"m1"})
+        self.assertEqual({e.request.parameters.num_inference_steps for e in entries}, {5})
+        self.assertEqual(sorted(e.request.parameters.seed for e in entries), list(range(10, 16)))
+        for entry in entries:
+            self.assertEqual(entry.request.seeds, [entry.request.parameters.seed])
+            self.assertEqual(entry.request.num_images, 1)
+
+        prompts: List[str] = [e.request.parameters.prompt for e in entries]
+        self.assertEqual(prompts.count("a cat"), 3)
+        for prompt in [p for p in prompts if p != "a cat"]:
+            self.assertRegex(prompt, r"^a (red|blue|green) hat\s*$")
+            self.assertFalse(Prompt(original=prompt).enable_replace)
+
+    def test_rerun(self):
+        # Without seeds, the same inputs make the same entries, which are skipped when generated
+        names: List[str] = [e.name for e in self._load(str(self.path_prompts), "--model", "m", "-n", "2")]
+        self.assertEqual(len(set(names)), 4)
+        self.assertEqual(names, [e.name for e in self._load(str(self.path_prompts), "--model", "m", "-n", "2")])
+
+    def test_model_required(self):
+        with self.assertRaises(ValueError):
+            self._load(str(self.path_prompts))
+
+    def test_log(self):
+        path_logs: Path = self.path_dir.joinpath("logs")
+        path_logs.mkdir()
+        used_prompt: str = Prompt(original="a green hat --random")()
+        write_result(path_logs, "used", nbytes=1, model="m", prompt=RANDOM_PROMPT, seed=1, used_prompt=used_prompt)
+        write_result(path_logs, "unknown", nbytes=1, model="m", prompt=RANDOM_PROMPT, seed=2, used_prompt="a dog")
+
+        entries: List[BatchEntry] = self._load(str(path_logs))
+        prompts: Dict[int, str] = {e.request.parameters.seed: e.request.parameters.prompt for e in entries}
+        # Words used in logs are recovered
+        self.assertEqual(Prompt(original=prompts[1])(), used_prompt)
+        self.assertRegex(prompts[2], r"^a (red|blue|green) hat\s*$")
+
+    def test_sorted_by_batch(self):
+        path_jsonl: Path = self.path_dir.joinpath("requests.jsonl")
+        with path_jsonl.open("w") as outf:
+            for i, (model, steps) in enumerate([("m1", 5), ("m2", 5), ("m1", 3), ("m1", 5), ("m2", 5)]):
+                outf.write(json.dumps({"model": model, "parameters": {"num_inference_steps": steps, "seed": i}}))
+                outf.write("\n")
+
+        keys = [e.group_key for e in self._load(str(path_jsonl))]
+        # Entries of the same batch key are adjacent
+        runs = [k for i, k in enumerate(keys) if i == 0 or keys[i - 1] != k]
+        self.assertEqual(len(runs), len(set(keys)))
+        self.assertEqual(len(runs), 3)
+
+
+class TestReplay(TempDirTestCase):
+    def test_replay(self):
+        model: str = get_tiny_model()
+        client = self.get_client()
+        request = get_web_request(0, model=model, prompt=RANDOM_PROMPT)
+        request["num_images"] = 3
+        resp = client.post("/api/generate", json=request)
+        self.assertEqual(resp.status_code, 200)
+        for path in resp.json()["paths"]:
+            self.assertEqual(client.get(f"/{path}").status_code, 200)
+
+        path_logs: List[Path] = sorted(self.path_dir.glob("*.json"))
+        self.assertEqual(len(path_logs), 3)
+        for path_log in path_logs:
+            log = json.loads(path_log.read_text())
+            # Logs of images have the words which are used
+            self.assertEqual(
+                Prompt(original=log["request"]["parameters"]["prompt"])(), log["parsed_prompt"]["used_prompt"]
+            )
+
+        path_out: Path = self.path_dir.joinpath("replay")
+        argv: List[str] = ["purepale-batch", str(self.path_dir), "--output", str(path_out), "--local", "--no-safety"]
+        with mock.patch("sys.argv", argv):
+            main()
+        for path_log in path_logs:
+            log = json.loads(path_log.read_text())
+            replayed = [
+                json.loads(p.read_text())
+                for p in path_out.glob("*.json")
+                if json.loads(p.read_text())["seeds"] == log["seeds"]
+            ]
+            self.assertEqual(len(replayed), 1)
+            self.assertEqual(replayed[0]["parsed_prompt"]["used_prompt"], log["parsed_prompt"]["used_prompt"])
+            with PIL.Image.open(self.path_dir.joinpath(Path(log["path"]).name)) as image:
+                expected = np.asarray(image, dtype=int)
+            with PIL.Image.open(path_out.joinpath(Path(replayed[0]["path"]).name)) as image:
+                self.assertLessEqual(np.abs(np.asarray(image, dtype=int) - expected).max(), 1)
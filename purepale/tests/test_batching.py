@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError
+from contextlib import contextmanager
+from typing import Iterator, List, Set
+
+import numpy as np
+
+from purepale.batching import BatchJob, BatchScheduler, FairShare
+from purepale.options import get_batch_scheduler
+from purepale.pipes import GenerationCancelled
+from purepale.schema import PipesRequest
+from purepale.tests.util import get_pipes_opts, get_request, get_tiny_model
+
+
+class TestFairShare(unittest.TestCase):
+    def test_order(self):
+        fair_share = FairShare()
+        jobs: List[BatchJob] = [
+            BatchJob(request=get_request(0), priority=0, on_progress=None, client="busy"),
+            BatchJob(request=get_request(1), priority=0, on_progress=None, client="idle"),
+            BatchJob(request=get_request(2), priority=1, on_progress=None, client="busy"),
+        ]
+        for job in jobs:
+            fair_share.join(job)
+        fair_share.charge("busy", 100.0)
+        self.assertEqual(sorted(jobs, key=fair_share.order), [jobs[2], jobs[1], jobs[0]])
+
+        # A client coming back does not get credit for being idle
+        for job in jobs[1:]:
+            job.future.set_result([])
+        comeback = BatchJob(request=get_request(3), priority=0, on_progress=None, client="idle")
+        fair_share.join(comeback)
+        self.assertEqual(fair_share.order(comeback)[1], fair_share.order(jobs[0])[1])
+
+
+class TestBatchScheduler(unittest.TestCase):
+    def setUp(self):
+        self.model: str = get_tiny_model()
+
+    def _get_scheduler(self, *args: str) -> BatchScheduler:
+        scheduler = get_batch_scheduler(get_pipes_opts(*args), models=[self.model], replicas=0)
+        assert isinstance(scheduler, BatchScheduler)
+        self.addCleanup(scheduler.close)
+        return scheduler
+
+    def _record_batch_sizes(self, scheduler: BatchScheduler) -> List[int]:
+        """Record the number of images of each batch."""
+        sizes: List[int] = []
+        with scheduler.registry.use(self.model) as pipes:
+            generate_batch = pipes.generate_batch
+
+            def record(*, requests, **kwargs):
+                sizes.append(sum(len(request.get_seeds()) for request in requests))
+                return generate_batch(requests=requests, **kwargs)
+
+            pipes.generate_batch = record  # type: ignore
+        return sizes
+
+    def test_batch(self):
+        scheduler = self._get_scheduler("--batch-window-ms", "200", "--max-batch", "2")
+        sizes: List[int] = self._record_batch_sizes(scheduler)
+        jobs: List[BatchJob] = [scheduler.submit(model=self.model, request=get_request(seed)) for seed in range(3)]
+        batched = [np.asarray(job.future.result()[0][0], dtype=int) for job in jobs]
+        self.assertEqual(sorted(sizes), [1, 2])
+
+        # Each image depends only on its request
+        for seed, image in enumerate(batched):
+            single = np.asarray(scheduler.generate(model=self.model, request=get_request(seed))[0][0], dtype=int)
+            self.assertLessEqual(np.abs(image - single).max(), 1)
+
+    def test_incompatible_requests(self):
+        scheduler = self._get_scheduler("--batch-window-ms", "200", "--max-batch", "4")
+        sizes: List[int] = self._record_batch_sizes(scheduler)
+        jobs: List[BatchJob] = [
+            scheduler.submit(model=self.model, request=get_request(0)),
+            scheduler.submit(model=self.model, request=get_request(1, steps=2)),
+        ]
+        for job in jobs:
+            job.future.result()
+        self.assertEqual(sizes, [1, 1])
+
+    def test_chunks(self):
+        scheduler = self._get_scheduler("--max-batch", "2")
+        sizes: List[int] = self._record_batch_sizes(scheduler)
+        request = get_request(0)
+        request.seeds = [3, 1, 4, 1, 5]
+        progress: List[int] = []
+        job: BatchJob = scheduler.submit(
+            model=self.model, request=request, on_progress=lambda j: progress.append(j.step)
+        )
+        results = job.future.result()
+        self.assertEqual(sorted(sizes), [1, 2, 2])
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(job.step, job.total_steps)
+
+        # Images are in the order of seeds
+        self.assertEqual(len(results), 5)
+        for seed, (image, _) in zip(request.seeds, results):
+            single = np.asarray(scheduler.generate(model=self.model, request=get_request(seed))[0][0], dtype=int)
+            self.assertLessEqual(np.abs(np.asarray(image, dtype=int) - single).max(), 1)
+
+    def test_cancel_chunks(self):
+        scheduler = self._get_scheduler()
+        progress = threading.Event()
+        request = get_request(0, steps=50)
+        request.seeds = [0, 1, 2]
+        running: BatchJob = scheduler.submit(model=self.model, request=request, on_progress=lambda job: progress.set())
+        self.assertTrue(progress.wait(timeout=60))
+        queued: BatchJob = scheduler.submit(model=self.model, request=get_request(1))
+        request = get_request(2)
+        request.seeds = [0, 1]
+        queued_chunks: BatchJob = scheduler.submit(model=self.model, request=request)
+        # Shorter jobs run first, so only the other queued job is ahead
+        self.assertEqual(scheduler.queue_position(queued_chunks), 1)
+
+        scheduler.cancel(queued_chunks)
+        with self.assertRaises(CancelledError):
+            queued_chunks.future.result()
+        scheduler.cancel(running)
+        with self.assertRaises(GenerationCancelled):
+            running.future.result()
+        self.assertEqual(len(queued.future.result()), 1)
+
+    def test_cancel(self):
+        scheduler = self._get_scheduler()
+        progress = threading.Event()
+        running: BatchJob = scheduler.submit(
+            model=self.model,
+            request=get_request(0, steps=50),
+            on_progress=lambda job: progress.set(),
+        )
+        self.assertTrue(progress.wait(timeout=60))
+        # Queued while the only batch in progress runs
+        queued: BatchJob = scheduler.submit(model=self.model, request=get_request(1))
+        self.assertEqual(scheduler.queue_position(queued), 0)
+
+        scheduler.cancel(queued)
+        with self.assertRaises(CancelledError):
+            queued.future.result()
+        scheduler.cancel(running)
+        with self.assertRaises(GenerationCancelled):
+            running.future.result()
+        self.assertLess(running.step, 50)
+
+
+class _FakeRegistry:
+    """Registry of models which fit in memory one at a time, whose batches take a while."""
+
+    models: List[str] = ["a", "b"]
+
+    def __init__(self):
+        self.resident: Set[str] = set()
+        self.in_use: Set[str] = set()
+        self.max_in_use: int = 0
+        self._lock = threading.Lock()
+
+    @property
+    def resident_models(self) -> List[str]:
+        with self._lock:
+            return list(self.resident)
+
+    @contextmanager
+    def use(self, model: str) -> Iterator["_FakeRegistry"]:
+        with self._lock:
+            self.in_use.add(model)
+            self.max_in_use = max(self.max_in_use, len(self.in_use))
+            if model not in self.resident:
+                self.resident = {model}
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self.in_use.discard(model)
+
+    def generate_batch(self, *, requests: List[PipesRequest], callback):
+        for step in range(3):
+            time.sleep(0.05)
+            callback(step + 1, 3)
+        return [[] for _ in requests]
+
+
+class TestInflightBatches(unittest.TestCase):
+    def _run(self, registry: _FakeRegistry) -> None:
+        scheduler = BatchScheduler(
+            registry=registry,  # type: ignore
+            window_ms=0,
+            max_batch=1,
+            max_process=1,
+            max_inflight=4,
+        )
+        self.addCleanup(scheduler.close)
+        jobs: List[BatchJob] = [scheduler.submit(model=model, request=get_request(0)) for model in ["a", "b", "a"]]
+        for job in jobs:
+            job.future.result()
+
+    def test_not_resident(self):
+        # Batches of models which are not loaded wait for others, which keeps the memory budget
+        registry = _FakeRegistry()
+        self._run(registry)
+        self.assertEqual(registry.max_in_use, 1)
+
+    def test_resident(self):
+        registry = _FakeRegistry()
+        registry.resident = {"a", "b"}
+        self._run(registry)
+        self.assertEqual(registry.max_in_use, 2)
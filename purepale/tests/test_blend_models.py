@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import json
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.blend_models import blend_checkpoints, open_checkpoint, operation
+from purepale.tests.util import TempDirTestCase
+
+
+def _save_safetensors(state_dict: Dict[str, torch.Tensor], path: Path) -> None:
+    header: Dict[str, Dict] = {}
+    data: List[bytes] = []
+    offset: int = 0
+    for name, tensor in state_dict.items():
+        b: bytes = tensor.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+        dtype: str = {torch.float32: "F32", torch.float16: "F16", torch.int64: "I64"}[tensor.dtype]
+        header[name] = {"dtype": dtype, "shape": list(tensor.shape), "data_offsets": [offset, offset + len(b)]}
+        data.append(b)
+        offset += len(b)
+    encoded: bytes = json.dumps(header).encode("utf8")
+    path.write_bytes(len(encoded).to_bytes(8, "little") + encoded + b"".join(data))
+
+
+class TestBlendModels(TempDirTestCase):
+    def _get_state_dicts(self) -> List[Dict[str, torch.Tensor]]:
+        state_dicts: List[Dict[str, torch.Tensor]] = []
+        for seed in range(3):
+            generator = torch.Generator().manual_seed(seed)
+            state_dicts.append(
+                {
+                    "weight": torch.randn(4, 3, generator=generator),
+                    # Not contiguous in the file
+                    "weight_t": torch.randn(3, 5, generator=generator).t(),
+                    "half": torch.randn(2, generator=generator).half(),
+                    "empty": torch.zeros(0),
+                    "position_ids": torch.arange(4) + seed,
+                }
+            )
+        return state_dicts
+
+    def _blend(self, paths: List[Path], weights: List[float], *, num_workers: int) -> Dict[str, torch.Tensor]:
+        path_out: Path = self.path_dir.joinpath(f"out{num_workers}.bin")
+        blend_checkpoints(paths=paths, weights=weights, path_out=path_out, dtype=torch.float32, num_workers=num_workers)
+        return torch.load(path_out)
+
+    def test_blend_checkpoints(self):
+        state_dicts = self._get_state_dicts()
+        paths: List[Path] = [self.path_dir.joinpath("0.bin"), self.path_dir.joinpath("1.safetensors")]
+        torch.save(state_dicts[0], paths[0])
+        _save_safetensors({k: v.contiguous() for k, v in state_dicts[1].items()}, paths[1])
+        paths.append(self.path_dir.joinpath("2.bin"))
+        torch.save(state_dicts[2], paths[2])
+
+        with ExitStack() as stack:
+            for path, state_dict in zip(paths, state_dicts):
+                tensors = open_checkpoint(path, stack=stack)
+                for name, tensor in state_dict.items():
+                    self.assertTrue(torch.equal(tensors[name].load(), tensor), name)
+
+        weights: List[float] = [0.5, 0.3, 0.2]
+        for num_workers in [1, 2]:
+            blended: Dict[str, torch.Tensor] = self._blend(paths, weights, num_workers=num_workers)
+            self.assertEqual(list(blended.keys()), list(state_dicts[0].keys()))
+            for name in ["weight", "weight_t", "half", "empty"]:
+                expected = sum(w * sd[name].float() for w, sd in zip(weights, state_dicts))
+                self.assertEqual(blended[name].dtype, torch.float32)
+                self.assertTrue(torch.allclose(blended[name], expected), name)
+            # Tensors other than floating point ones are of the first model
+            self.assertTrue(torch.equal(blended["position_ids"], state_dicts[0]["position_ids"]))
+
+    def test_shape_mismatch(self):
+        paths: List[Path] = [self.path_dir.joinpath("0.bin"), self.path_dir.joinpath("1.bin")]
+        torch.save({"weight": torch.zeros(2)}, paths[0])
+        torch.save({"weight": torch.zeros(3)}, paths[1])
+        with self.assertRaises(ValueError):
+            self._blend(paths, [0.5, 0.5], num_workers=1)
+
+    def test_operation(self):
+        path_models: List[Path] = [
+            build_tiny_model(self.path_dir.joinpath(f"tiny{seed}"), seed=seed) for seed in range(2)
+        ]
+        path_out: Path = self.path_dir.joinpath("blended")
+        operation([str(p) for p in path_models], [0.25, 0.75], path_out, text_encoder=True, local_files_only=True)
+
+        self.assertEqual(
+            path_out.joinpath("scheduler", "scheduler_config.json").read_text(),
+            path_models[0].joinpath("scheduler", "scheduler_config.json").read_text(),
+        )
+        for component, name in [
+            ("unet", "diffusion_pytorch_model.bin"),
+            ("vae", "diffusion_pytorch_model.bin"),
+            ("text_encoder", "pytorch_model.bin"),
+        ]:
+            inputs = [torch.load(p.joinpath(component, name)) for p in path_models]
+            blended: Dict[str, torch.Tensor] = torch.load(path_out.joinpath(component, name))
+            for key, tensor in blended.items():
+                if tensor.dtype.is_floating_point:
+                    # Accumulated in fp32 and saved in the dtype of the first model
+                    expected = (0.25 * inputs[0][key].float() + 0.75 * inputs[1][key].float()).to(tensor.dtype)
+                    self.assertTrue(torch.equal(tensor, expected), key)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import tempfile
+import time
+import unittest
+from concurrent.futures import Future
+from io import BytesIO
+from pathlib import Path
+from typing import Any, List
+
+import PIL.Image
+import torch
+
+from purepale.benchmark.blip import build_tiny_model
+from purepale.blip import BLIP, BLIPBatcher, CaptionOptions
+from purepale.cache import get_tensor_cache
+from purepale.third_party.blip.blip import BLIP_Decoder
+
+
+def _get_images(num: int) -> List[PIL.Image.Image]:
+    colors = [(0, 0, 0), (255, 0, 0), (0, 0, 255)]
+    return [PIL.Image.new("RGB", (32 + 8 * i, 48), colors[i % len(colors)]) for i in range(num)]
+
+
+def _build_model() -> Any:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        blip_model = build_tiny_model(Path(tmpdir))
+    # Amplify image embeddings so that captions depend on images
+    with torch.no_grad():
+        blip_model.visual_encoder.norm.weight.fill_(20.0)
+    return blip_model
+
+
+class TestCaptionDecoder(unittest.TestCase):
+    def test_same_as_reference(self):
+        blip_model = _build_model()
+        model = BLIP("cpu", blip_model)
+        images: List[torch.Tensor] = [model.preprocess(image) for image in _get_images(3)]
+        sep_bias = blip_model.text_decoder.cls.predictions.bias[blip_model.tokenizer.sep_token_id]
+        # Captions end early with a larger bias of the end of sentences
+        for bias in [0.0, 0.25]:
+            with torch.no_grad():
+                sep_bias.fill_(bias)
+            for num_beams in [1, 2, 3]:
+                with torch.no_grad():
+                    expected: List[str] = BLIP_Decoder.generate(
+                        blip_model, torch.stack(images), sample=False, num_beams=num_beams, max_length=20, min_length=5
+                    )
+                self.assertEqual(
+                    model.predict_batch(images, CaptionOptions(num_beams=num_beams)), expected, (bias, num_beams)
+                )
+
+
+class TestBLIPBatcher(unittest.TestCase):
+    blip_model: Any
+
+    @classmethod
+    def setUpClass(cls):
+        cls.blip_model = _build_model()
+
+    def _get_batcher(self, *, window_ms: int, max_batch: int, **kwargs) -> BLIPBatcher:
+        batcher = BLIPBatcher(model=BLIP("cpu", self.blip_model), window_ms=window_ms, max_batch=max_batch, **kwargs)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def _record_batch_sizes(self, batcher: BLIPBatcher) -> List[int]:
+        sizes: List[int] = []
+        decode = batcher.model.decode
+
+        def record(image_embeds: torch.Tensor, options: CaptionOptions = CaptionOptions()) -> List[str]:
+            sizes.append(len(image_embeds))
+            return decode(image_embeds, options)
+
+        batcher.model.decode = record  # type: ignore
+        return sizes
+
+    def test_batch(self):
+        images: List[PIL.Image.Image] = _get_images(3)
+        model = BLIP("cpu", self.blip_model)
+        expected: List[str] = [model.predict(image) for image in images]
+        self.assertEqual(len(set(expected)), len(images))
+
+        batcher = self._get_batcher(window_ms=200, max_batch=2)
+        sizes: List[int] = self._record_batch_sizes(batcher)
+        self.assertEqual(batcher.predict_many(images), expected)
+        self.assertEqual(sorted(sizes), [1, 2])
+
+    def test_options(self):
+        images: List[PIL.Image.Image] = _get_images(2)
+        model = BLIP("cpu", self.blip_model)
+        greedy = CaptionOptions(num_beams=1)
+
+        batcher = self._get_batcher(window_ms=200, max_batch=4)
+        sizes: List[int] = self._record_batch_sizes(batcher)
+        futures: List["Future[str]"] = batcher.submit_many(images[:1]) + batcher.submit_many(images[1:], greedy)
+        self.assertEqual(
+            [future.result() for future in futures],
+            [model.predict(images[0]), model.predict(images[1], greedy)],
+        )
+        # Images with different options are not captioned together
+        self.assertEqual(sizes, [1, 1])
+
+    def test_embedding_cache(self):
+        images: List[PIL.Image.Image] = _get_images(2)
+        model = BLIP("cpu", self.blip_model)
+        expected: List[str] = [model.predict(image) for image in images]
+        datas: List[bytes] = []
+        for image in images:
+            buf = BytesIO()
+            image.save(buf, format="PNG")
+            datas.append(buf.getvalue())
+
+        cache = get_tensor_cache(1)
+        assert cache is not None
+        batcher = self._get_batcher(window_ms=0, max_batch=4, embedding_cache=cache)
+        num_encoded: List[int] = []
+        encode = batcher.model.encode
+
+        def record(images: List[torch.Tensor]) -> torch.Tensor:
+            num_encoded.append(len(images))
+            return encode(images)
+
+        batcher.model.encode = record  # type: ignore
+        self.assertEqual(batcher.predict_files(datas[:1]), expected[:1])
+        # Files of the same content share embeddings
+        self.assertEqual(batcher.predict_files([bytes(datas[0])]), expected[:1])
+        self.assertEqual(
+            batcher.predict_files(datas[:1], CaptionOptions(num_beams=1)),
+            [model.predict(images[0], CaptionOptions(num_beams=1))],
+        )
+        self.assertEqual((num_encoded, cache.stats().hits), ([1], 2))
+
+        # Prewarmed embeddings are used by later captions
+        batcher.prewarm(datas[1])
+        for _ in range(100):
+            if batcher.get_key(datas[1]) in cache:
+                break
+            time.sleep(0.1)
+        self.assertEqual(batcher.predict_files(datas), expected)
+        self.assertEqual(num_encoded, [1, 1])
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+from pathlib import Path
+from typing import List, Optional
+
+from purepale.cache import LRUCache, ResultCache
+from purepale.schema import WebResponse
+from purepale.tests.util import TempDirTestCase, write_result
+
+
+def _get_open_files() -> List[str]:
+    path_fd = Path("/proc/self/fd")
+    if not path_fd.exists():
+        raise unittest.SkipTest("Open files are not listed")
+    files: List[str] = []
+    for path in path_fd.iterdir():
+        try:
+            files.append(os.readlink(path))
+        except OSError:
+            pass
+    return files
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evict_by_bytes(self):
+        cache: LRUCache[bytes] = LRUCache(max_bytes=10, get_size=len)
+        cache.put("a", b"a" * 4)
+        cache.put("b", b"b" * 4)
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", b"c" * 4)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        stats = cache.stats()
+        self.assertEqual((stats.hits, stats.entries, stats.bytes), (1, 2, 8))
+
+        # A value larger than the limit is not cached
+        cache.put("d", b"d" * 11)
+        self.assertNotIn("d", cache)
+        self.assertEqual(len(cache), 2)
+
+
+class TestResultCache(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path_index: Path = self.path_dir.joinpath(".result_cache.sqlite3")
+
+    def _open(self, *, max_entries: int = 100, max_bytes: int = 0) -> ResultCache:
+        return self.closing(
+            ResultCache(
+                path_out=self.path_dir, path_index=self.path_index, max_entries=max_entries, max_bytes=max_bytes
+            )
+        )
+
+    def _put(self, cache: ResultCache, name: str, *, nbytes: int = 10) -> None:
+        path_log: Path = write_result(self.path_dir, name, nbytes=nbytes)
+        cache.put(name, path_log=path_log, path_image=self.path_dir.joinpath(f"{name}.png"))
+
+    def _get_prompt(self, cache: ResultCache, key: str) -> Optional[str]:
+        resp: Optional[WebResponse] = cache.get(key)
+        return None if resp is None else resp.request.parameters.prompt
+
+    def test_get(self):
+        cache = self._open()
+        self._put(cache, "a")
+        self.assertEqual(self._get_prompt(cache, "a"), "a")
+        self.assertIsNone(cache.get("b"))
+        stats = cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.entries, stats.bytes), (1, 1, 1, 10))
+
+    def test_evict_by_entries(self):
+        cache = self._open(max_entries=2)
+        self._put(cache, "a")
+        self._put(cache, "b")
+        cache.get("a")
+        self._put(cache, "c")
+        self.assertEqual(self._get_prompt(cache, "a"), "a")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(self._get_prompt(cache, "c"), "c")
+        # Evicted entries keep their files
+        self.assertTrue(self.path_dir.joinpath("b.png").exists())
+
+    def test_evict_by_bytes(self):
+        cache = self._open(max_bytes=25)
+        self._put(cache, "a")
+        self._put(cache, "b")
+        cache.get("a")
+        self._put(cache, "c")
+        self.assertIsNone(cache.get("b"))
+        stats = cache.stats()
+        self.assertEqual((stats.entries, stats.bytes, stats.max_bytes), (2, 20, 25))
+
+        # An entry larger than the limit does not stay
+        self._put(cache, "d", nbytes=30)
+        self.assertEqual(cache.stats().entries, 0)
+
+    def test_persistence(self):
+        cache = self._open()
+        for name in ["a", "b", "c"]:
+            self._put(cache, name)
+        cache.get("a")
+        cache.close()
+
+        # The LRU order is restored, and smaller limits evict least recently used entries
+        cache = self._open(max_entries=2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(self._get_prompt(cache, "c"), "c")
+        self.assertEqual(self._get_prompt(cache, "a"), "a")
+        self.assertEqual(cache.stats().bytes, 20)
+
+    def test_removed_files(self):
+        cache = self._open()
+        self._put(cache, "a")
+        self.path_dir.joinpath("a.png").unlink()
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats().entries, 0)
+
+    def test_broken_index(self):
+        self.path_index.write_bytes(b"broken" * 100)
+        path_wal: Path = Path(f"{self.path_index}-wal")
+        path_wal.write_bytes(b"broken" * 100)
+        with self.assertLogs("purepale.cache", level="ERROR"):
+            cache = self._open()
+        self.assertNotEqual(path_wal.read_bytes() if path_wal.exists() else b"", b"broken" * 100)
+        # The connection to the broken index is closed
+        self.assertNotIn(f"{self.path_index} (deleted)", _get_open_files())
+        self._put(cache, "a")
+        self.assertEqual(self._get_prompt(cache, "a"), "a")
+        cache.close()
+
+        cache = self._open()
+        self.assertEqual(self._get_prompt(cache, "a"), "a")
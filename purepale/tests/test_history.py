@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import datetime
+from pathlib import Path
+from typing import List
+
+import PIL.Image
+
+from purepale.history import HistoryIndex
+from purepale.output import get_sidecar_path
+from purepale.schema import HistoryResponse
+from purepale.tests.util import TempDirTestCase, get_response, get_tiny_model, get_web_request, write_result
+
+
+class TestHistoryIndex(TempDirTestCase):
+    def _open(self) -> HistoryIndex:
+        return self.closing(
+            HistoryIndex(path_out=self.path_dir, path_db=self.path_dir.joinpath(".history.sqlite3"), thumbnail_size=16)
+        )
+
+    def _add(self, history: HistoryIndex, name: str, **kwargs) -> None:
+        image = PIL.Image.new("RGB", (32, 32))
+        image.save(self.path_dir.joinpath(f"{name}.png"))
+        history.add(get_response(name, **kwargs), name=name, image=image)
+
+    @staticmethod
+    def _names(resp: HistoryResponse) -> List[str]:
+        return [item.name for item in resp.items]
+
+    def test_search(self):
+        history = self._open()
+        self._add(history, "g1", model="m1", prompt="a red {hat|cap} --random", seed=1, used_prompt="a red hat")
+        self._add(history, "g2", model="m2", prompt="a cat", seed=2)
+        self._add(history, "g3", model="m1", prompt="100% blue_cat", seed=3)
+
+        # From the newest
+        self.assertEqual(self._names(history.search()), ["g3", "g2", "g1"])
+        self.assertEqual(self._names(history.search(model="m1")), ["g3", "g1"])
+        self.assertEqual(self._names(history.search(seed=2)), ["g2"])
+        self.assertEqual(self._names(history.search(model="m2", seed=1)), [])
+
+        # Substrings of original and used prompts, where % and _ are not wildcards
+        self.assertEqual(self._names(history.search(prompt="red hat")), ["g1"])
+        self.assertEqual(self._names(history.search(prompt="cat")), ["g3", "g2"])
+        self.assertEqual(self._names(history.search(prompt="0% b")), ["g3"])
+        self.assertEqual(self._names(history.search(prompt="e_c")), ["g3"])
+        self.assertEqual(self._names(history.search(prompt="a%t")), [])
+
+        resp = history.search(offset=1, limit=1)
+        self.assertEqual((self._names(resp), resp.total), (["g2"], 3))
+        now = datetime.datetime.now()
+        self.assertEqual(history.search(since=now).total, 0)
+        self.assertEqual(history.search(until=now).total, 3)
+
+        history.close()
+        for item in self._open().search().items:
+            assert item.thumbnail is not None
+            self.assertTrue(self.path_dir.joinpath("thumbnails", Path(item.thumbnail).name).exists())
+            self.assertEqual(item.response.request.parameters.seed, item.response.seeds[0])
+
+    def test_backfill(self):
+        for i in range(3):
+            name: str = f"log{i}"
+            write_result(self.path_dir, name, nbytes=0, model="m", prompt=f"prompt {i}", seed=i)
+            PIL.Image.new("RGB", (32, 32)).save(self.path_dir.joinpath(f"{name}.png"))
+        # Not logs of generations
+        self.path_dir.joinpath("other.json").write_text("[]")
+        self.path_dir.joinpath("broken.json").write_text("{")
+        get_sidecar_path(self.path_dir.joinpath("log0.jpg")).write_text(get_response("log0").json())
+
+        with self.assertLogs("purepale.history", level="WARNING"):
+            history = self._open()
+            history._backfill_thread.join()
+        self.assertEqual(sorted(self._names(history.search())), ["log0", "log1", "log2"])
+        self.assertEqual(self._names(history.search(prompt="prompt 1")), ["log1"])
+        self.assertTrue(all(item.thumbnail is not None for item in history.search().items))
+
+
+class TestHistoryAPI(TempDirTestCase):
+    def test_history(self):
+        model: str = get_tiny_model()
+        client = self.get_client()
+        for seed, prompt in enumerate(["a cat", "a dog"]):
+            resp = client.post("/api/generate", json=get_web_request(seed, model=model, prompt=prompt))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(client.get(f"/{resp.json()['path']}").status_code, 200)
+
+        history = client.get("/api/history", params={"prompt": "dog"}).json()
+        self.assertEqual(history["total"], 1)
+        self.assertEqual(history["items"][0]["response"]["request"]["parameters"]["seed"], 1)
+        self.assertEqual(client.get("/api/history", params={"limit": 1}).json()["total"], 2)
+        self.assertEqual(client.get("/api/history", params={"limit": 0}).status_code, 422)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import json
+import time
+from typing import Any, Dict, List
+
+from starlette.testclient import TestClient
+
+from purepale.tests.util import TempDirTestCase, get_tiny_model, get_web_request
+
+
+class TestJobs(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model: str = get_tiny_model()
+        # One batch at a time, so that later jobs stay queued
+        self.client: TestClient = self.get_client("--max-inflight", "1")
+
+    def _submit(self, seed: int, *, steps: int = 3) -> str:
+        resp = self.client.post("/api/jobs", json=get_web_request(seed, model=self.model, steps=steps))
+        self.assertEqual(resp.status_code, 200)
+        return resp.json()["id"]
+
+    def _wait(self, job_id: str, state: str) -> Dict[str, Any]:
+        for _ in range(600):
+            status: Dict[str, Any] = self.client.get(f"/api/jobs/{job_id}").json()
+            if status["state"] == state:
+                return status
+            time.sleep(0.1)
+        raise TimeoutError(f"{job_id} is not {state}")
+
+    def _events(self, job_id: str) -> List[Dict[str, Any]]:
+        resp = self.client.get(f"/api/jobs/{job_id}/events")
+        self.assertEqual(resp.headers["content-type"].split(";")[0], "text/event-stream")
+        return [json.loads(line[len("data: ") :]) for line in resp.text.splitlines() if line.startswith("data: ")]
+
+    def test_finished(self):
+        job_id: str = self._submit(0)
+        events = self._events(job_id)
+        # The stream ends with the terminal event
+        self.assertEqual(events[-1]["state"], "finished")
+        self.assertTrue(all(e["state"] != "finished" for e in events[:-1]))
+        path: str = events[-1]["response"]["path"]
+        self.assertEqual(self.client.get(f"/{path}").status_code, 200)
+        self.assertEqual(self.client.get(f"/api/jobs/{job_id}").json()["state"], "finished")
+
+    def test_cancel(self):
+        running: str = self._submit(0, steps=100)
+        self._wait(running, "running")
+        queued: str = self._submit(1)
+        self.assertEqual(self.client.get(f"/api/jobs/{queued}").json()["queue_position"], 0)
+
+        self.assertEqual(self.client.delete(f"/api/jobs/{queued}").json()["state"], "cancelled")
+        self.assertEqual([e["state"] for e in self._events(queued)], ["cancelled"])
+
+        self.client.delete(f"/api/jobs/{running}")
+        status: Dict[str, Any] = self._wait(running, "cancelled")
+        self.assertLess(status["step"], 100)
+        self.assertIsNone(status["response"])
+        self.assertEqual(self._events(running)[-1]["state"], "cancelled")
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get("/api/jobs/unknown").status_code, 404)
+        self.assertEqual(self.client.delete("/api/jobs/unknown").status_code, 404)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+from typing import Dict
+
+from starlette.testclient import TestClient
+
+from purepale.tests.util import TempDirTestCase, get_tiny_model, get_web_request
+
+
+class TestMetrics(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model: str = get_tiny_model()
+        self.client: TestClient = self.get_client("--result-cache-entries", "10")
+
+    def _get_metrics(self) -> Dict[str, float]:
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["content-type"].split(";")[0], "text/plain")
+        samples: Dict[str, float] = {}
+        for line in resp.text.splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_generate(self):
+        labels: str = f'endpoint="generate",model="{self.model}",result='
+        generated: str = f'purepale_requests_total{{{labels}"generated"}}'
+        cached: str = f'purepale_requests_total{{{labels}"cached"}}'
+        seconds: str = f'purepale_request_seconds_count{{model="{self.model}"}}'
+        # Metrics are shared by servers in this process
+        before: Dict[str, float] = self._get_metrics()
+
+        for _ in range(2):
+            resp = self.client.post("/api/generate", json=get_web_request(0, model=self.model))
+            self.assertEqual(resp.status_code, 200)
+            # Wait for the result to be written to the cache
+            self.assertEqual(self.client.get(f"/{resp.json()['path']}").status_code, 200)
+        after: Dict[str, float] = self._get_metrics()
+        for name, expected in [(generated, 1), (cached, 1), (seconds, 1)]:
+            self.assertEqual(after[name] - before.get(name, 0), expected, name)
+        self.assertEqual(after['purepale_cache_hits_total{cache="result"}'], 1)
+        for stage in ["text_encode", "denoise_step", "vae_decode"]:
+            self.assertGreater(after[f'purepale_stage_seconds_count{{stage="{stage}"}}'], 0, stage)
+        self.assertGreater(after['purepale_peak_rss_bytes{process="server"}'], 0)
+
+    def test_help(self):
+        text: str = self.client.get("/metrics").text
+        self.assertIn("# TYPE purepale_cache_hits_total counter", text)
+        self.assertIn("# TYPE purepale_peak_rss_bytes gauge", text)
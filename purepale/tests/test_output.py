@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+
+import PIL.Image
+
+from purepale.output import EXIF_MAX_BYTES, get_sidecar_path, get_suffix, is_sidecar, read_metadata, save_image
+from purepale.schema import OutputFormat, OutputOptions
+from purepale.tests.util import TempDirTestCase
+
+
+class TestOutput(TempDirTestCase):
+    def test_metadata(self):
+        image = PIL.Image.new("RGB", (16, 16), (255, 0, 0))
+        small: str = '{"prompt": "猫"}'
+        # Larger than the limit of Exif, where each character takes 2 bytes
+        large: str = "x" * (EXIF_MAX_BYTES // 2 + 1)
+        for fmt in OutputFormat:
+            options = OutputOptions(format=fmt)
+            for name, metadata in [("small", small), ("large", large), ("none", None)]:
+                path: Path = self.path_dir.joinpath(f"{name}{get_suffix(options)}")
+                save_image(image, path, options=options, metadata=metadata)
+                self.assertEqual(read_metadata(path), metadata, (fmt, name))
+                with PIL.Image.open(path) as saved:
+                    self.assertEqual(saved.size, image.size)
+                # Only metadata too large for Exif goes to the sidecar
+                expected: bool = name == "large" and fmt != OutputFormat.png
+                self.assertEqual(get_sidecar_path(path).exists(), expected, (fmt, name))
+
+    def test_sidecar_path(self):
+        path_sidecar: Path = get_sidecar_path(self.path_dir.joinpath("20230101_000000.jpg"))
+        # Not the log of the server
+        self.assertEqual(path_sidecar.name, "20230101_000000.meta.json")
+        self.assertTrue(is_sidecar(path_sidecar))
+        self.assertFalse(is_sidecar(self.path_dir.joinpath("20230101_000000.json")))
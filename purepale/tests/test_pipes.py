@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import torch
+
+from purepale.cache import get_tensor_cache
+from purepale.pipes import Pipes
+from purepale.tests.util import get_pipes
+
+
+class TestPipes(unittest.TestCase):
+    pipes: Pipes
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pipes = get_pipes()
+
+    def test_encode_texts(self):
+        cache = get_tensor_cache(1)
+        pipes: Pipes = get_pipes(embedding_cache=cache)
+        assert cache is not None
+        texts = ["a cat", "a dog", "a cat"]
+        with torch.no_grad():
+            expected: torch.Tensor = self.pipes.encode_texts(texts)
+            self.assertTrue(torch.equal(pipes.encode_texts(texts), expected))
+            self.assertEqual((cache.stats().entries, cache.stats().hits), (2, 0))
+            self.assertTrue(torch.equal(pipes.encode_texts(texts[1:]), expected[1:]))
+            self.assertEqual(cache.stats().hits, 2)
+
+        # Each entry owns its memory, so the cache counts the memory it keeps
+        for key in [(pipes._get_model_key(["tokenizer", "text_encoder"]), text) for text in texts[:2]]:
+            embedding = cache.get(key)
+            assert embedding is not None
+            self.assertEqual(embedding.untyped_storage().nbytes(), embedding.element_size() * embedding.nelement())
+        self.assertEqual(cache.stats().bytes, 2 * expected[0].element_size() * expected[0].nelement())
+
+    def test_warmup(self):
+        self.pipes.warmup()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import torch
+import torch.ao.nn.quantized.dynamic
+
+from purepale.quantization import quantize
+from purepale.tests.util import TempDirTestCase, get_pipes, get_request, get_tiny_model
+
+
+class TestQuantize(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(0)
+        self.module = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.LayerNorm(16), torch.nn.Linear(16, 4))
+        self.input = torch.randn(3, 8)
+
+    def _quantize(self) -> torch.nn.Module:
+        return quantize(self.module, fingerprint="dummy", cache_dir=self.path_dir)
+
+    def test_quantize(self):
+        quantized = quantize(self.module, fingerprint="dummy", cache_dir=None)
+        self.assertIsInstance(quantized[0], torch.ao.nn.quantized.dynamic.Linear)
+        self.assertIsInstance(quantized[2], torch.ao.nn.quantized.dynamic.Linear)
+        # The original is not changed, and other layers share its weights
+        self.assertIs(type(self.module[0]), torch.nn.Linear)
+        self.assertIs(quantized[1].weight, self.module[1].weight)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(quantized(self.input), self.module(self.input), atol=0.1))
+
+    def test_cache(self):
+        with torch.no_grad():
+            expected: torch.Tensor = self._quantize()(self.input)
+            paths: List[Path] = list(self.path_dir.iterdir())
+            self.assertEqual(len(paths), 1)
+
+            with self.assertLogs("purepale.quantization", level="INFO") as logs:
+                self.assertTrue(torch.equal(self._quantize()(self.input), expected))
+            self.assertIn("Loaded quantized weights", logs.output[0])
+
+            # Broken caches are made again
+            paths[0].write_bytes(b"broken")
+            with self.assertLogs("purepale.quantization", level="ERROR"):
+                self.assertTrue(torch.equal(self._quantize()(self.input), expected))
+            self.assertTrue(torch.equal(self._quantize()(self.input), expected))
+
+            # Other weights have other caches
+            quantize(self.module, fingerprint="other", cache_dir=self.path_dir)
+        self.assertEqual(len(list(self.path_dir.iterdir())), 2)
+
+    def test_pipes(self):
+        model: str = get_tiny_model().replace("@fp32", "@int8")
+        args: List[str] = ["--quantization-cache-dir", str(self.path_dir)]
+        image = np.asarray(get_pipes(*args, model=model).generate(request=get_request(0))[0][0], dtype=int)
+        self.assertEqual(
+            sorted(path.name.split("_")[0] for path in self.path_dir.iterdir()),
+            ["CLIPTextModel", "UNet2DConditionModel"],
+        )
+        # Loaded from the cache
+        with self.assertLogs("purepale.quantization", level="INFO"):
+            pipes = get_pipes(*args, model=model)
+        self.assertTrue(np.array_equal(np.asarray(pipes.generate(request=get_request(0))[0][0], dtype=int), image))
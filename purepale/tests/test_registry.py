@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+from typing import List
+
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.options import get_pipes_kwargs
+from purepale.registry import PipesRegistry
+from purepale.tests.util import TempDirTestCase, get_pipes_opts
+
+
+class TestPipesRegistry(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.models: List[str] = [
+            f"{build_tiny_model(self.path_dir.joinpath(f'tiny{seed}'), seed=seed)}@fp32" for seed in range(2)
+        ]
+
+    def _get_registry(self, **kwargs) -> PipesRegistry:
+        return PipesRegistry(
+            models=self.models,
+            device="cpu",
+            pipes_kwargs=get_pipes_kwargs(get_pipes_opts()),
+            feature_negative_prompt=False,
+            **kwargs,
+        )
+
+    def test_lazy_load(self):
+        registry = self._get_registry()
+        # Schedulers are known without loading models
+        self.assertEqual(registry.scheduler_param(self.models[0])["_class_name"], "PNDMScheduler")
+        with self.assertRaises(KeyError):
+            registry.scheduler_param(self.models[0], "unknown")  # type: ignore
+        self.assertEqual(registry.resident_models, [])
+
+        with registry.use(self.models[1]) as pipes:
+            self.assertEqual(registry.resident_models, [self.models[1]])
+            self.assertEqual(pipes.scheduler_params, registry._entries[self.models[1]].scheduler_params)
+
+    def test_evict(self):
+        registry = self._get_registry()
+        with registry.use(self.models[0]):
+            pass
+        nbytes: int = registry._entries[self.models[0]].nbytes
+
+        # Only one model fits
+        registry = self._get_registry(max_bytes=nbytes)
+        with registry.use(self.models[0]):
+            pass
+        with registry.use(self.models[1]):
+            self.assertEqual(registry.resident_models, [self.models[1]])
+            # Models in use are not evicted even over the budget
+            with registry.use(self.models[0]):
+                self.assertEqual(registry.resident_models, self.models)
+
+    def test_evict_to_cpu(self):
+        registry = self._get_registry(max_bytes=1, evict_to="cpu")
+        with registry.use(self.models[0]) as pipes:
+            pass
+        with registry.use(self.models[1]):
+            self.assertEqual(registry.resident_models, [self.models[1]])
+        # Evicted Pipes are kept and restored
+        with registry.use(self.models[0]) as restored:
+            self.assertIs(restored, pipes)
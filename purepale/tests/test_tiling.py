@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import threading
+import unittest
+from typing import Dict, List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from purepale.pipes import Pipes
+from purepale.tests.util import get_pipes, get_request
+from purepale.tiling import TileableConv2d, circular_padding, make_tileable
+
+
+class TestTileableConv2d(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.conv = torch.nn.Conv2d(2, 3, kernel_size=3, padding=1)
+        self.input = torch.randn(1, 2, 8, 8)
+        with torch.no_grad():
+            self.zero_padded = self.conv(self.input)
+            self.circular = F.conv2d(F.pad(self.input, (1, 1, 1, 1), mode="circular"), self.conv.weight, self.conv.bias)
+        model = torch.nn.Sequential(self.conv, torch.nn.ReLU())
+        self.assertEqual(make_tileable(model), 1)
+        self.assertIsInstance(self.conv, TileableConv2d)
+
+    def test_padding(self):
+        with torch.no_grad():
+            self.assertTrue(torch.equal(self.conv(self.input), self.zero_padded))
+            with circular_padding():
+                self.assertTrue(torch.allclose(self.conv(self.input), self.circular))
+                with circular_padding(False):
+                    self.assertTrue(torch.equal(self.conv(self.input), self.zero_padded))
+                # Outputs of shifted inputs are shifted outputs
+                shifted = self.conv(torch.roll(self.input, shifts=(3, 5), dims=(2, 3)))
+                self.assertTrue(
+                    torch.allclose(shifted, torch.roll(self.circular, shifts=(3, 5), dims=(2, 3)), atol=1e-6)
+                )
+            self.assertTrue(torch.equal(self.conv(self.input), self.zero_padded))
+
+    def test_threads(self):
+        barrier = threading.Barrier(2)
+        failures: List[bool] = []
+
+        def run(circular: bool) -> None:
+            with torch.no_grad(), circular_padding(circular):
+                for _ in range(100):
+                    # Both threads run convolutions between the barriers
+                    barrier.wait()
+                    expected = self.circular if circular else self.zero_padded
+                    failures.append(not torch.allclose(self.conv(self.input), expected))
+
+        threads = [threading.Thread(target=run, args=(circular,)) for circular in [True, False]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((len(failures), any(failures)), (200, False))
+
+
+class TestTiledGeneration(unittest.TestCase):
+    def _generate(self, pipes: Pipes, tileable: bool) -> np.ndarray:
+        request = get_request(0, prompt="a cat --tile" if tileable else "a cat", steps=20)
+        return np.asarray(pipes.generate(request=request)[0][0], dtype=int)
+
+    def test_threads(self):
+        pipes: Pipes = get_pipes()
+        expected: Dict[bool, np.ndarray] = {tileable: self._generate(pipes, tileable) for tileable in [True, False]}
+        self.assertFalse(np.array_equal(expected[True], expected[False]))
+
+        # A tiled generation and a normal one run at the same time with the shared Pipes
+        results: Dict[bool, np.ndarray] = {}
+        threads = [
+            threading.Thread(target=lambda t=tileable: results.update({t: self._generate(pipes, t)}))
+            for tileable in [True, False]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for tileable in [True, False]:
+            self.assertTrue(np.array_equal(results[tileable], expected[tileable]), tileable)
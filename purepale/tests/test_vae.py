@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from purepale.pipes import Pipes
+from purepale.tests.util import get_pipes, get_request
+from purepale.vae import _get_tiles, apply_tiled, decode_latents_tiled, encode_tiled
+
+
+class TestApplyTiled(unittest.TestCase):
+    def test_get_tiles(self):
+        for length in [10, 64, 65, 100, 200, 333]:
+            size, starts = _get_tiles(length, 64, 8, 8 if length % 8 == 0 else 1)
+            self.assertEqual((starts[0], starts[-1] + size), (0, length))
+            self.assertLessEqual(size, max(length, 64) if len(starts) == 1 else 72)
+            # Neighbors overlap
+            for prev, start in zip(starts, starts[1:]):
+                self.assertLessEqual(start, prev + size - 8)
+
+    def test_local_functions(self):
+        x = torch.randn(1, 3, 150, 100)
+        conv = torch.nn.Conv2d(3, 4, kernel_size=1)
+        for func, scale, align in [
+            (lambda t: t, 1, 1),
+            (conv, 1, 1),
+            # Upsampling tiles aligned to pixels of the input
+            (lambda t: F.interpolate(t, scale_factor=2, mode="nearest"), 2, 1),
+            (lambda t: F.avg_pool2d(t, 2), 0.5, 2),
+        ]:
+            with torch.no_grad():
+                expected = func(x)
+                actual = apply_tiled(x, func, tile=64, overlap=8, scale=scale, align=align)
+            self.assertEqual(actual.shape, expected.shape)
+            self.assertTrue(torch.allclose(actual, expected, atol=1e-5), scale)
+
+
+class TestTiledVAE(unittest.TestCase):
+    pipes: Pipes
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pipes = get_pipes()
+
+    def test_single_tile(self):
+        pipe = self.pipes.pipe
+        latents = torch.randn(2, 4, 32, 48, generator=torch.Generator().manual_seed(0))
+        with torch.no_grad():
+            images = pipe.decode_latents(latents)
+            self.assertTrue(
+                np.allclose(decode_latents_tiled(pipe.vae, latents, pipe.vae_scale_factor), images, atol=1e-4)
+            )
+            image = torch.from_numpy(images).permute(0, 3, 1, 2) * 2 - 1
+            self.assertTrue(
+                torch.allclose(
+                    encode_tiled(pipe.vae, image, pipe.vae_scale_factor).mean,
+                    pipe.vae.encode(image).latent_dist.mean,
+                    atol=1e-4,
+                )
+            )
+
+    def test_tiles(self):
+        pipe = self.pipes.pipe
+        # Two tiles in each direction
+        latents = torch.randn(1, 4, 72, 80, generator=torch.Generator().manual_seed(0))
+        with torch.no_grad():
+            images = pipe.decode_latents(latents)
+            tiled = decode_latents_tiled(pipe.vae, latents, pipe.vae_scale_factor)
+        self.assertEqual(tiled.shape, images.shape)
+        # Tiles differ only a little since attention of the VAE sees the whole image only without tiles
+        self.assertLess(np.abs(tiled - images).mean(), 0.02)
+
+    def test_generate(self):
+        request = get_request(0, size=128)
+        image = np.asarray(self.pipes.generate(request=request)[0][0], dtype=int)
+        pipes: Pipes = get_pipes("--vae-tiling-pixels", str(128 * 128 - 1))
+        tiled = np.asarray(pipes.generate(request=request)[0][0], dtype=int)
+        self.assertLessEqual(np.abs(tiled - image).max(), 1)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import shutil
+import time
+
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.options import get_batch_scheduler
+from purepale.tests.util import TempDirTestCase, get_pipes_opts, get_request
+from purepale.workers import WorkerError, WorkerPool
+
+
+class TestWorkerPool(TempDirTestCase):
+    def test_failed_restart(self):
+        path_model = build_tiny_model(self.path_dir.joinpath("tiny"))
+        model: str = f"{path_model}@fp32"
+        pool = get_batch_scheduler(get_pipes_opts(), models=[model], replicas=1)
+        assert isinstance(pool, WorkerPool)
+        self.addCleanup(pool.close)
+        self.assertEqual(len(pool.generate(model=model, request=get_request(0))), 1)
+
+        # The worker dies and fails to load the removed model again
+        worker = pool.workers[0]
+        shutil.rmtree(path_model)
+        assert worker.process is not None
+        worker.process.kill()
+        job = pool.submit(model=model, request=get_request(1))
+        with self.assertRaises(WorkerError):
+            job.future.result(timeout=120)
+        for _ in range(1200):
+            if worker.load_error is not None:
+                break
+            time.sleep(0.1)
+        self.assertFalse(worker.available)
+        with self.assertRaises(WorkerError):
+            pool.generate(model=model, request=get_request(2))
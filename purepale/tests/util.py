@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import argparse
+import atexit
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any, Dict, Optional, TypeVar
+
+from starlette.testclient import TestClient
+
+from purepale.benchmark.tiny import build_tiny_model
+from purepale.options import add_pipes_options, get_pipes_kwargs
+from purepale.pipes import Pipes
+from purepale.schema import ModelConfig, Parameters, PipesRequest, PrasedPrompt, WebRequest, WebResponse
+from purepale.serve import get_app
+from purepale.serve import get_opts as get_server_opts
+
+C = TypeVar("C")
+
+_tiny_model: Optional[str] = None
+
+
+def get_tiny_model() -> str:
+    """Return the name of a tiny fp32 model, which is built once per process."""
+    global _tiny_model
+    if _tiny_model is None:
+        path_dir = Path(tempfile.mkdtemp())
+        atexit.register(shutil.rmtree, path_dir, ignore_errors=True)
+        _tiny_model = f"{build_tiny_model(path_dir.joinpath('tiny'))}@fp32"
+    return _tiny_model
+
+
+def get_pipes_opts(*args: str) -> argparse.Namespace:
+    """Return options of ``add_pipes_options`` to run models offline without the safety checker."""
+    oparser = argparse.ArgumentParser()
+    add_pipes_options(oparser)
+    return oparser.parse_args(["--local", "--no-safety", *args])
+
+
+def get_pipes(*args: str, model: Optional[str] = None, **kwargs) -> Pipes:
+    """Return Pipes of the model (the tiny model by default) on CPU with options of ``add_pipes_options``."""
+    return Pipes(
+        model_config=ModelConfig.parse(get_tiny_model() if model is None else model),
+        device="cpu",
+        **get_pipes_kwargs(get_pipes_opts(*args)),
+        **kwargs,
+    )
+
+
+def get_request(seed: int, *, prompt: str = "a cat", steps: int = 3, size: int = 64) -> PipesRequest:
+    return PipesRequest(
+        parameters=Parameters(prompt=prompt, height=size, width=size, num_inference_steps=steps, seed=seed)
+    )
+
+
+def get_web_request(seed: int, *, model: str, prompt: str = "a cat", steps: int = 3, size: int = 64) -> Dict[str, Any]:
+    return {
+        "model": model,
+        "parameters": {"prompt": prompt, "height": size, "width": size, "num_inference_steps": steps, "seed": seed},
+    }
+
+
+def get_response(
+    name: str,
+    *,
+    model: str = "dummy",
+    prompt: Optional[str] = None,
+    seed: int = 0,
+    used_prompt: Optional[str] = None,
+) -> WebResponse:
+    """Return a response of a generation of ``images/{name}.png``, whose prompt is ``name`` by default."""
+    if prompt is None:
+        prompt = name
+    return WebResponse(
+        request=WebRequest(model=model, parameters=Parameters(prompt=prompt, seed=seed), seeds=[seed]),
+        model=ModelConfig.parse(model),
+        path=f"images/{name}.png",
+        scheduler={},
+        parsed_prompt=PrasedPrompt(
+            used_prompt=prompt if used_prompt is None else used_prompt,
+            used_prompt_tokens=[],
+            used_prompt_truncated=[],
+            negative_prompt="",
+            tileable=False,
+        ),
+        paths=[f"images/{name}.png"],
+        seeds=[seed],
+    )
+
+
+def write_result(path_out: Path, name: str, *, nbytes: int, **kwargs) -> Path:
+    """Write a log and an image of ``nbytes`` like the server, and return the path of the log."""
+    path_out.joinpath(f"{name}.png").write_bytes(b"\0" * nbytes)
+    path_log: Path = path_out.joinpath(f"{name}.json")
+    path_log.write_text(get_response(name, **kwargs).json())
+    return path_log
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Test case with a temporary directory ``path_dir`` for each test."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path_dir = Path(tmpdir.name)
+
+    def closing(self, obj: C) -> C:
+        """Close ``obj`` at the end of the test, before the directory is removed."""
+        self.addCleanup(obj.close)  # type: ignore
+        return obj
+
+    def get_client(self, *args: str) -> TestClient:
+        """Start the server of the tiny model writing outputs to ``path_dir``, and return its client."""
+        opts = get_server_opts(
+            ["--model", get_tiny_model(), "--output", str(self.path_dir), "--local", "--no-safety", *args]
+        )
+        client = TestClient(get_app(opts))
+        client.__enter__()
+        self.addCleanup(client.__exit__, None, None, None)
+        return client
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import torch
+import torch.nn.functional as F
+
+_state = threading.local()
+
+
+class TileableConv2d(torch.nn.Conv2d):
+    """Conv2d which pads circularly while ``circular_padding`` is active in the calling thread.
+
+    This is based on lox9973's snippet (https://gitlab.com/-/snippets/2395088),
+    but the padding mode is decided per thread, so that tiled and normal generations can share modules.
+    """
+
+    def _conv_forward(self, input: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor]) -> torch.Tensor:
+        if getattr(_state, "circular", False) and any(p > 0 for p in self._reversed_padding_repeated_twice):
+            return F.conv2d(
+                F.pad(input, self._reversed_padding_repeated_twice, mode="circular"),
+                weight,
+                bias,
+                self.stride,
+                0,
+                self.dilation,
+                self.groups,
+            )
+        return super()._conv_forward(input, weight, bias)
+
+
+def make_tileable(module: torch.nn.Module) -> int:
+    """Let Conv2d layers in the module follow ``circular_padding`` and return the number of them.
+
+    Layers keep their weights and behave as before outside of ``circular_padding``.
+    """
+    num: int = 0
+    for m in module.modules():
+        if type(m) is torch.nn.Conv2d:
+            m.__class__ = TileableConv2d
+        if isinstance(m, TileableConv2d):
+            num += 1
+    return num
+
+
+@contextmanager
+def circular_padding(enabled: bool = True) -> Iterator[None]:
+    """Pad tileable Conv2d layers circularly in the current thread."""
+    previous: bool = getattr(_state, "circular", False)
+    _state.circular = enabled
+    try:
+        yield
+    finally:
+        _state.circular = previous
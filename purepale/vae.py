@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import math
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+# Sizes of tiles and their overlaps in the latent space
+LATENT_TILE_SIZE: int = 64
+LATENT_TILE_OVERLAP: int = 8
+
+
+def _get_tiles(length: int, tile: int, overlap: int, align: int) -> Tuple[int, List[int]]:
+    """Return the size and start positions of the fewest evenly spaced tiles covering the length."""
+    if length <= tile:
+        return length, [0]
+    num: int = math.ceil((length - overlap) / (tile - overlap))
+    size: int = math.ceil((length + (num - 1) * overlap) / num / align) * align
+    return size, [round(i * (length - size) / (num - 1) / align) * align for i in range(num)]
+
+
+def _get_ramp(length: int, fade: int, *, fade_in: bool, fade_out: bool) -> torch.Tensor:
+    weight = torch.ones(length)
+    fade = min(fade, length)
+    ramp = torch.arange(1, fade + 1, dtype=torch.float32) / (fade + 1)
+    if fade_in:
+        weight[:fade] = ramp
+    if fade_out:
+        weight[length - fade :] = torch.minimum(weight[length - fade :], ramp.flip(0))
+    return weight
+
+
+def apply_tiled(
+    x: torch.Tensor,
+    func: Callable[[torch.Tensor], torch.Tensor],
+    *,
+    tile: int,
+    overlap: int,
+    scale: float,
+    align: int = 1,
+) -> torch.Tensor:
+    """Apply ``func`` to overlapping tiles of ``x`` and blend outputs linearly in overlaps.
+
+    Tiles are at most about ``tile`` wide, and their sizes and positions are multiples of ``align``.
+    ``func`` scales the height and the width of a tile by ``scale``.
+    """
+    height, width = x.shape[2:]
+    tile_h, ys = _get_tiles(height, tile, overlap, align)
+    tile_w, xs = _get_tiles(width, tile, overlap, align)
+    fade: int = int(overlap * scale)
+
+    out = None
+    weight_sum = None
+    dtype = x.dtype
+    for y in ys:
+        for x0 in xs:
+            t: torch.Tensor = func(x[:, :, y : y + tile_h, x0 : x0 + tile_w])
+            if out is None:
+                dtype = t.dtype
+                out = torch.zeros(
+                    (t.size(0), t.size(1), int(height * scale), int(width * scale)),
+                    dtype=torch.float32,
+                    device=t.device,
+                )
+                weight_sum = torch.zeros(out.shape[2:], dtype=torch.float32, device=t.device)
+            assert weight_sum is not None
+            weight = (
+                _get_ramp(t.size(2), fade, fade_in=y > 0, fade_out=y != ys[-1])[:, None]
+                * _get_ramp(t.size(3), fade, fade_in=x0 > 0, fade_out=x0 != xs[-1])[None, :]
+            ).to(t.device)
+            oy, ox = int(y * scale), int(x0 * scale)
+            out[:, :, oy : oy + t.size(2), ox : ox + t.size(3)] += t.float() * weight
+            weight_sum[oy : oy + t.size(2), ox : ox + t.size(3)] += weight
+    assert out is not None and weight_sum is not None
+    return (out / weight_sum).to(dtype)
+
+
+def decode_latents_tiled(vae, latents: torch.Tensor, scale_factor: int) -> np.ndarray:
+    """Same as ``decode_latents`` of pipelines, but decode each image in tiles."""
+    latents = 1 / 0.18215 * latents
+    images: List[torch.Tensor] = []
+    for i in range(latents.size(0)):
+        images.append(
+            apply_tiled(
+                latents[i : i + 1],
+                lambda t: vae.decode(t).sample,
+                tile=LATENT_TILE_SIZE,
+                overlap=LATENT_TILE_OVERLAP,
+                scale=scale_factor,
+            )
+        )
+    image = (torch.cat(images) / 2 + 0.5).clamp(0, 1)
+    return image.cpu().permute(0, 2, 3, 1).float().numpy()
+
+
+def encode_tiled(vae, image: torch.Tensor, scale_factor: int) -> DiagonalGaussianDistribution:
+    """Same as ``vae.encode(image).latent_dist``, but encode each image in tiles."""
+    moments: List[torch.Tensor] = []
+    for i in range(image.size(0)):
+        moments.append(
+            apply_tiled(
+                image[i : i + 1],
+                lambda t: vae.quant_conv(vae.encoder(t)),
+                tile=LATENT_TILE_SIZE * scale_factor,
+                overlap=LATENT_TILE_OVERLAP * scale_factor,
+                scale=1 / scale_factor,
+                align=scale_factor,
+            )
+        )
+    return DiagonalGaussianDistribution(torch.cat(moments))
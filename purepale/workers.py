@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import PIL
+import PIL.Image
+import torch
+
+from purepale.batching import BatchJob, BatchScheduler, FairShare, track_inflight
+from purepale.cache import get_tensor_cache
+from purepale.metrics import METRICS, get_peak_rss
+from purepale.pipes import GenerationCancelled
+from purepale.registry import PipesRegistry
+from purepale.runtime import set_num_threads
+from purepale.schema import PipesRequest, PrasedPrompt, SchedulerName
+
+logger = getLogger(__name__)
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _worker_main(
+    *,
+    model: str,
+    device: str,
+    num_threads: int,
+    num_interop_threads: int,
+    pipes_kwargs: Dict[str, Any],
+    feature_negative_prompt: bool,
+    embedding_cache_mb: int,
+    latent_cache_mb: int,
+    scheduler_kwargs: Dict[str, Any],
+    inbox: "multiprocessing.Queue",
+    outbox: "multiprocessing.Queue",
+) -> None:
+    """Entry point of a worker process which serves one model."""
+    set_num_threads(intra_op=num_threads, inter_op=num_interop_threads)
+
+    try:
+        # The model is never evicted since it is the only one
+        registry = PipesRegistry(
+            models=[model],
+            device=device,
+            pipes_kwargs=pipes_kwargs,
+            feature_negative_prompt=feature_negative_prompt,
+            embedding_cache=get_tensor_cache(embedding_cache_mb),
+            latent_cache=get_tensor_cache(latent_cache_mb),
+        )
+        with registry.use(model) as pipes:
+            scheduler_params = pipes.scheduler_params
+    except Exception as e:
+        outbox.put(("failed", "".join(traceback.TracebackException.from_exception(e).format())))
+        return
+    outbox.put(("ready", scheduler_params))
+
+    batch_scheduler = BatchScheduler(
+        registry=registry,
+        **scheduler_kwargs,
+    )
+    jobs: Dict[int, BatchJob] = {}
+
+    def on_done(job_id: int, future: "Future[List[Tuple[PIL.Image.Image, PrasedPrompt]]]") -> None:
+        jobs.pop(job_id, None)
+        if future.cancelled():
+            outbox.put(("cancelled", job_id))
+            return
+        e = future.exception()
+        outbox.put(("metrics", METRICS.pop_changes(), get_peak_rss()))
+        if isinstance(e, GenerationCancelled):
+            outbox.put(("cancelled", job_id))
+        elif e is not None:
+            outbox.put(("error", job_id, "".join(str(v) for v in e.args)))
+        else:
+            outbox.put(("done", job_id, future.result()))
+
+    while True:
+        msg = inbox.get()
+        if msg[0] == "submit":
+            _, job_id, request, priority, client = msg
+            job = batch_scheduler.submit(
+                model=model,
+                request=request,
+                priority=priority,
+                client=client,
+                on_progress=lambda j, job_id=job_id: outbox.put(("progress", job_id, j.step, j.total_steps)),
+            )
+            jobs[job_id] = job
+            job.future.add_done_callback(lambda future, job_id=job_id: on_done(job_id, future))
+        elif msg[0] == "cancel":
+            job = jobs.get(msg[1])
+            if job is not None:
+                batch_scheduler.cancel(job)
+        elif msg[0] == "close":
+            break
+    batch_scheduler.close()
+
+
+class Worker:
+    model: str
+    index: int
+    device: str
+    capacity: int
+    process: Optional[multiprocessing.process.BaseProcess]
+    inbox: "multiprocessing.Queue"
+    outbox: "multiprocessing.Queue"
+    ready: threading.Event
+    inflight: Dict[int, BatchJob]
+    scheduler_params: Dict[Optional[SchedulerName], Dict[str, Any]]
+    load_error: Optional[str]
+
+    def __init__(self, *, model: str, index: int, device: str, capacity: int):
+        self.model = model
+        self.index = index
+        self.device = device
+        self.capacity = capacity
+        self.process = None
+        self.ready = threading.Event()
+        self.inflight = {}
+        self.scheduler_params = {}
+        self.load_error = None
+
+    def __str__(self) -> str:
+        return f"Worker({self.model}#{self.index}@{self.device})"
+
+    @property
+    def available(self) -> bool:
+        return (
+            self.ready.is_set()
+            and self.load_error is None
+            and self.process is not None
+            and self.process.is_alive()
+            and len(self.inflight) < self.capacity
+        )
+
+
+class WorkerPool:
+    """Run each replica of each model in its own process.
+
+    Requests wait here in the order of priority and usage of clients (see FairShare),
+    and go to the replica of the model with the fewest jobs in flight.
+    Each replica takes up to ``max_inflight * max_batch`` jobs and batches them with its own BatchScheduler.
+    When a worker process dies, its jobs fail and the worker is restarted.
+    When no worker of a model can be restarted, the jobs waiting for the model fail.
+    """
+
+    def __init__(
+        self,
+        *,
+        models: List[str],
+        replicas: int,
+        device: str,
+        pipes_kwargs: Dict[str, Any],
+        feature_negative_prompt: bool,
+        embedding_cache_mb: int,
+        latent_cache_mb: int,
+        window_ms: int,
+        max_batch: int,
+        max_process: int,
+        max_inflight: Optional[int] = None,
+        num_threads: int = 0,
+        num_interop_threads: int = 0,
+    ):
+        assert replicas >= 1
+        if max_inflight is None:
+            max_inflight = max_process
+        self._ctx = multiprocessing.get_context("spawn")
+        self._pipes_kwargs: Dict[str, Any] = pipes_kwargs
+        self._feature_negative_prompt: bool = feature_negative_prompt
+        self._embedding_cache_mb: int = embedding_cache_mb
+        self._latent_cache_mb: int = latent_cache_mb
+        self._scheduler_kwargs: Dict[str, Any] = {
+            "window_ms": window_ms,
+            "max_batch": max_batch,
+            "max_process": max_process,
+            "max_inflight": max_inflight,
+        }
+
+        num_devices: int = torch.cuda.device_count() if device == "cuda" else 0
+        self.workers: List[Worker] = []
+        for model in models:
+            for index in range(replicas):
+                _device: str = device
+                if num_devices > 0:
+                    _device = f"cuda:{len(self.workers) % num_devices}"
+                self.workers.append(
+                    Worker(
+                        model=model,
+                        index=index,
+                        device=_device,
+                        capacity=max_inflight * max_batch,
+                    )
+                )
+        self._num_threads: int = num_threads
+        if num_threads <= 0 and device == "cpu":
+            # Workers share CPU cores by default
+            self._num_threads = max(1, (os.cpu_count() or 1) // len(self.workers))
+        self._num_interop_threads: int = num_interop_threads
+
+        self.fair_share = FairShare()
+        self._cond = threading.Condition()
+        self._pending: Dict[str, List[BatchJob]] = {model: [] for model in models}
+        self._next_job_id: int = 0
+        self._closed: bool = False
+
+        for worker in self.workers:
+            self._start(worker)
+        for worker in self.workers:
+            threading.Thread(target=self._read_loop, args=(worker,), daemon=True).start()
+        for worker in self.workers:
+            worker.ready.wait()
+            if worker.load_error is not None:
+                self.close()
+                raise WorkerError(f"Failed to start {worker}\n{worker.load_error}")
+        self._thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._thread.start()
+
+    @property
+    def models(self) -> List[str]:
+        return list(self._pending.keys())
+
+    @property
+    def resident_models(self) -> List[str]:
+        return [model for model in self.models if any(w.model == model and w.ready.is_set() for w in self.workers)]
+
+    def scheduler_param(self, model: str, scheduler: Optional[SchedulerName] = None) -> Dict[str, Any]:
+        for worker in self.workers:
+            if worker.model == model:
+                return worker.scheduler_params[scheduler]
+        raise KeyError(model)
+
+    @property
+    def num_pending(self) -> int:
+        with self._cond:
+            return sum(len(jobs) for jobs in self._pending.values())
+
+    def _start(self, worker: Worker) -> None:
+        logger.info(f"Starting {worker}")
+        worker.ready.clear()
+        worker.inbox = self._ctx.Queue()
+        worker.outbox = self._ctx.Queue()
+        worker.process = self._ctx.Process(  # type: ignore
+            target=_worker_main,
+            kwargs={
+                "model": worker.model,
+                "device": worker.device,
+                "num_threads": self._num_threads,
+                "num_interop_threads": self._num_interop_threads,
+                "pipes_kwargs": self._pipes_kwargs,
+                "feature_negative_prompt": self._feature_negative_prompt,
+                "embedding_cache_mb": self._embedding_cache_mb,
+                "latent_cache_mb": self._latent_cache_mb,
+                "scheduler_kwargs": self._scheduler_kwargs,
+                "inbox": worker.inbox,
+                "outbox": worker.outbox,
+            },
+            daemon=True,
+        )
+        worker.process.start()  # type: ignore
+
+    def _read_loop(self, worker: Worker) -> None:
+        while True:
+            try:
+                msg = worker.outbox.get(timeout=1.0)
+            except queue.Empty:
+                if self._closed:
+                    return
+                assert worker.process is not None
+                if not worker.process.is_alive():
+                    if not worker.ready.is_set():
+                        self._on_load_failed(
+                            worker, f"{worker} exited with code {worker.process.exitcode} while loading"
+                        )
+                        return
+                    self._on_worker_died(worker)
+                continue
+
+            if msg[0] == "ready":
+                worker.scheduler_params = msg[1]
+                worker.ready.set()
+                logger.info(f"{worker} is ready")
+                with self._cond:
+                    self._cond.notify()
+            elif msg[0] == "failed":
+                self._on_load_failed(worker, msg[1])
+                return
+            elif msg[0] == "metrics":
+                METRICS.merge(msg[1])
+                METRICS.set("purepale_peak_rss_bytes", msg[2], process=str(worker))
+            elif msg[0] == "progress":
+                job = worker.inflight.get(msg[1])
+                if job is not None:
+                    self.fair_share.charge(job.client, (msg[2] - job.step) * job.step_cost)
+                    job.step = msg[2]
+                    job.total_steps = msg[3]
+                    if job.on_progress is not None:
+                        job.on_progress(job)
+            else:
+                self._finish(worker, msg)
+
+    def _finish(self, worker: Worker, msg: Tuple) -> None:
+        with self._cond:
+            job: Optional[BatchJob] = worker.inflight.pop(msg[1], None)
+            self._cond.notify()
+        if job is None:
+            return
+        if msg[0] == "done":
+            job.future.set_result(msg[2])
+        elif msg[0] == "cancelled":
+            job.future.set_exception(GenerationCancelled())
+        else:
+            job.future.set_exception(WorkerError(msg[2]))
+
+    def _on_worker_died(self, worker: Worker) -> None:
+        logger.error(f"{worker} died")
+        with self._cond:
+            jobs: List[BatchJob] = list(worker.inflight.values())
+            worker.inflight.clear()
+        for job in jobs:
+            job.future.set_exception(WorkerError(f"{worker} died"))
+        self._start(worker)
+
+    def _on_load_failed(self, worker: Worker, error: str) -> None:
+        logger.error(f"{worker} failed to load\n{error}")
+        with self._cond:
+            worker.load_error = error
+            left: List[BatchJob] = []
+            if not self._has_worker(worker.model):
+                left = list(self._pending[worker.model])
+                self._pending[worker.model].clear()
+        worker.ready.set()
+        for job in left:
+            if job.future.set_running_or_notify_cancel():
+                job.future.set_exception(WorkerError(f"No worker of {worker.model} is running"))
+
+    def _has_worker(self, model: str) -> bool:
+        return any(w.model == model and w.load_error is None for w in self.workers)
+
+    def submit(
+        self,
+        *,
+        model: str,
+        request: PipesRequest,
+        priority: int = 0,
+        on_progress: Optional[Callable[[BatchJob], None]] = None,
+        client: str = "",
+    ) -> BatchJob:
+        assert model in self._pending
+        job = BatchJob(
+            request=request,
+            priority=priority,
+            on_progress=on_progress,
+            client=client,
+        )
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WorkerPool is closed")
+            running: bool = self._has_worker(model)
+            if running:
+                self.fair_share.join(job)
+                self._pending[model].append(job)
+                self._cond.notify()
+        track_inflight(model=model, job=job)
+        if not running:
+            job.future.set_running_or_notify_cancel()
+            job.future.set_exception(WorkerError(f"No worker of {model} is running"))
+        return job
+
+    def generate(
+        self,
+        *,
+        model: str,
+        request: PipesRequest,
+        client: str = "",
+    ) -> List[Tuple[PIL.Image.Image, PrasedPrompt]]:
+        return self.submit(model=model, request=request, client=client).future.result()
+
+    def cancel(self, job: BatchJob) -> None:
+        queued: bool = False
+        with self._cond:
+            job.cancel_requested = True
+            for jobs in self._pending.values():
+                if job in jobs:
+                    jobs.remove(job)
+                    queued = True
+                    break
+            if not queued:
+                for worker in self.workers:
+                    for job_id, inflight in worker.inflight.items():
+                        if inflight is job:
+                            worker.inbox.put(("cancel", job_id))
+        if queued:
+            job.future.cancel()
+
+    def queue_position(self, job: BatchJob) -> Optional[int]:
+        """Return the number of queued jobs which run before the job, or None if it is not queued."""
+        with self._cond:
+            found: bool = False
+            ahead: int = 0
+            order = self.fair_share.order(job)
+            # Jobs of other models count too, since workers of all models share devices
+            for jobs in self._pending.values():
+                for other in jobs:
+                    if other is job:
+                        found = True
+                    elif self.fair_share.order(other) < order:
+                        ahead += 1
+            return ahead if found else None
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            left: List[BatchJob] = [job for jobs in self._pending.values() for job in jobs]
+            for jobs in self._pending.values():
+                jobs.clear()
+        for job in left:
+            job.future.set_running_or_notify_cancel()
+            job.future.set_exception(RuntimeError("WorkerPool is closed"))
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.inbox.put(("close",))
+                worker.process.join(timeout=10)
+
+    def _dispatch_loop(self) -> None:
+        with self._cond:
+            while not self._closed:
+                dispatched: bool = False
+                for model, jobs in self._pending.items():
+                    if len(jobs) == 0:
+                        continue
+                    candidates: List[Worker] = [w for w in self.workers if w.model == model and w.available]
+                    if len(candidates) == 0:
+                        continue
+                    worker: Worker = min(candidates, key=lambda w: len(w.inflight))
+                    job: BatchJob = min(jobs, key=self.fair_share.order)
+                    jobs.remove(job)
+                    job.future.set_running_or_notify_cancel()
+                    METRICS.observe("purepale_queue_wait_seconds", time.monotonic() - job.arrived, queue="pool")
+
+                    job_id: int = self._next_job_id
+                    self._next_job_id += 1
+                    worker.inflight[job_id] = job
+                    worker.inbox.put(("submit", job_id, job.request, job.priority, job.client))
+                    dispatched = True
+                if not dispatched:
+                    self._cond.wait()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from typing import Callable, Dict, List, Optional
+
+logger = getLogger(__name__)
+
+
+class BackgroundWriter:
+    """Write output files in background threads to keep encoding off the request threads.
+
+    Readers of a file being written wait for it with ``get_pending``.
+    ``max_workers=0`` writes files in the thread of the caller.
+    """
+
+    def __init__(self, *, max_workers: int):
+        assert max_workers >= 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if max_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="writer")
+        self._lock = threading.Lock()
+        self._pending: Dict[str, "Future[None]"] = {}
+
+    def submit(self, names: List[str], func: Callable[[], None]) -> "Future[None]":
+        """Run ``func``, which writes files of ``names``."""
+
+        def run() -> None:
+            try:
+                func()
+            except Exception:
+                logger.exception(f"Failed to write {names}")
+
+        future: "Future[None]"
+        if self._executor is None:
+            future = Future()
+            run()
+            future.set_result(None)
+            return future
+
+        with self._lock:
+            future = self._executor.submit(run)
+            for name in names:
+                self._pending[name] = future
+
+        def done(_: "Future[None]") -> None:
+            with self._lock:
+                for name in names:
+                    if self._pending.get(name) is future:
+                        del self._pending[name]
+
+        future.add_done_callback(done)
+        return future
+
+    def get_pending(self, name: str) -> Optional["Future[None]"]:
+        with self._lock:
+            return self._pending.get(name)
+
+    def close(self) -> None:
+        """Wait for all files to be written."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)